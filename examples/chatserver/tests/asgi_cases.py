@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ASGI websocket server, which are written as coroutines, and hence are imported by
+``test_asgi`` on Python 3 only.
+"""
+import asyncio
+import unittest
+from django.test import SimpleTestCase
+from ws4redis import settings as private_settings
+from ws4redis.drain import Drain
+from ws4redis.exceptions import SlowConsumerError
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+try:
+    from asgiref.sync import async_to_sync
+    from asgiref.testing import ApplicationCommunicator
+except ImportError:
+    # the tests are skipped, but their decorator must be available
+    ApplicationCommunicator, async_to_sync = None, lambda func: func
+
+try:
+    from ws4redis.asgi_server import WebsocketASGIServer, AsyncOutboundQueue
+except ImportError:
+    WebsocketASGIServer = None
+
+
+@unittest.skipIf(ApplicationCommunicator is None, "asgiref is not available")
+@unittest.skipIf(WebsocketASGIServer is None, "redis.asyncio is not available")
+class WebsocketASGITests(SimpleTestCase):
+    def setUp(self):
+        self.facility = u'asgitest'
+
+    def connect(self, application, query_string, headers=()):
+        scope = {
+            'type': 'websocket',
+            'path': '/ws/' + self.facility,
+            'query_string': query_string,
+            'headers': list(headers),
+        }
+        return ApplicationCommunicator(application, scope)
+
+    @async_to_sync
+    async def test_subscribe_publish_broadcast(self):
+        publisher = RedisPublisher(facility=self.facility, broadcast=True)
+        publisher.publish_message(RedisMessage(u'persisted'), 10)
+        application = WebsocketASGIServer()
+        communicator = self.connect(application, b'subscribe-broadcast&publish-broadcast&echo')
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.accept'})
+        # the persisted message is replayed upon connection
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.send', 'text': u'persisted'})
+        await communicator.send_input({'type': 'websocket.receive', 'text': u'Grüße'})
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.send', 'text': u'Grüße'})
+        # a second websocket shares the PubSub connection of the first one
+        other = self.connect(application, b'subscribe-broadcast')
+        await other.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await other.receive_output(2), {'type': 'websocket.accept'})
+        self.assertEqual((await other.receive_output(2))['text'], u'Grüße')
+        publisher.publish_message(RedisMessage(u'broadcast'))
+        self.assertEqual((await communicator.receive_output(2))['text'], u'broadcast')
+        self.assertEqual((await other.receive_output(2))['text'], u'broadcast')
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await other.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(2)
+        await other.wait(2)
+        self.assertFalse(application.websockets)
+
+    @async_to_sync
+    async def test_outbound_queue(self):
+        queue = AsyncOutboundQueue(high_water_mark=11, policy='drop-oldest')
+        for message in (b'first', b'second', b'third'):
+            queue.put_nowait((message, None), b'channel')
+        # the oldest message is dropped, to keep the queue below its high water mark
+        self.assertEqual(await queue.get(), (b'second', None))
+        self.assertEqual(await queue.get(), (b'third', None))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.1)
+        queue = AsyncOutboundQueue(high_water_mark=10, policy='close-1013')
+        queue.put_nowait((b'first', None), b'channel')
+        queue.put_nowait((b'second', None), b'channel')
+        with self.assertRaises(SlowConsumerError) as context:
+            await queue.get()
+        self.assertEqual(context.exception.code, 1013)
+
+    @async_to_sync
+    async def test_slow_consumer(self):
+        self.facility = u'asgislow'
+        outbound_queue = private_settings.WS4REDIS_OUTBOUND_QUEUE
+        private_settings.WS4REDIS_OUTBOUND_QUEUE = {'high_water_mark': 10, 'policy': 'close-1008'}
+        try:
+            application = WebsocketASGIServer()
+            communicator = self.connect(application, b'subscribe-broadcast')
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.accept'})
+        finally:
+            private_settings.WS4REDIS_OUTBOUND_QUEUE = outbound_queue
+        connection = RedisPublisher()._connection
+        for _ in range(50):
+            if connection.pubsub_numsub('ws4redis:broadcast:asgislow')[0][1]:
+                break
+            await asyncio.sleep(0.05)
+        # publish more than the high water mark, before the client is served
+        pipeline = connection.pipeline(transaction=False)
+        for count in range(20):
+            pipeline.publish('ws4redis:broadcast:asgislow', 'message {0}'.format(count))
+        pipeline.execute()
+        while True:
+            event = await communicator.receive_output(2)
+            if event['type'] == 'websocket.close':
+                break
+        self.assertEqual(event['code'], 1008)
+        await communicator.wait(2)
+
+    @async_to_sync
+    async def test_stream(self):
+        self.facility = u'asgistream'
+        private_settings.WS4REDIS_STREAM = {'maxlen': 100, 'expire': 60}
+        try:
+            publisher = RedisPublisher(facility=self.facility, broadcast=True)
+            publisher._connection.delete('ws4redis:stream:{ws4redis:broadcast:asgistream}',
+                                         'ws4redis:sequence:{ws4redis:broadcast:asgistream}')
+            publisher.publish_message(RedisMessage(u'persisted'), 10)
+            application = WebsocketASGIServer()
+            communicator = self.connect(application, b'subscribe-broadcast&publish-broadcast&echo')
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.accept'})
+            # messages are sent without their sequence numbers
+            self.assertEqual((await communicator.receive_output(2))['text'], u'persisted')
+            await communicator.send_input({'type': 'websocket.receive', 'text': u'echo'})
+            self.assertEqual((await communicator.receive_output(2))['text'], u'echo')
+            entries = publisher._connection.xrange('ws4redis:stream:{ws4redis:broadcast:asgistream}')
+            self.assertEqual([fields[b'message'] for _, fields in entries], [b'persisted', b'echo'])
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(2)
+        finally:
+            private_settings.WS4REDIS_STREAM = None
+
+    @async_to_sync
+    async def test_drain(self):
+        self.facility = u'asgidrain'
+        application = WebsocketASGIServer()
+        drain = Drain(window=0.2, code=1012, reconnect_delay=1.0)
+        drain.register(application)
+        communicator = self.connect(application, b'subscribe-broadcast')
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.accept'})
+        drain.start()
+        event = await communicator.receive_output(2)
+        self.assertEqual((event['type'], event['code']), ('websocket.close', 1012))
+        self.assertTrue(event['reason'].startswith('reconnect-delay='))
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1012})
+        await communicator.wait(2)
+        # further websockets are rejected
+        other = self.connect(application, b'subscribe-broadcast')
+        await other.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await other.receive_output(2))['type'], 'websocket.close')
+        await other.wait(2)
+
+    @async_to_sync
+    async def test_denied_channels(self):
+        private_settings.WS4REDIS_ALLOWED_CHANNELS = 'chatserver.tests.denied_channels.denied_channels'
+        try:
+            application = WebsocketASGIServer()
+            communicator = self.connect(application, b'subscribe-broadcast', [(b'deny-channels', b'YES')])
+            await communicator.send_input({'type': 'websocket.connect'})
+            # closing before accepting, rejects the handshake
+            self.assertEqual((await communicator.receive_output(2))['type'], 'websocket.close')
+            await communicator.wait(2)
+        finally:
+            private_settings.WS4REDIS_ALLOWED_CHANNELS = None
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+import six
+
+if six.PY3:
+    from .asgi_cases import WebsocketASGITests  # noqa: F401
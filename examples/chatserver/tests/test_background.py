@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+from redis import StrictRedis
+from ws4redis import metrics
+from ws4redis import settings as private_settings
+from ws4redis.background import BackgroundPublisher
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+
+class BackgroundPublisherTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        self.channels = ['ws4redis:user:john:background', 'ws4redis:user:mary:background']
+        self.connection.delete(*self.channels)
+        self.pubsub = self.connection.pubsub()
+        self.pubsub.subscribe(*self.channels)
+        for _ in self.channels:
+            self.assertEqual(self.pubsub.get_message(timeout=1.0)['type'], 'subscribe')
+        self.publisher = RedisPublisher(facility='background', users=['john', 'mary'])
+
+    def tearDown(self):
+        self.pubsub.close()
+        self.connection.delete(*self.channels)
+
+    def receive(self):
+        received = []
+        message = self.pubsub.get_message(timeout=1.0)
+        while message:
+            received.append((message['channel'].decode(), message['data']))
+            message = self.pubsub.get_message(timeout=0.2)
+        return sorted(received)
+
+    def test_flush(self):
+        background = BackgroundPublisher(flush_interval=0.05, batch_size=3)
+        try:
+            for k in range(4):
+                self.assertTrue(self.publisher.enqueue_message(RedisMessage(u'm{0}'.format(k)), 10, background))
+            self.assertTrue(background.flush(timeout=5))
+        finally:
+            background.close()
+        self.assertEqual(self.receive(), sorted((channel, 'm{0}'.format(k).encode())
+                                                for channel in self.channels for k in range(4)))
+        self.assertEqual(self.connection.get(self.channels[0]), b'm3')
+        self.assertEqual(metrics.get_counters()['background.published_messages'], 4)
+        self.assertIn('background.queue_depth', metrics.get_histograms())
+
+    def test_dropped_messages(self):
+        # the thread keeps waiting for a batch, until it is flushed
+        background = BackgroundPublisher(max_queue=2, flush_interval=30, batch_size=100)
+        try:
+            self.assertTrue(self.publisher.enqueue_message(RedisMessage(u'first'), 10, background))
+            self.assertTrue(self.publisher.enqueue_message(RedisMessage(u'second'), 10, background))
+            self.assertFalse(self.publisher.enqueue_message(RedisMessage(u'third'), 10, background))
+            self.assertEqual(metrics.get_counters()['background.dropped_messages'], 1)
+            self.assertTrue(background.flush(timeout=5))
+        finally:
+            background.close()
+        self.assertEqual([data for channel, data in self.receive() if channel == self.channels[0]],
+                         [b'first', b'second'])
+
+    def test_close(self):
+        background = BackgroundPublisher(flush_interval=30)
+        self.publisher.enqueue_message(RedisMessage(u'pending'), 10, background)
+        thread = background._thread
+        background.close()
+        # pending messages are published before the thread stops
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.connection.get(self.channels[1]), b'pending')
+        self.assertFalse(self.publisher.enqueue_message(RedisMessage(u'late'), 10, background))
+        self.assertEqual(metrics.get_counters()['background.dropped_messages'], 1)
+
+    def test_synchronous(self):
+        self.assertTrue(self.publisher.enqueue_message(RedisMessage(u'direct'), 10))
+        self.assertEqual(self.connection.get(self.channels[0]), b'direct')
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+import select
+import socket
 import requests
 import six
 import django
@@ -12,11 +14,16 @@ from django.test.client import RequestFactory
 from importlib import import_module
 
 from django.core.servers.basehttp import WSGIServer
+from redis import StrictRedis
 from websocket import create_connection, WebSocketException
+from ws4redis import metrics
 from ws4redis import settings as private_settings
-from ws4redis.django_runserver import application
+from ws4redis.django_runserver import application, _websocket_app as websocket_app
+from ws4redis.multiplexer import get_multiplexer
 from ws4redis.publisher import RedisPublisher
 from ws4redis.redis_store import RedisMessage, SELF
+from ws4redis.subscriber import RedisSubscriber, MultiplexedRedisSubscriber
+from ws4redis.websocket import PreparedFrame
 
 from .denied_channels import denied_channels
 
@@ -294,6 +301,22 @@ class WebsocketTests(LiveServerTestCase):
         response = requests.post(websocket_url, {})
         self.assertEqual(response.status_code, 400)
 
+    def test_handshake_timings(self):
+        metrics.reset()
+        response = requests.get(self.live_server_url + u'/ws/foobar')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(metrics.get_counters()['handshake.rejected'], 1)
+        ws = create_connection(self.websocket_base_url + u'?subscribe-broadcast')
+        stages = ['protocol', 'request', 'auth', 'channels', 'upgrade', 'subscribe', 'replay']
+        deadline = time.time() + 5
+        while 'handshake.replay' not in metrics.get_histograms() and time.time() < deadline:
+            time.sleep(0.01)
+        ws.close()
+        histograms = metrics.get_histograms()
+        # the rejected handshake stopped at the protocol check, hence each stage was timed once
+        for stage in stages:
+            self.assertEqual(sum(count for _, count in histograms['handshake.' + stage]), 1)
+
     def t_e_s_t_invalid_version(self):
         # does not work: websocket library overrides Sec-WebSocket-Version
         websocket_url = self.websocket_base_url + u'?publish-broadcast'
@@ -307,8 +330,43 @@ class WebsocketTests(LiveServerTestCase):
         pub2 = RedisPublisher(facility=self.facility, users=['john'])
         self.assertEqual(pub2._publishers, set([self.prefix + ':user:john:' + self.facility]))
 
+    def test_channel_keys(self):
+        request = self.factory.get('/chat/')
+        request.user = User.objects.get(username='mary')
+        publisher = RedisPublisher()
+        channels = publisher._get_message_channels(request, facility=self.facility, users=['john', SELF],
+                                                   groups=['chatusers'], sessions=['abc'])
+        self.assertEqual(sorted(channels), sorted([
+            self.prefix + ':user:john:' + self.facility,
+            self.prefix + ':user:mary:' + self.facility,
+            self.prefix + ':group:chatusers:' + self.facility,
+            self.prefix + ':session:abc:' + self.facility,
+        ]))
+        # keys are built once and then shared
+        again = publisher._get_message_channels(facility=self.facility, groups=['chatusers'])
+        self.assertIs(again[0], channels[channels.index(again[0])])
+        # subclasses may override the prefix
+        class PrefixedPublisher(RedisPublisher):
+            @staticmethod
+            def get_prefix():
+                return 'other:'
+
+        self.assertEqual(PrefixedPublisher()._get_message_channels(facility=self.facility, broadcast=True),
+                         ['other:broadcast:' + self.facility])
+        self.assertEqual(publisher._get_message_channels(facility=self.facility, broadcast=True),
+                         [self.prefix + ':broadcast:' + self.facility])
+        # facilities may contain braces
+        self.assertEqual(publisher._get_message_channels(facility='{x}', users=[7]), [self.prefix + ':user:7:{x}'])
+        # duplicate entries are dropped, keeping the order
+        channels = publisher._get_message_channels(facility='dup', groups=['b', 'a', 'b'], users=['u', 'u'],
+                                                   sessions=['s', 's'])
+        self.assertEqual(channels, [self.prefix + ':group:b:dup', self.prefix + ':group:a:dup',
+                                    self.prefix + ':user:u:dup', self.prefix + ':session:s:dup'])
+
     def test_forbidden_channel(self):
+        # the handshake is compiled, when the server is created
         private_settings.WS4REDIS_ALLOWED_CHANNELS = None
+        websocket_app.compile_handshake()
         websocket_url = self.websocket_base_url + u'?subscribe-broadcast&publish-broadcast'
         ws = create_connection(websocket_url, header=['Deny-Channels: YES'])
         self.assertTrue(True)  # Passes because all channels allowed.
@@ -317,6 +375,7 @@ class WebsocketTests(LiveServerTestCase):
         callbacks = [denied_channels, 'chatserver.tests.denied_channels.denied_channels']
         for callback in callbacks:
             private_settings.WS4REDIS_ALLOWED_CHANNELS = callback
+            websocket_app.compile_handshake()
             try:
                 ws = create_connection(websocket_url, header=['Deny-Channels: YES'])
                 self.fail('Did not reject channels')
@@ -367,6 +426,22 @@ class WebsocketTests(LiveServerTestCase):
         ws.close()
         self.assertFalse(ws.connected)
 
+    def test_compression_opt_in(self):
+        websocket_url = self.websocket_base_url + u'?subscribe-broadcast'
+        header = ['Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits']
+        # compression is not offered, unless configured
+        ws = create_connection(websocket_url, header=header)
+        self.assertNotIn('sec-websocket-extensions', ws.headers)
+        ws.close()
+        deflate = private_settings.WS4REDIS_PERMESSAGE_DEFLATE
+        try:
+            private_settings.WS4REDIS_PERMESSAGE_DEFLATE = {}
+            ws = create_connection(websocket_url, header=header)
+            self.assertTrue(ws.headers['sec-websocket-extensions'].startswith('permessage-deflate'))
+            ws.close()
+        finally:
+            private_settings.WS4REDIS_PERMESSAGE_DEFLATE = deflate
+
     @unittest.skipIf(django.VERSION < (1, 8), reason='Binary websockets not supported below Django 1.8')
     def test_binary_message_publish_broadcast(self):
         message = RedisMessage(b'\x00\x12\xaa')
@@ -383,3 +458,204 @@ class WebsocketTests(LiveServerTestCase):
         self.assertEqual(result, message)
         # now access Redis store directly
         self.assertEqual(publisher._connection.get(self.prefix + ':broadcast:' + self.facility), message)
+
+    def test_multiplexed_subscriber(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        channel = self.prefix + ':broadcast:' + self.facility
+        subscribers = [MultiplexedRedisSubscriber(connection) for _ in range(10)]
+        for subscriber in subscribers:
+            subscriber.subscribe_channels([channel])
+        self.assertEqual(connection.pubsub_numsub(channel)[0][1], 1)
+        self.assertEqual(connection.publish(channel, self.message), 1)
+        frames = set()
+        for subscriber in subscribers:
+            ready = select.select([subscriber.get_file_descriptor()], [], [], 1.0)[0]
+            self.assertTrue(ready)
+            frames.add(subscriber.parse_response())
+            self.assertIsNone(subscriber.parse_response())
+        # the websocket frame is encoded once and shared by all subscribers
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames.pop().message, self.message)
+        for subscriber in subscribers:
+            subscriber.release()
+        time.sleep(0.1)
+        self.assertEqual(connection.pubsub_numsub(channel)[0][1], 0)
+
+    def test_multiplexer_reconnect(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        channel = self.prefix + ':broadcast:reconnect'
+        subscriber = MultiplexedRedisSubscriber(connection)
+        subscriber.subscribe_channels([channel])
+        multiplexer = get_multiplexer(connection, channel)
+        # lose the connection of the multiplexer
+        multiplexer._pubsub.connection._sock.shutdown(socket.SHUT_RDWR)
+        for _ in range(50):
+            if connection.publish(channel, 'reconnected'):
+                break
+            time.sleep(0.1)
+        ready = select.select([subscriber.get_file_descriptor()], [], [], 5.0)[0]
+        self.assertTrue(ready)
+        self.assertEqual(subscriber.parse_response().message, b'reconnected')
+        subscriber.release()
+
+    def test_deliver_after_release(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        subscriber = MultiplexedRedisSubscriber(connection)
+        subscriber.subscribe_channels([self.prefix + ':broadcast:released'])
+        subscriber.deliver(PreparedFrame(b'pending'))
+        subscriber.release()
+        # the multiplexer may still fan out a message it collected before the release
+        subscriber.deliver(PreparedFrame(b'late'))
+        self.assertIsNone(subscriber.get_file_descriptor())
+        self.assertIsNone(subscriber.parse_response())
+
+    def test_publish_burst(self):
+        metrics.reset()
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        # a facility of its own, since these messages are not persisted
+        channel = self.prefix + ':broadcast:burst'
+        websocket_url = self.websocket_base_url.replace(self.facility, u'burst') + u'?subscribe-broadcast'
+        ws = create_connection(websocket_url)
+        # the subscription is made after the handshake
+        while not connection.pubsub_numsub(channel)[0][1]:
+            time.sleep(0.01)
+        pipeline = connection.pipeline(transaction=False)
+        for count in range(200):
+            pipeline.publish(channel, 'message {0}'.format(count))
+        pipeline.execute()
+        for count in range(200):
+            self.assertEqual(ws.recv(), 'message {0}'.format(count))
+        ws.close()
+        batch_sizes = dict(metrics.get_histograms()['subscriber.batch_size'])
+        # messages received in one go from Redis are sent as one batch
+        self.assertGreater(max(batch_sizes), 1)
+        self.assertLessEqual(max(batch_sizes), private_settings.WS4REDIS_BATCH_SIZE)
+
+    def test_full_batch(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        channel = self.prefix + ':broadcast:fullbatch'
+        websocket_url = self.websocket_base_url.replace(self.facility, u'fullbatch')
+        ws = create_connection(websocket_url + u'?subscribe-broadcast&publish-broadcast&echo')
+        ws.settimeout(3)
+        while not connection.pubsub_numsub(channel)[0][1]:
+            time.sleep(0.01)
+        # the confirmation of the subscription shall not be part of the batch
+        connection.publish(channel, 'warmup')
+        self.assertEqual(ws.recv(), 'warmup')
+        pipeline = connection.pipeline(transaction=False)
+        for count in range(private_settings.WS4REDIS_BATCH_SIZE):
+            pipeline.publish(channel, 'message {0}'.format(count))
+        pipeline.execute()
+        for count in range(private_settings.WS4REDIS_BATCH_SIZE):
+            self.assertEqual(ws.recv(), 'message {0}'.format(count))
+        # a full batch must not leave the loop waiting for further messages from Redis
+        ws.send('ping')
+        self.assertEqual(ws.recv(), 'ping')
+        ws.close()
+        connection.delete(channel)
+
+    def test_parse_responses_nonblocking(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        channel = self.prefix + ':broadcast:nonblocking'
+        subscriber = RedisSubscriber(connection)
+        subscriber.subscribe_channels([channel])
+        self.assertEqual(subscriber.parse_responses(10)[0][0], b'subscribe')
+        connection.publish(channel, 'first')
+        # wait until the message reached the socket of the subscriber, without consuming it
+        self.assertTrue(subscriber._subscription.connection.can_read(timeout=1.0))
+        self.assertEqual(subscriber.parse_responses(10, block=False), [[b'message', channel.encode(), b'first']])
+        self.assertEqual(subscriber.parse_responses(10, block=False), [])
+        subscriber.release()
+
+    def test_publish_many(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        pubsub = connection.pubsub()
+        pubsub.subscribe(self.prefix + ':user:john:bulk', self.prefix + ':broadcast:bulk')
+        self.assertEqual(pubsub.get_message(timeout=1.0)['type'], 'subscribe')
+        self.assertEqual(pubsub.get_message(timeout=1.0)['type'], 'subscribe')
+        users = {'facility': 'bulk', 'users': ['john', 'mary']}
+        broadcast = {'facility': 'bulk', 'broadcast': True}
+        messages = [(u'first', users), (u'second', broadcast), (u'first', users), (u'third', users)]
+        receivers = RedisPublisher().publish_many(messages, expire=10, chunk_size=3)
+        self.assertEqual(receivers, {
+            self.prefix + ':user:john:bulk': 1,
+            self.prefix + ':user:mary:bulk': 0,
+            self.prefix + ':broadcast:bulk': 1,
+        })
+        received = []
+        message = pubsub.get_message(timeout=1.0)
+        while message:
+            received.append((message['channel'], message['data']))
+            message = pubsub.get_message(timeout=0.2)
+        pubsub.close()
+        # identical messages on the same channel are published only once
+        self.assertEqual(sorted(received), [
+            (b'ws4redis:broadcast:bulk', b'second'),
+            (b'ws4redis:user:john:bulk', b'first'),
+            (b'ws4redis:user:john:bulk', b'third'),
+        ])
+        self.assertEqual(connection.get(self.prefix + ':user:mary:bulk'), b'third')
+
+    def test_publish_many_mutated_audience(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        audience = {'facility': 'mutated'}
+
+        def messages():
+            for username in ('john', 'mary'):
+                audience['users'] = [username]
+                yield u'hello ' + username, audience
+
+        receivers = RedisPublisher().publish_many(messages(), expire=10)
+        self.assertEqual(sorted(receivers), [self.prefix + ':user:john:mutated', self.prefix + ':user:mary:mutated'])
+        self.assertEqual(connection.get(self.prefix + ':user:john:mutated'), b'hello john')
+        self.assertEqual(connection.get(self.prefix + ':user:mary:mutated'), b'hello mary')
+
+    def test_replay_round_trips(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        channels = [self.prefix + ':user:john:replay', self.prefix + ':group:chatusers:replay',
+                    self.prefix + ':broadcast:replay']
+        for channel in channels:
+            connection.setex(channel, 10, channel)
+
+        class FakeWebsocket(object):
+            batches = []
+
+            def send_prepared_batch(self, frames):
+                self.batches.append([frame.message for frame in frames])
+
+        def get_calls():
+            stats = connection.info('commandstats')
+            return dict((command, stats.get('cmdstat_' + command, {}).get('calls', 0))
+                        for command in ('subscribe', 'get', 'mget'))
+
+        calls = get_calls()
+        subscriber = RedisSubscriber(connection)
+        subscriber.subscribe_channels(channels)
+        subscriber.send_persisted_messages(FakeWebsocket())
+        subscriber.release()
+        # one SUBSCRIBE, one MGET and the messages sent as one batch
+        calls = dict((command, count - calls[command]) for command, count in get_calls().items())
+        self.assertEqual(calls, {'subscribe': 1, 'get': 0, 'mget': 1})
+        self.assertEqual(FakeWebsocket.batches, [[channel.encode() for channel in channels]])
+
+    def test_publish_script(self):
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        pubsub = connection.pubsub()
+        pubsub.subscribe(self.prefix + ':group:editors:scripted')
+        self.assertEqual(pubsub.get_message(timeout=1.0)['type'], 'subscribe')
+        publisher = RedisPublisher(facility='scripted', groups=['editors', 'staff'], users=['john'])
+        # the script is loaded again, after Redis forgot it
+        connection.script_flush()
+        receivers = publisher.publish_message(RedisMessage(u'scripted'), 10)
+        self.assertEqual(receivers, {
+            self.prefix + ':group:editors:scripted': 1,
+            self.prefix + ':group:staff:scripted': 0,
+            self.prefix + ':user:john:scripted': 0,
+        })
+        self.assertEqual(pubsub.get_message(timeout=1.0)['data'], b'scripted')
+        pubsub.close()
+        for channel in receivers:
+            self.assertEqual(connection.get(channel), b'scripted')
+            self.assertGreater(connection.ttl(channel), 0)
+        self.assertEqual(publisher.pipeline_publish_message(RedisMessage(u'again'), 0), dict.fromkeys(receivers, 0))
+        self.assertEqual(connection.get(self.prefix + ':user:john:scripted'), b'scripted')
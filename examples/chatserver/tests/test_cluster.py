@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import unittest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import LiveServerTestCase
+from redis import StrictRedis
+from websocket import create_connection
+from ws4redis import settings as private_settings
+from ws4redis import cluster, django_runserver
+from ws4redis.cluster import ShardedRedis
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+
+# commands, whose keys are sent to the node owning their hash slot, and how to extract these keys
+KEY_POSITIONS = {
+    'GET': lambda args: args[:1],
+    'SETEX': lambda args: args[:1],
+    'PUBLISH': lambda args: args[:1],
+    'SPUBLISH': lambda args: args[:1],
+    'XRANGE': lambda args: args[:1],
+    'XREVRANGE': lambda args: args[:1],
+    'MGET': lambda args: args,
+    'DEL': lambda args: args,
+    'SUBSCRIBE': lambda args: args,
+    'SSUBSCRIBE': lambda args: args,
+    'EVALSHA': lambda args: args[2:2 + int(args[1])],
+}
+
+
+class RecordingRedis(StrictRedis):
+    """
+    Records the commands sent to this node, including those sent through its pipelines and its
+    PubSub connections.
+    """
+    def __init__(self, *args, **kwargs):
+        super(RecordingRedis, self).__init__(*args, **kwargs)
+        self.commands = []
+
+    def record(self, execute_command):
+        def recording(*args, **options):
+            self.commands.append((str(args[0]).upper(), args[1:]))
+            return execute_command(*args, **options)
+        return recording
+
+    def execute_command(self, *args, **options):
+        self.commands.append((str(args[0]).upper(), args[1:]))
+        return super(RecordingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        pipeline = super(RecordingRedis, self).pipeline(*args, **kwargs)
+        pipeline.execute_command = self.record(pipeline.execute_command)
+        return pipeline
+
+    def pubsub(self, **kwargs):
+        pubsub = super(RecordingRedis, self).pubsub(**kwargs)
+        pubsub.execute_command = self.record(pubsub.execute_command)
+        return pubsub
+
+
+@unittest.skipIf(cluster.key_slot is None, "redis-py does not support Redis Cluster")
+class ShardedRedisTests(LiveServerTestCase):
+    """
+    Three databases of the local Redis server stand in for the nodes of a cluster. Since pub/sub
+    ignores the database number, the commands sent to each node are recorded, to check that they
+    are routed to the node owning the hash slot of their keys.
+    """
+    @classmethod
+    def setUpClass(cls):
+        os.environ.update(DJANGO_LIVE_TEST_SERVER_ADDRESS="localhost:8000-8010,8080,9200-9300")
+        super(ShardedRedisTests, cls).setUpClass()
+
+    def setUp(self):
+        options = dict(private_settings.WS4REDIS_CONNECTION)
+        self.nodes = [StrictRedis(**dict(options, db=db)) for db in (1, 2, 3)]
+        for node in self.nodes:
+            node.flushdb()
+        options.pop('db', None)
+        self.connection = ShardedRedis(nodes=[{'db': db} for db in (1, 2, 3)], **options)
+        self.connection._nodes = [RecordingRedis(**dict(options, db=db)) for db in (1, 2, 3)]
+        self.facilities = [u'cluster{0}'.format(k) for k in range(12)]
+        self.channels = ['ws4redis:broadcast:{0}'.format(facility) for facility in self.facilities]
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.flushdb()
+
+    def get_owner(self, key):
+        return [node.exists(key) for node in self.nodes].index(1)
+
+    def get_routed_keys(self, *commands):
+        """
+        Returns the keys of the recorded ``commands`` as a dictionary, mapping each key onto the
+        index of the node it was sent to. Asserts that each key was sent to the owner of its slot.
+        """
+        routed = {}
+        for index, node in enumerate(self.connection._nodes):
+            for command, args in node.commands:
+                if command not in commands:
+                    continue
+                for key in KEY_POSITIONS[command](args):
+                    if isinstance(key, bytes):
+                        key = key.decode('utf-8')
+                    self.assertEqual(index, ShardedRedis.get_slot(key) * 3 // 16384,
+                                     '{0} {1} was sent to the wrong node'.format(command, key))
+                    routed[key] = index
+        return routed
+
+    def test_routing(self):
+        owners = set()
+        for facility, channel in zip(self.facilities, self.channels):
+            publisher = RedisPublisher(facility=facility, broadcast=True)
+            publisher._connection = self.connection
+            publisher.publish_message(RedisMessage(facility), 10)
+            # the message is persisted on the node owning the slot of its channel
+            owner = self.get_owner(channel)
+            slot = ShardedRedis.get_slot(channel)
+            self.assertEqual(owner, slot * 3 // 16384)
+            self.assertEqual(self.connection.get(channel), facility.encode())
+            owners.add(owner)
+        self.assertEqual(owners, set([0, 1, 2]))
+        # the message is published on the node owning the slot of its channel
+        routed = self.get_routed_keys('PUBLISH', 'SPUBLISH', 'EVALSHA')
+        self.assertEqual(set(routed), set(self.channels))
+
+    def test_pipeline(self):
+        publisher = RedisPublisher(facility=u'cluster', broadcast=True)
+        publisher._connection = self.connection
+        publisher._publishers = set(self.channels)
+        publisher.pipeline_publish_message(RedisMessage(u'pipelined'), 10)
+        routed = self.get_routed_keys('PUBLISH', 'SPUBLISH', 'SETEX', 'EVALSHA')
+        self.assertEqual(set(routed), set(self.channels))
+        for channel in self.channels:
+            self.assertEqual(self.connection.get(channel), b'pipelined')
+
+    def test_publish_many(self):
+        publisher = RedisPublisher()
+        publisher._connection = self.connection
+        messages = [(facility, {'facility': facility, 'broadcast': True}) for facility in self.facilities]
+        receivers = publisher.publish_many(messages, expire=10, chunk_size=5)
+        # results are assigned to their channels, although commands are sent node by node
+        self.assertEqual(receivers, dict((channel, 0) for channel in self.channels))
+        routed = self.get_routed_keys('PUBLISH', 'SPUBLISH', 'EVALSHA')
+        self.assertEqual(set(routed), set(self.channels))
+        for facility, channel in zip(self.facilities, self.channels):
+            self.assertEqual(self.connection.get(channel), facility.encode())
+
+    def test_stream(self):
+        private_settings.WS4REDIS_STREAM = {'maxlen': 100, 'expire': 60}
+        try:
+            publisher = RedisPublisher(facility=u'cluster', broadcast=True)
+            publisher._connection = self.connection
+            publisher._publishers = set(self.channels)
+            publisher.publish_message(RedisMessage(u'first'), 10)
+            publisher.pipeline_publish_message(RedisMessage(u'second'), 10)
+        finally:
+            private_settings.WS4REDIS_STREAM = None
+        routed = self.get_routed_keys('EVALSHA')
+        self.assertTrue(set(self.channels).issubset(routed))
+        for channel in self.channels:
+            # the stream is located in the slot of its channel
+            stream = RedisPublisher.get_stream_key(channel)
+            self.assertEqual(self.get_owner(stream), self.get_owner(channel))
+            self.assertEqual(self.get_owner(RedisPublisher.get_sequence_key(channel)), self.get_owner(channel))
+            self.assertEqual(len(self.connection.xrange(stream)), 2)
+            self.assertEqual(self.connection.get(channel), b'2|second')
+
+    def test_requires_multiplexer(self):
+        subscriber = private_settings.WS4REDIS_SUBSCRIBER
+        private_settings.WS4REDIS_SUBSCRIBER = 'ws4redis.subscriber.RedisSubscriber'
+        try:
+            with self.assertRaises(ImproperlyConfigured):
+                django_runserver.WebsocketRunServer(redis_connection=self.connection)
+        finally:
+            private_settings.WS4REDIS_SUBSCRIBER = subscriber
+
+    def test_subscribe(self):
+        subscriber = private_settings.WS4REDIS_SUBSCRIBER
+        private_settings.WS4REDIS_SUBSCRIBER = 'ws4redis.subscriber.MultiplexedRedisSubscriber'
+        try:
+            websocket_app = django_runserver.WebsocketRunServer(redis_connection=self.connection)
+        finally:
+            private_settings.WS4REDIS_SUBSCRIBER = subscriber
+        self.server_thread.httpd.set_app(websocket_app)
+        base_url = self.live_server_url.replace('http:', 'ws:', 1) + u'/ws/'
+        websockets = []
+        for facility, channel in zip(self.facilities, self.channels):
+            publisher = RedisPublisher(facility=facility, broadcast=True)
+            publisher._connection = self.connection
+            publisher.publish_message(RedisMessage(u'persisted'), 10)
+            ws = create_connection(base_url + facility + u'?subscribe-broadcast')
+            self.assertEqual(ws.recv(), 'persisted')
+            websockets.append((ws, publisher, channel))
+        for ws, publisher, channel in websockets:
+            # the channel is subscribed after the handshake
+            for _ in range(50):
+                if self.nodes[0].pubsub_numsub(channel)[0][1]:
+                    break
+                time.sleep(0.05)
+            publisher.publish_message(RedisMessage(channel))
+            self.assertEqual(ws.recv(), channel)
+            ws.close()
+        # each channel is subscribed on the node owning its slot
+        routed = self.get_routed_keys('SUBSCRIBE', 'SSUBSCRIBE')
+        self.assertEqual(set(routed), set(self.channels))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import json
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test import TransactionTestCase
+from redis import StrictRedis
+from ws4redis import settings as private_settings
+from ws4redis.coalesce import publish_on_commit, PublishBuffer
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+
+def notify_saved(sender, instance, **kwargs):
+    message = json.dumps({'group': instance.name})
+    RedisPublisher(facility='coalesce', broadcast=True).publish_message(RedisMessage(message))
+    RedisPublisher(facility='coalesce', groups=[instance.name]).publish_message(RedisMessage(message))
+
+
+class PublishOnCommitTests(TransactionTestCase):
+    def setUp(self):
+        self.connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        self.broadcast = 'ws4redis:broadcast:coalesce'
+        self.channels = [self.broadcast] + ['ws4redis:group:{0}:coalesce'.format(name) for name in ('a', 'b')]
+        self.connection.delete(*self.channels)
+        self.pubsub = self.connection.pubsub()
+        self.pubsub.subscribe(*self.channels)
+        for _ in self.channels:
+            self.assertEqual(self.pubsub.get_message(timeout=1.0)['type'], 'subscribe')
+        post_save.connect(notify_saved, sender=Group)
+
+    def tearDown(self):
+        post_save.disconnect(notify_saved, sender=Group)
+        self.pubsub.close()
+        self.connection.delete(*self.channels)
+
+    def receive(self):
+        received = []
+        message = self.pubsub.get_message(timeout=0.5)
+        while message:
+            received.append((message['channel'].decode(), message['data']))
+            message = self.pubsub.get_message(timeout=0.2)
+        return received
+
+    def save_groups(self, *names):
+        for name in names:
+            Group.objects.create(name=name)
+
+    def test_last_wins(self):
+        with transaction.atomic():
+            with publish_on_commit():
+                self.save_groups('a', 'b', 'a2')
+            # nothing is published before the transaction commits
+            self.assertEqual(self.receive(), [])
+        self.assertEqual(sorted(self.receive()), [
+            (self.broadcast, b'{"group": "a2"}'),
+            ('ws4redis:group:a:coalesce', b'{"group": "a"}'),
+            ('ws4redis:group:b:coalesce', b'{"group": "b"}'),
+        ])
+        self.assertEqual(self.connection.get(self.broadcast), b'{"group": "a2"}')
+
+    def test_json_array(self):
+        with transaction.atomic():
+            with publish_on_commit(policy='json-array'):
+                self.save_groups('a', 'b')
+        received = dict(self.receive())
+        self.assertEqual(json.loads(received[self.broadcast].decode()), [{'group': 'a'}, {'group': 'b'}])
+        self.assertEqual(json.loads(received['ws4redis:group:a:coalesce'].decode()), [{'group': 'a'}])
+
+    def test_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                with publish_on_commit():
+                    self.save_groups('a')
+                raise RuntimeError('abort')
+        self.assertEqual(self.receive(), [])
+        self.assertIsNone(self.connection.get(self.broadcast))
+
+    def test_savepoint_rollback(self):
+        with transaction.atomic():
+            with publish_on_commit():
+                self.save_groups('a')
+            try:
+                with transaction.atomic():
+                    with publish_on_commit():
+                        self.save_groups('b')
+                        raise RuntimeError('abort')
+            except RuntimeError:
+                pass
+        self.assertEqual(sorted(self.receive()), [
+            (self.broadcast, b'{"group": "a"}'),
+            ('ws4redis:group:a:coalesce', b'{"group": "a"}'),
+        ])
+
+    def test_savepoint_rollback_within_block(self):
+        with transaction.atomic():
+            with publish_on_commit():
+                self.save_groups('a')
+                try:
+                    with transaction.atomic():
+                        self.save_groups('b')
+                        raise RuntimeError('abort')
+                except RuntimeError:
+                    pass
+        # the message of the rolled back savepoint does not replace the one committed before
+        self.assertEqual(sorted(self.receive()), [
+            (self.broadcast, b'{"group": "a"}'),
+            ('ws4redis:group:a:coalesce', b'{"group": "a"}'),
+        ])
+
+    def test_publish_many(self):
+        messages = [(u'{"group": "a"}', {'facility': 'coalesce', 'broadcast': True, 'groups': ['a']}),
+                    (u'{"group": "b"}', {'facility': 'coalesce', 'groups': ['b']})]
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                with publish_on_commit():
+                    self.assertEqual(RedisPublisher().publish_many(messages), {})
+                raise RuntimeError('abort')
+        self.assertEqual(self.receive(), [])
+        with transaction.atomic():
+            with publish_on_commit():
+                RedisPublisher().publish_many(messages)
+            self.assertEqual(self.receive(), [])
+        self.assertEqual(sorted(self.receive()), [
+            (self.broadcast, b'{"group": "a"}'),
+            ('ws4redis:group:a:coalesce', b'{"group": "a"}'),
+            ('ws4redis:group:b:coalesce', b'{"group": "b"}'),
+        ])
+
+    def test_autocommit(self):
+        # outside of a transaction, messages are published when the block is left
+        with publish_on_commit():
+            self.save_groups('a')
+            self.save_groups('b')
+        self.assertEqual(sorted(self.receive()), [
+            (self.broadcast, b'{"group": "b"}'),
+            ('ws4redis:group:a:coalesce', b'{"group": "a"}'),
+            ('ws4redis:group:b:coalesce', b'{"group": "b"}'),
+        ])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            PublishBuffer('first-wins')
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import select
+import struct
+import types
+import unittest
+from django.test import LiveServerTestCase
+from websocket import create_connection, WebSocketBadStatusException, ABNF
+from ws4redis import settings as private_settings
+from ws4redis import django_runserver
+from ws4redis import drain as drain_module
+from ws4redis.drain import Drain
+from ws4redis.redis_store import RedisMessage
+from ws4redis.websocket import PreparedFrame
+from ws4redis.wsgi_server import WebsocketWSGIServer
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.drains = []
+
+    def drain(self, drain):
+        self.drains.append(drain)
+
+
+class DrainTests(unittest.TestCase):
+    def test_schedule(self):
+        drain = Drain(window=10.0)
+        schedule = drain.schedule(range(5))
+        deadlines = sorted(schedule.values())
+        self.assertEqual(sorted(schedule), list(range(5)))
+        for earlier, later in zip(deadlines, deadlines[1:]):
+            self.assertAlmostEqual(later - earlier, 2.0, places=3)
+
+    def test_close_reason(self):
+        drain = Drain(reconnect_delay=2.0)
+        for _ in range(100):
+            delay = int(drain.get_close_reason().split('=')[1])
+            self.assertTrue(0 <= delay <= 2000)
+
+    def test_start_once(self):
+        drain = Drain(window=30.0, code=1012)
+        server = FakeServer()
+        drain.register(server)
+        drain.deliver(PreparedFrame(RedisMessage(json.dumps({'window': 5.0, 'code': 1001}))))
+        drain.start()
+        self.assertEqual(server.drains, [drain])
+        self.assertEqual((drain.window, drain.code), (5.0, 1001))
+        # servers created while draining, are drained at once
+        other = FakeServer()
+        drain.register(other)
+        self.assertEqual(other.drains, [drain])
+
+    def test_pipe(self):
+        # without drain mode, servers do not create a pipe
+        self.assertIsNone(WebsocketWSGIServer()._drain_fds)
+        configured = drain_module.drain
+        drain_module.drain = Drain()
+        try:
+            server = WebsocketWSGIServer()
+        finally:
+            drain_module.drain = configured
+        fds = server._drain_fds
+        server.close()
+        self.assertIsNone(server._drain_fds)
+        for fd in fds:
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+
+
+class DrainServerTests(LiveServerTestCase):
+    reactor_threads = 0
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ.update(DJANGO_LIVE_TEST_SERVER_ADDRESS="localhost:8000-8010,8080,9200-9300")
+        super(DrainServerTests, cls).setUpClass()
+        httpd = cls.server_thread.httpd
+        # serve one request per connection and keep the sockets handed over to a reactor open
+        httpd.RequestHandlerClass = django_runserver.WSGIRequestHandler
+        httpd.shutdown_request = types.MethodType(django_runserver.shutdown_request, httpd)
+
+    def setUp(self):
+        reactor_threads = private_settings.WS4REDIS_REACTOR_THREADS
+        private_settings.WS4REDIS_REACTOR_THREADS = self.reactor_threads
+        # servers listen for draining, only if it is configured
+        self.configured_drain = drain_module.drain
+        self.drain = drain_module.drain = Drain(window=1.0, code=1012, reconnect_delay=3.0)
+        try:
+            self.websocket_app = django_runserver.WebsocketRunServer()
+        finally:
+            private_settings.WS4REDIS_REACTOR_THREADS = reactor_threads
+            drain_module.drain = self.configured_drain
+        self.server_thread.httpd.set_app(self.websocket_app)
+        self.websocket_url = self.live_server_url.replace('http:', 'ws:', 1) + u'/ws/drain?subscribe-broadcast'
+
+    def tearDown(self):
+        self.websocket_app.close()
+
+    def test_drain(self):
+        drain = self.drain
+        connections = [create_connection(self.websocket_url) for _ in range(5)]
+        started_at = time.time()
+        drain.start()
+        closed_at = []
+        while connections:
+            ready = select.select([ws.sock for ws in connections], [], [], 5.0)[0]
+            self.assertTrue(ready)
+            for ws in [ws for ws in connections if ws.sock in ready]:
+                # read the raw frame, since the server may have closed the socket already
+                frame = ws.recv_frame()
+                opcode, data = frame.opcode, frame.data
+                if opcode == ABNF.OPCODE_PING:
+                    # sent, if WS4REDIS_KEEPALIVE is configured
+                    ws.pong(data)
+                    continue
+                closed_at.append(time.time() - started_at)
+                self.assertEqual(opcode, ABNF.OPCODE_CLOSE)
+                code, = struct.unpack('!H', data[:2])
+                self.assertEqual(code, 1012)
+                delay = int(data[2:].decode().split('=')[1])
+                self.assertTrue(0 <= delay <= 3000)
+                ws.close()
+                connections.remove(ws)
+        # closed one by one, spread over the window
+        self.assertLess(min(closed_at), 0.5)
+        self.assertGreater(max(closed_at), 0.5)
+        self.assertLess(max(closed_at), 2.0)
+        with self.assertRaises(WebSocketBadStatusException) as context:
+            create_connection(self.websocket_url)
+        self.assertEqual(context.exception.status_code, 503)
+
+
+@unittest.skipIf(sys.version_info < (3,), "Reactors require Python 3")
+class ReactorDrainTests(DrainServerTests):
+    reactor_threads = 2
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import unittest
+from django.contrib.auth.models import User
+from django.test import LiveServerTestCase
+from django.test.client import RequestFactory
+from redis import StrictRedis
+from websocket import create_connection
+from ws4redis import identity
+from ws4redis import wsgi_server
+from ws4redis import settings as private_settings
+from ws4redis.django_runserver import application
+from ws4redis.identity import CachedUser, Identity, IdentityCache, get_invalidation_channel
+from ws4redis.models import invalidate_rotated_identity
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+from ws4redis.websocket import PreparedFrame
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class IdentityCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = IdentityCache(maxsize=3, ttl=60, clock=self.clock)
+
+    def test_least_recently_used(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, Identity(key, ()))
+        self.assertEqual(self.cache.get('a'), Identity('a', ()))
+        self.cache.set('d', Identity('d', ()))
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), Identity('a', ()))
+
+    def test_expiry(self):
+        self.cache.set('a', Identity('john', ('chatters',)))
+        self.clock.now += 59
+        self.assertEqual(self.cache.get('a').groups, ('chatters',))
+        self.clock.now += 2
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate(self):
+        self.cache.set('a', Identity('john', ()))
+        self.cache.set('b', Identity(None, ()))
+        self.cache.invalidate('a', 'x')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.deliver(PreparedFrame(RedisMessage('b')))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cached_user(self):
+        loaded = []
+
+        def load_user():
+            loaded.append(True)
+            return User(username='john', email='john@example.com')
+
+        user = CachedUser(Identity('john', ('chatters',)), load_user)
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual(user.get_username(), 'john')
+        self.assertEqual(user.groups, ['chatters'])
+        self.assertFalse(loaded)
+        self.assertEqual(user.email, 'john@example.com')
+        self.assertEqual(len(loaded), 1)
+
+
+class IdentityHandshakeTests(LiveServerTestCase):
+    fixtures = ['data.json']
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ.update(DJANGO_LIVE_TEST_SERVER_ADDRESS="localhost:8000-8010,8080,9200-9300")
+        super(IdentityHandshakeTests, cls).setUpClass()
+        cls.server_thread.httpd.set_app(application)
+
+    def setUp(self):
+        self.facility = u'identity'
+        self.websocket_base_url = self.live_server_url.replace('http:', 'ws:', 1) + u'/ws/' + self.facility
+        self.cache = IdentityCache()
+        identity.identity_cache = wsgi_server.identity_cache = self.cache
+        self.get_user_calls = []
+
+        def get_user(request, get_user=wsgi_server.get_user):
+            self.get_user_calls.append(request)
+            return get_user(request)
+
+        wsgi_server.get_user = get_user
+
+    def tearDown(self):
+        wsgi_server.get_user = wsgi_server.get_user.__defaults__[0]
+        identity.identity_cache = wsgi_server.identity_cache = None
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def connect(self):
+        header = ['Cookie: sessionid={0}'.format(self.client.cookies['sessionid'].coded_value)]
+        return create_connection(self.websocket_base_url + u'?subscribe-user&subscribe-group', header=header)
+
+    def test_returning_client(self):
+        logged_in = self.client.login(username='john', password='secret')
+        self.assertTrue(logged_in, 'John is not logged in')
+        request = RequestFactory().get('/chat/')
+        request.user = User.objects.get(username='mary')
+        publisher = RedisPublisher(request=request, facility=self.facility, groups=['chatusers'])
+        publisher.publish_message(RedisMessage(u'Hello chatusers'), 10)
+        ws = self.connect()
+        self.assertEqual(ws.recv(), u'Hello chatusers')
+        ws.close()
+        self.assertEqual(len(self.get_user_calls), 1)
+        session_key = self.client.cookies['sessionid'].value
+        self.assertEqual(self.cache.get(session_key).username, 'john')
+
+        # the second handshake resolves the group from the cache
+        ws = self.connect()
+        self.assertEqual(ws.recv(), u'Hello chatusers')
+        ws.close()
+        self.assertEqual(len(self.get_user_calls), 1)
+
+    def test_invalidate_on_logout(self):
+        self.client.login(username='john', password='secret')
+        self.connect().close()
+        self.assertEqual(len(self.cache), 1)
+        session_key = self.client.cookies['sessionid'].value
+        self.client.logout()
+        self.assertIsNone(self.cache.get(session_key))
+        self.assertTrue(self.wait_for(lambda: len(self.cache) == 0))
+
+    def test_invalidate_rotated_on_login(self):
+        self.cache.set('old-key', Identity(None, ()))
+        self.cache.set('new-key', Identity('john', ()))
+        request = RequestFactory().get('/chat/')
+        request.COOKIES['sessionid'] = 'old-key'
+        invalidate_rotated_identity(sender=User, request=request, user=None)
+        self.assertIsNone(self.cache.get('old-key'))
+        self.assertEqual(self.cache.get('new-key').username, 'john')
+
+    def test_invalidate_from_other_process(self):
+        self.client.login(username='john', password='secret')
+        self.connect().close()
+        session_key = self.client.cookies['sessionid'].value
+        self.assertEqual(self.cache.get(session_key).username, 'john')
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        connection.publish(get_invalidation_channel(), session_key)
+        self.assertTrue(self.wait_for(lambda: len(self.cache) == 0))
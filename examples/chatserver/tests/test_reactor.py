@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import types
+import threading
+import unittest
+from django.conf import settings
+from django.test import LiveServerTestCase
+from websocket import create_connection
+from ws4redis import settings as private_settings
+from ws4redis import django_runserver
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+
+@unittest.skipIf(sys.version_info < (3,), "Reactors require Python 3")
+class ReactorTests(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ.update(DJANGO_LIVE_TEST_SERVER_ADDRESS="localhost:8000-8010,8080,9200-9300")
+        super(ReactorTests, cls).setUpClass()
+        reactor_threads = private_settings.WS4REDIS_REACTOR_THREADS
+        private_settings.WS4REDIS_REACTOR_THREADS = 2
+        try:
+            cls.websocket_app = django_runserver.WebsocketRunServer()
+        finally:
+            private_settings.WS4REDIS_REACTOR_THREADS = reactor_threads
+        httpd = cls.server_thread.httpd
+        httpd.set_app(cls.websocket_app)
+        # serve one request per connection and keep the sockets handed over to a reactor open
+        httpd.RequestHandlerClass = django_runserver.WSGIRequestHandler
+        httpd.shutdown_request = types.MethodType(django_runserver.shutdown_request, httpd)
+
+    def setUp(self):
+        self.facility = u'reactor'
+        self.websocket_base_url = self.live_server_url.replace('http:', 'ws:', 1) + u'/ws/' + self.facility
+        self.publisher = RedisPublisher(facility=self.facility, broadcast=True)
+        # forget messages persisted by previous tests
+        self.channel = getattr(settings, 'WS4REDIS_PREFIX', 'ws4redis') + ':broadcast:' + self.facility
+        self.publisher._connection.delete(self.channel)
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_publish_subscribe(self):
+        ws = create_connection(self.websocket_base_url + u'?subscribe-broadcast&publish-broadcast&echo')
+        ws.send(u'Hello reactor')
+        self.assertEqual(ws.recv(), u'Hello reactor')
+        self.publisher.publish_message(RedisMessage(u'Hello client'))
+        self.assertEqual(ws.recv(), u'Hello client')
+        ws.close()
+
+    def test_threads_per_connection(self):
+        threads = threading.active_count()
+        connections = [create_connection(self.websocket_base_url + u'?subscribe-broadcast')
+                       for _ in range(50)]
+        # the request threads terminate after handing over their websockets
+        self.assertTrue(self.wait_for(lambda: threading.active_count() <= threads + 1))
+        self.publisher.publish_message(RedisMessage(u'Hello all'))
+        for ws in connections:
+            self.assertEqual(ws.recv(), u'Hello all')
+        websockets = len(self.websocket_app.websockets)
+        for ws in connections:
+            ws.close()
+        self.assertTrue(self.wait_for(lambda: len(self.websocket_app.websockets) <= websockets - 50))
+
+    def test_publish_burst(self):
+        ws = create_connection(self.websocket_base_url + u'?subscribe-broadcast')
+        # the subscription is made after the handshake
+        self.assertTrue(self.wait_for(lambda: self.publisher._connection.pubsub_numsub(self.channel)[0][1]))
+        pipeline = self.publisher._connection.pipeline(transaction=False)
+        for count in range(500):
+            pipeline.publish(self.channel, 'message {0}'.format(count))
+        pipeline.execute()
+        for count in range(500):
+            self.assertEqual(ws.recv(), 'message {0}'.format(count))
+        ws.close()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from django.test import LiveServerTestCase
+from redis import StrictRedis
+from websocket import create_connection
+from ws4redis import settings as private_settings
+from ws4redis.django_runserver import application
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+
+class ResumeTests(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ.update(DJANGO_LIVE_TEST_SERVER_ADDRESS="localhost:8000-8010,8080,9200-9300")
+        super(ResumeTests, cls).setUpClass()
+        cls.server_thread.httpd.set_app(application)
+
+    def setUp(self):
+        self.stream_settings = private_settings.WS4REDIS_STREAM
+        private_settings.WS4REDIS_STREAM = {'maxlen': 100, 'expire': 60}
+        self.facility = u'resume'
+        self.channel = 'ws4redis:broadcast:resume'
+        self.stream = 'ws4redis:stream:{ws4redis:broadcast:resume}'
+        self.sequence = 'ws4redis:sequence:{ws4redis:broadcast:resume}'
+        self.connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        self.connection.delete(self.channel, self.stream, self.sequence)
+        self.publisher = RedisPublisher(facility=self.facility, broadcast=True)
+        self.websocket_url = self.live_server_url.replace('http:', 'ws:', 1) + u'/ws/resume?subscribe-broadcast'
+
+    def tearDown(self):
+        private_settings.WS4REDIS_STREAM = self.stream_settings
+        self.connection.delete(self.channel, self.stream, self.sequence)
+
+    def publish(self, *messages):
+        for message in messages:
+            self.publisher.publish_message(RedisMessage(message))
+
+    def connect(self, resume=None):
+        url = self.websocket_url
+        if resume is not None:
+            url += '&resume=' + resume
+        ws = create_connection(url)
+        # the channel is subscribed after the handshake
+        for _ in range(50):
+            if self.connection.pubsub_numsub(self.channel)[0][1]:
+                break
+            time.sleep(0.05)
+        return ws
+
+    def receive(self, ws):
+        while True:
+            message = ws.recv()
+            if message != private_settings.WS4REDIS_HEARTBEAT:
+                return message
+
+    def test_publish_sequenced(self):
+        self.publish('first', 'second', 'third')
+        entries = self.connection.xrange(self.stream)
+        self.assertEqual([entry_id for entry_id, _ in entries], [b'0-1', b'0-2', b'0-3'])
+        self.assertEqual(entries[2][1], {b'message': b'third'})
+        self.assertEqual(self.connection.get(self.channel), b'3|third')
+        self.assertEqual(self.publisher.fetch_message(None, self.facility, 'broadcast'), b'third')
+
+    def test_plain_client(self):
+        self.publish('persisted')
+        ws = self.connect()
+        self.assertEqual(self.receive(ws), 'persisted')
+        self.publish('live')
+        self.assertEqual(self.receive(ws), 'live')
+        ws.close()
+
+    def test_resume(self):
+        self.publish('first', 'second')
+        ws = self.connect(resume='')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:2|second')
+        self.publish('third')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:3|third')
+        ws.close()
+        self.publish('fourth', 'fifth')
+        ws = self.connect(resume='broadcast:resume:3')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:4|fourth')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:5|fifth')
+        ws.close()
+        # nothing is replayed to a client, which is up to date
+        ws = self.connect(resume='broadcast:resume:5')
+        self.publish('sixth')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:6|sixth')
+        ws.close()
+
+    def test_resume_trimmed(self):
+        self.publish('first', 'second', 'third', 'fourth')
+        self.connection.xtrim(self.stream, 1, approximate=False)
+        ws = self.connect(resume='broadcast:resume:1')
+        # the gap is lost, hence the client receives the persisted message
+        self.assertEqual(self.receive(ws), 'broadcast:resume:4|fourth')
+        self.publish('fifth')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:5|fifth')
+        ws.close()
+
+    def test_resume_expired(self):
+        self.publish('first', 'second')
+        # both, the stream and the persisted message expired
+        self.connection.delete(self.channel, self.stream)
+        ws = self.connect(resume='broadcast:resume:2')
+        ws.settimeout(3)
+        self.publish('third')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:3|third')
+        ws.close()
+
+    def test_sequence_continues_stream(self):
+        # a stream published before its counter existed, keeps its numbering
+        self.publish('first', 'second')
+        self.connection.delete(self.sequence)
+        self.publish('third')
+        self.assertEqual(self.connection.get(self.channel), b'3|third')
+        self.assertEqual(self.connection.get(self.sequence), b'3')
+
+    def test_resume_unknown_channel(self):
+        self.publish('first')
+        ws = self.connect(resume='broadcast:other:7')
+        self.assertEqual(self.receive(ws), 'broadcast:resume:1|first')
+        ws.close()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from ws4redis.timerwheel import TimerWheel
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(resolution=0.1, slots=16, levels=3, clock=self.clock)
+        self.expired = []
+
+    def schedule(self, delay):
+        deadline = self.clock.now + delay
+        return self.wheel.schedule(delay, self.expired.append, deadline)
+
+    def test_expire_in_order(self):
+        for delay in (0.05, 3.0, 1.0, 30.0, 600.0):
+            self.schedule(delay)
+        self.assertAlmostEqual(self.wheel.timeout(), 0.1, places=3)
+        deadlines = []
+        while self.wheel.timeout() is not None:
+            self.clock.now += self.wheel.timeout()
+            self.wheel.advance()
+            for deadline in self.expired:
+                # timers never expire early, and at most one tick late
+                self.assertGreaterEqual(self.clock.now, deadline)
+                self.assertLess(self.clock.now, deadline + 0.101)
+            deadlines.extend(self.expired)
+            del self.expired[:]
+        self.assertEqual(deadlines, sorted(deadlines))
+        self.assertEqual(len(deadlines), 5)
+
+    def test_cancel(self):
+        timer = self.schedule(2.0)
+        self.schedule(5.0)
+        self.assertTrue(timer.active)
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.now += 10.0
+        self.assertEqual(self.wheel.advance(), 1)
+        self.assertEqual(len(self.expired), 1)
+        self.assertIsNone(self.wheel.timeout())
+
+    def test_random_deadlines(self):
+        rand = random.Random(4711)
+        timers = []
+        for _ in range(2000):
+            timers.append(self.schedule(rand.uniform(0, 3600)))
+            if rand.random() < 0.2:
+                rand.choice(timers).cancel()
+            if rand.random() < 0.3:
+                self.clock.now += rand.uniform(0, 10)
+                self.wheel.advance()
+                for deadline in self.expired:
+                    self.assertGreaterEqual(self.clock.now, deadline)
+                del self.expired[:]
+        self.clock.now += 3600
+        self.wheel.advance()
+        self.assertFalse(any(timer.active for timer in timers))
+        self.assertEqual(len(self.wheel), 0)
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import socket
+import threading
+import time
+import unittest
+import zlib
+from ws4redis import metrics
+from ws4redis.compression import PerMessageDeflate
+from ws4redis.exceptions import SlowConsumerError
+from ws4redis.outbound import OutboundQueue
+from ws4redis.utf8validator import Utf8Validator
+from ws4redis.websocket import WebSocket, Header, PreparedFrame
+
+
+def masked_frame(payload, opcode=WebSocket.OPCODE_TEXT, fin=True, flags=0):
+    mask = os.urandom(4)
+    header = Header(length=len(payload))
+    header.mask = mask
+    return Header.encode_header(fin, opcode, mask, len(payload), flags) + header.mask_payload(payload)
+
+
+def read_frame(sock):
+    data = sock.recv(65536)
+    length = bytearray(data)[1] & 0x7f
+    offset = 2
+    if length == 126:
+        length, offset = struct.unpack('!H', data[2:4])[0], 4
+    return bytearray(data)[0], data[offset:offset + length]
+
+
+class WebsocketFrameTests(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.websocket = WebSocket(self.server.makefile('rb'))
+
+    def tearDown(self):
+        self.websocket.stream = None
+        self.server.close()
+        self.client.close()
+
+    def test_pipelined_frames(self):
+        self.client.sendall(b''.join(masked_frame(m) for m in (b'first', b'second', b'third')))
+        self.assertEqual(self.websocket.receive(), u'first')
+        self.assertTrue(self.websocket.buffered)
+        self.assertEqual(self.websocket.receive(), u'second')
+        self.assertEqual(self.websocket.receive(), u'third')
+        self.assertFalse(self.websocket.buffered)
+
+    def test_partial_reads(self):
+        payload = b'x' * 70000
+        frame = masked_frame(payload, WebSocket.OPCODE_BINARY)
+
+        def send_slowly():
+            for offset in range(0, len(frame), 7000):
+                self.client.sendall(frame[offset:offset + 7000])
+                time.sleep(0.001)
+
+        writer = threading.Thread(target=send_slowly)
+        writer.start()
+        self.assertEqual(self.websocket.receive(), bytearray(payload))
+        writer.join()
+
+    def test_mask_payload(self):
+        for size in (0, 1, 3, 4, 5, 125, 4099):
+            header = Header(length=size)
+            header.mask = os.urandom(4)
+            payload = os.urandom(size)
+            expected = bytearray(payload)
+            for i in range(size):
+                expected[i] ^= bytearray(header.mask)[i % 4]
+            self.assertEqual(header.mask_payload(payload), bytes(expected))
+            self.assertEqual(header.unmask_payload(header.mask_payload(payload)), payload)
+
+    def test_fragmented_messages(self):
+        text = u'Grüße aus Zürich – 東京 '.encode('utf-8') * 100
+        # split inside multi-byte code points on purpose
+        fragments = [text[i:i + 7] for i in range(0, len(text), 7)]
+        frames = [masked_frame(fragments[0], WebSocket.OPCODE_TEXT, fin=False)]
+        frames.extend(masked_frame(f, WebSocket.OPCODE_CONTINUATION, fin=False) for f in fragments[1:-1])
+        frames.append(masked_frame(fragments[-1], WebSocket.OPCODE_CONTINUATION))
+        frames.append(masked_frame(b'\x00\x01', WebSocket.OPCODE_BINARY, fin=False))
+        frames.append(masked_frame(b'\x02', WebSocket.OPCODE_CONTINUATION))
+        frames.append(masked_frame(b'', WebSocket.OPCODE_TEXT))
+        self.client.sendall(b''.join(frames))
+        self.assertEqual(self.websocket.receive(), text.decode('utf-8'))
+        self.assertEqual(self.websocket.receive(), b'\x00\x01\x02')
+        self.assertEqual(self.websocket.receive(), u'')
+
+    def test_invalid_utf8(self):
+        self.client.sendall(masked_frame(b'valid', WebSocket.OPCODE_TEXT, fin=False) +
+                            masked_frame(b'\xed\xa0\x80', WebSocket.OPCODE_CONTINUATION))
+        self.assertIsNone(self.websocket.receive())
+        self.assertTrue(self.websocket.closed)
+
+    def test_oversized_frame(self):
+        # the announced length is rejected, before a payload buffer of that size is allocated
+        self.client.sendall(Header.encode_header(True, WebSocket.OPCODE_BINARY, os.urandom(4), 2 ** 40, 0))
+        self.assertIsNone(self.websocket.receive())
+        self.assertTrue(self.websocket.closed)
+        first_byte, payload = read_frame(self.client)
+        self.assertEqual(first_byte, 0x80 | WebSocket.OPCODE_CLOSE)
+        self.assertEqual(struct.unpack('!H', payload[:2])[0], 1009)
+
+    def test_send_prepared(self):
+        frame = PreparedFrame(u'Grüße')
+        self.websocket.send_prepared(frame)
+        self.assertEqual(read_frame(self.client), (0x80 | WebSocket.OPCODE_TEXT, u'Grüße'.encode('utf-8')))
+        frame = PreparedFrame(b'\x00' * 200, binary=True)
+        self.websocket.compression = PerMessageDeflate(server_no_context_takeover=True)
+        self.websocket.send_prepared(frame)
+        first_byte, payload = read_frame(self.client)
+        self.assertEqual(first_byte, 0x80 | Header.RSV0_MASK | WebSocket.OPCODE_BINARY)
+        self.assertIs(frame.get_data(self.websocket.compression), frame.get_data(self.websocket.compression))
+
+    def test_send_prepared_batch(self):
+        frames = [PreparedFrame(u'message {0}'.format(i)) for i in range(3)]
+        frames.append(PreparedFrame(b'\x01' * 300, binary=True))
+        self.websocket.send_prepared_batch(frames)
+        received = b''
+        expected = b''.join(frame.data for frame in frames)
+        while len(received) < len(expected):
+            received += self.client.recv(65536)
+        self.assertEqual(received, expected)
+
+    def test_writev_short_writes(self):
+        self.client.setblocking(False)
+        buffers = [b'', b'a' * 300000, b'b', b'c' * 70000]
+        received = []
+
+        def reader():
+            while sum(len(r) for r in received) < 370001:
+                try:
+                    received.append(self.client.recv(65536))
+                except socket.error:
+                    time.sleep(0.001)
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        self.websocket.stream.writev(buffers)
+        thread.join()
+        self.assertEqual(b''.join(received), b''.join(buffers))
+
+    def test_keepalive(self):
+        self.assertGreater(self.websocket.keepalive(0.05), 0)
+        time.sleep(0.06)
+        self.websocket.keepalive(0.05)
+        opcode, payload = read_frame(self.client)
+        self.assertEqual(opcode, 0x80 | WebSocket.OPCODE_PING)
+        self.client.sendall(masked_frame(payload, WebSocket.OPCODE_PONG) + masked_frame(b'hello'))
+        self.assertEqual(self.websocket.receive(), u'hello')
+        self.assertIsNotNone(self.websocket.rtt)
+        # the client remains silent, hence it is pinged again and closed after two missed pongs
+        for _ in range(3):
+            time.sleep(0.06)
+            self.websocket.keepalive(0.05, max_missed=2)
+        self.assertTrue(self.websocket.closed)
+        self.assertEqual(read_frame(self.client)[0], 0x80 | WebSocket.OPCODE_PING)
+
+    def test_lone_pong(self):
+        self.client.sendall(masked_frame(b'', WebSocket.OPCODE_PONG))
+        self.assertIsNone(self.websocket.receive())
+        self.assertFalse(self.websocket.closed)
+
+    def test_nonblocking_fill(self):
+        stream = self.websocket.stream
+        self.assertIsNone(stream.fill())
+        self.assertFalse(self.websocket.message_buffered)
+        frame = masked_frame(b'x' * 10000, WebSocket.OPCODE_TEXT, fin=False)
+        self.client.sendall(frame[:1000])
+        self.assertEqual(stream.fill(), 1000)
+        self.assertIsNone(stream.peek_frame())
+        self.client.sendall(frame[1000:] + masked_frame(b'', WebSocket.OPCODE_PING))
+        # the buffer grows until it holds the whole frame
+        while stream.fill():
+            pass
+        self.assertEqual(stream.peek_frame(), (False, WebSocket.OPCODE_TEXT, len(frame)))
+        self.assertFalse(self.websocket.message_buffered)
+        self.client.sendall(masked_frame(b'y', WebSocket.OPCODE_CONTINUATION))
+        stream.fill()
+        self.assertTrue(self.websocket.message_buffered)
+        self.assertEqual(self.websocket.receive(), u'x' * 10000 + u'y')
+        self.assertEqual(read_frame(self.client)[0], 0x80 | WebSocket.OPCODE_PONG)
+        self.assertFalse(self.websocket.message_buffered)
+        self.client.close()
+        self.assertEqual(stream.fill(), 0)
+
+
+class PerMessageDeflateTests(unittest.TestCase):
+    def test_negotiate(self):
+        extension, response = PerMessageDeflate.negotiate('x-webkit-deflate-frame, permessage-deflate; client_max_window_bits', {})
+        self.assertEqual(response, 'permessage-deflate; server_max_window_bits=12; client_max_window_bits=12')
+        extension, response = PerMessageDeflate.negotiate(
+            'permessage-deflate; server_max_window_bits=8, permessage-deflate; server_no_context_takeover',
+            {'server_max_window_bits': 15})
+        self.assertEqual(response, 'permessage-deflate; server_no_context_takeover')
+        self.assertTrue(extension.server_no_context_takeover)
+        self.assertEqual(extension.client_max_window_bits, 15)
+        self.assertEqual(PerMessageDeflate.negotiate('permessage-deflate; foo=1', {}), (None, None))
+        self.assertEqual(PerMessageDeflate.negotiate(None, {}), (None, None))
+
+    def test_compressed_messages(self):
+        server, client = socket.socketpair()
+        websocket = WebSocket(server.makefile('rb'), compression=PerMessageDeflate(max_message_size=1000))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        first = compressor.compress(b'{"a": 1}' * 50) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        second = compressor.compress(b'{"b": 2}' * 50) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        client.sendall(masked_frame(first[:-4], flags=Header.RSV0_MASK) +
+                       masked_frame(second[:5], fin=False, flags=Header.RSV0_MASK) +
+                       masked_frame(second[5:-4], WebSocket.OPCODE_CONTINUATION))
+        self.assertEqual(websocket.receive(), u'{"a": 1}' * 50)
+        self.assertEqual(websocket.receive(), u'{"b": 2}' * 50)
+        websocket.send(u'{"c": 3}' * 50)
+        first_byte, payload = read_frame(client)
+        self.assertEqual(first_byte, 0x80 | Header.RSV0_MASK | WebSocket.OPCODE_TEXT)
+        self.assertEqual(zlib.decompressobj(-12).decompress(payload + b'\x00\x00\xff\xff'), b'{"c": 3}' * 50)
+        websocket.send(u'short')
+        self.assertEqual(read_frame(client), (0x80 | WebSocket.OPCODE_TEXT, b'short'))
+        # a message inflating beyond max_message_size closes the websocket with 1009
+        client.sendall(masked_frame(zlib.compress(b' ' * 2000)[2:-4], flags=Header.RSV0_MASK))
+        self.assertIsNone(websocket.receive())
+        self.assertEqual(read_frame(client), (0x80 | WebSocket.OPCODE_CLOSE, struct.pack('!H', 1009)))
+        server.close()
+        client.close()
+
+
+class OutboundQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        metrics.reset()
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def stalled_websocket(self, policy):
+        websocket = WebSocket(self.server.makefile('rb'), outbound=OutboundQueue(50000, policy))
+        # the client does not read, hence the socket's send buffer fills up
+        while not websocket.pending:
+            websocket.send_prepared(PreparedFrame(b'x' * 10000, binary=True, channel=b'fill'))
+        return websocket
+
+    def drain(self, websocket):
+        self.client.setblocking(False)
+        received = b''
+        while websocket.pending:
+            try:
+                received += self.client.recv(65536)
+            except socket.error:
+                pass
+            websocket.flush()
+        time.sleep(0.01)
+        try:
+            while True:
+                chunk = self.client.recv(65536)
+                if not chunk:
+                    break
+                received += chunk
+        except socket.error:
+            pass
+        return received
+
+    def test_drop_oldest(self):
+        websocket = self.stalled_websocket('drop-oldest')
+        for i in range(20):
+            websocket.send_prepared(PreparedFrame(u'message {0:02d}'.format(i) * 1000, channel=b'chan'))
+        self.assertLessEqual(websocket.pending, 50000)
+        received = self.drain(websocket)
+        self.assertIn(b'message 19', received)
+        self.assertNotIn(b'message 10', received)
+        counters = metrics.get_counters()
+        self.assertEqual(counters['outbound.slow_consumers'], 1)
+        self.assertGreater(counters['outbound.dropped_frames'], 0)
+
+    def test_drop_newest(self):
+        websocket = self.stalled_websocket('drop-newest')
+        for i in range(20):
+            websocket.send_prepared(PreparedFrame(u'message {0:02d}'.format(i) * 1000, channel=b'chan'))
+        received = self.drain(websocket)
+        self.assertIn(b'message 00', received)
+        self.assertNotIn(b'message 19', received)
+
+    def test_keep_latest(self):
+        websocket = self.stalled_websocket('keep-latest')
+        for i in range(20):
+            for channel in (b'a', b'b'):
+                websocket.send_prepared(PreparedFrame(channel * 3000 + u'{0:02d}'.format(i).encode(), channel=channel))
+        received = self.drain(websocket)
+        self.assertIn(b'a' * 3000 + b'19', received)
+        self.assertIn(b'b' * 3000 + b'19', received)
+        self.assertNotIn(b'a' * 3000 + b'10', received)
+
+    def test_close(self):
+        websocket = self.stalled_websocket('close-1013')
+        for i in range(10):
+            if websocket.closed:
+                break
+            websocket.send_prepared(PreparedFrame(b'y' * 10000, binary=True))
+        self.assertTrue(websocket.closed)
+        self.assertEqual(metrics.get_counters()['outbound.slow_consumer_closes'], 1)
+
+    def test_close_backlogged(self):
+        websocket = self.stalled_websocket('drop-oldest')
+        for i in range(10):
+            websocket.send_prepared(PreparedFrame(b'y' * 10000, binary=True))
+        received = []
+
+        def reader():
+            time.sleep(0.1)
+            self.client.settimeout(2)
+            data = self.client.recv(65536)
+            while data:
+                received.append(data)
+                data = self.client.recv(65536)
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        websocket.close(1001)
+        self.server.shutdown(socket.SHUT_WR)
+        thread.join()
+        # the backlog is discarded, but the close frame follows the frame written partially
+        received = b''.join(received)
+        self.assertTrue(received.endswith(b'\x88\x02' + struct.pack('!H', 1001)))
+        self.assertLess(len(received), 50000)
+
+    def test_close_timeout(self):
+        websocket = WebSocket(self.server.makefile('rb'), outbound=OutboundQueue(50000, close_timeout=0.2))
+        while not websocket.pending:
+            websocket.send_prepared(PreparedFrame(b'x' * 10000, binary=True))
+        start = time.time()
+        websocket.close()
+        # a client which does not read, does not keep the server waiting
+        self.assertLess(time.time() - start, 1.0)
+        self.assertTrue(websocket.closed)
+
+    def test_clear_partial(self):
+        queue = OutboundQueue(100, 'close-1008')
+        queue.push([b'a' * 60])
+        queue.push([b'b' * 30])
+        queue.consume(10)
+        with self.assertRaises(SlowConsumerError):
+            queue.push([b'c' * 60])
+        queue.clear()
+        # the remaining bytes of the frame written partially, precede the close frame
+        self.assertEqual((len(queue), queue.pending), (1, 50))
+        self.assertEqual(b''.join(bytes(buf) for buf in queue.peek()), b'a' * 50)
+        queue.consume(50)
+        queue.clear()
+        self.assertEqual((len(queue), queue.pending), (0, 0))
+
+
+class Utf8ValidatorTests(unittest.TestCase):
+    def test_validate_fragments(self):
+        validator = Utf8Validator()
+        self.assertEqual(validator.validate(b'ab\xe6\x9d'), (True, False, 4, 4))
+        self.assertEqual(validator.validate(b'\xb1\xf0\x9f'), (True, False, 3, 7))
+        self.assertEqual(validator.validate(b'\x98\x80x'), (True, True, 3, 10))
+        validator.reset()
+        self.assertEqual(validator.validate(b'abc\xed'), (True, False, 4, 4))
+        # encoded surrogate, rejected at its second octet
+        self.assertEqual(validator.validate(b'\xa0\x80'), (False, False, 0, 4))
+        validator.reset()
+        self.assertEqual(validator.validate(b'a\xc3\xa9\xff'), (False, False, 3, 3))
@@ -31,7 +31,7 @@ class UserChatView(TemplateView):
     def post(self, request, *args, **kwargs):
         redis_publisher = RedisPublisher(facility='foobar', users=[request.POST.get('user')])
         message = RedisMessage(request.POST.get('message'))
-        redis_publisher.publish_message(message)
+        redis_publisher.enqueue_message(message)
         return HttpResponse('OK')
 
 
@@ -50,5 +50,5 @@ class GroupChatView(TemplateView):
     def post(self, request, *args, **kwargs):
         redis_publisher = RedisPublisher(facility='foobar', groups=[request.POST.get('group')])
         message = RedisMessage(request.POST.get('message'))
-        redis_publisher.publish_message(message)
+        redis_publisher.enqueue_message(message)
         return HttpResponse('OK')
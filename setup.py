@@ -64,6 +64,7 @@ setup(
     ],
     extras_require={
         'uwsgi': ['uWSGI>=1.9.20'],
+        'asgi': ['redis>=4.2.0', 'asgiref>=3.2'],
         'wsaccel': ['wsaccel>=0.6.2'],
         'django-redis-sessions': ['django-redis-sessions>=0.4.0'],
     },
@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+# Measure the channel keys built per second by RedisStore._get_message_channels, for a publisher
+# addressing a list of users and groups, compared with formatting each key from its template, as
+# was done before ws4redis.redis_store.ChannelKeys.
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from django.conf import settings
+
+settings.configure(WS4REDIS_PREFIX='bench')
+from ws4redis.redis_store import RedisStore
+
+ROUNDS = 100000
+USERS = ['john', 'mary']
+GROUPS = ['chatusers', 'staff', 'editors']
+
+
+def format_keys(facility, groups, users):
+    prefix = RedisStore.get_prefix()
+    channels = ['{prefix}broadcast:{facility}'.format(prefix=prefix, facility=facility)]
+    channels.extend('{prefix}group:{0}:{facility}'.format(g, prefix=prefix, facility=facility)
+                    for g in set(groups))
+    channels.extend('{prefix}user:{0}:{facility}'.format(u, prefix=prefix, facility=facility)
+                    for u in set(users))
+    return channels
+
+
+def channel_keys(facility, groups, users):
+    return store._get_message_channels(facility=facility, broadcast=True, groups=groups, users=users)
+
+
+store = RedisStore(None)
+
+if __name__ == '__main__':
+    keys = len(channel_keys('foobar', GROUPS, USERS))
+    assert sorted(format_keys('foobar', GROUPS, USERS)) == sorted(channel_keys('foobar', GROUPS, USERS))
+    for func in (format_keys, channel_keys):
+        start = time.time()
+        for _ in range(ROUNDS):
+            func('foobar', GROUPS, USERS)
+        elapsed = time.time() - start
+        print('{0:>12}: {1:>10.0f} keys/s'.format(func.__name__, ROUNDS * keys / elapsed))
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# Measure how many small masked frames per second ws4redis.websocket.WebSocket is able to read
+# from a socketpair, using the buffered Stream versus one recv() call per header field.
+from __future__ import print_function
+import os
+import sys
+import socket
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ws4redis.websocket import WebSocket, Stream, Header
+
+FRAMES = 200000
+PAYLOAD = b'{"message": "Hello, World"}'
+
+
+class UnbufferedStream(object):
+    """The previous implementation of Stream, issuing one recv() for each read."""
+    __slots__ = ('read', 'write', 'fileno')
+    max_buffer_size = Stream.max_buffer_size
+
+    def __init__(self, wsgi_input):
+        self.read = wsgi_input.raw._sock.recv
+        self.write = wsgi_input.raw._sock.sendall
+        self.fileno = wsgi_input.fileno()
+
+
+def masked_frame(payload):
+    mask = os.urandom(4)
+    header = Header.encode_header(True, WebSocket.OPCODE_TEXT, mask, len(payload), 0)
+    masked = bytearray(payload)
+    for i in range(len(masked)):
+        masked[i] ^= bytearray(mask)[i % 4]
+    return header + bytes(masked)
+
+
+def run(stream_class):
+    server, client = socket.socketpair()
+    frame = masked_frame(PAYLOAD)
+    chunk = frame * 1000
+
+    def writer():
+        for _ in range(FRAMES // 1000):
+            client.sendall(chunk)
+
+    websocket = WebSocket(server.makefile('rb'))
+    websocket.stream = stream_class(server.makefile('rb'))
+    thread = threading.Thread(target=writer)
+    thread.daemon = True
+    start = time.time()
+    thread.start()
+    try:
+        for _ in range(FRAMES):
+            header, payload = websocket.read_frame()
+        assert payload == PAYLOAD
+        elapsed = time.time() - start
+    finally:
+        websocket.stream = None
+        # unblocks the writer, in case reading failed
+        server.close()
+        thread.join()
+        client.close()
+    return FRAMES / elapsed
+
+
+if __name__ == '__main__':
+    before = run(UnbufferedStream)
+    after = run(Stream)
+    print('unbuffered: {0:10.0f} frames/s'.format(before))
+    print('buffered:   {0:10.0f} frames/s ({1:.1f}x)'.format(after, after / before))
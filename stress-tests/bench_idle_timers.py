@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# Estimate the CPU time spent on idle websockets at 10k and 50k connections: Polling each
+# connection's socket with select every 4 seconds, as one thread per websocket did, versus keeping
+# their keepalive and idle deadlines in ws4redis.timerwheel.TimerWheel, as the reactor does.
+from __future__ import print_function
+import os
+import sys
+import time
+import select
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ws4redis._compat import monotonic
+from ws4redis.timerwheel import TimerWheel
+
+CONNECTIONS = [10000, 50000]
+SIMULATED_SECONDS = 600
+KEEPALIVE_INTERVAL = 30.0
+IDLE_TIMEOUT = 300.0
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def poll_select(connections):
+    """
+    Each idle connection wakes up every 4 seconds and polls its socket, hence measure a sample of
+    these wakeups and extrapolate. This is a lower bound, since switching between the threads
+    is not accounted for.
+    """
+    server, client = socket.socketpair()
+    wakeups = 100000
+    start = time.process_time()
+    for _ in range(wakeups):
+        select.select([server], [], [], 0)
+        monotonic()
+    seconds = time.process_time() - start
+    server.close()
+    client.close()
+    wakeups_per_second = connections / 4.0
+    return wakeups_per_second, seconds / wakeups * wakeups_per_second
+
+
+def timer_wheel(connections):
+    """
+    Drive a timer wheel with a keepalive and an idle timer per connection through the simulated
+    interval, waking up only when the wheel has to be advanced.
+    """
+    clock = FakeClock()
+    wheel = TimerWheel(clock=clock)
+
+    def keepalive(index):
+        wheel.schedule(KEEPALIVE_INTERVAL, keepalive, index)
+
+    def idle_timeout(index):
+        wheel.schedule(IDLE_TIMEOUT, idle_timeout, index)
+
+    for index in range(connections):
+        # spread the connections as if they had been opened over the last minute
+        offset = index * 60.0 / connections
+        wheel.schedule(KEEPALIVE_INTERVAL - offset % KEEPALIVE_INTERVAL, keepalive, index)
+        wheel.schedule(IDLE_TIMEOUT - offset, idle_timeout, index)
+    end = clock.now + SIMULATED_SECONDS
+    wakeups = 0
+    start = time.process_time()
+    while True:
+        timeout = wheel.timeout()
+        if clock.now + timeout > end:
+            break
+        clock.now += timeout
+        wheel.advance()
+        wakeups += 1
+    seconds = time.process_time() - start
+    return wakeups / float(SIMULATED_SECONDS), seconds / SIMULATED_SECONDS
+
+
+if __name__ == '__main__':
+    print('Keepalive every {0:.0f} s, idle timeout {1:.0f} s, {2} s simulated'.format(
+        KEEPALIVE_INTERVAL, IDLE_TIMEOUT, SIMULATED_SECONDS))
+    print('{0:>12} {1:>22} {2:>14} {3:>12}'.format('connections', 'strategy', 'wakeups/s', 'CPU ms/s'))
+    for connections in CONNECTIONS:
+        for name, strategy in (('select every 4 s', poll_select), ('timer wheel', timer_wheel)):
+            wakeups, cpu = strategy(connections)
+            print('{0:>12} {1:>22} {2:>14.1f} {3:>12.2f}'.format(connections, name, wakeups, cpu * 1000))
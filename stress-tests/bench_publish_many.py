@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+# Measure the messages per second published to targeted audiences from a batch job: One
+# RedisPublisher and one publish_message call per message, versus a single call of
+# RedisPublisher.publish_many. Requires a Redis server on localhost:6379.
+from __future__ import print_function
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from django.conf import settings
+
+settings.configure(WS4REDIS_PREFIX='bench')
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+MESSAGES = 20000
+USERS = 1000
+
+
+def get_messages():
+    return [(u'notification {0}'.format(k), {'facility': 'bench', 'users': ['user{0}'.format(k % USERS)]})
+            for k in range(MESSAGES)]
+
+
+def publish_each(messages):
+    for message, audience in messages:
+        RedisPublisher(**audience).publish_message(RedisMessage(message))
+
+
+def publish_many(messages):
+    RedisPublisher().publish_many(messages)
+
+
+if __name__ == '__main__':
+    messages = get_messages()
+    for func in (publish_each, publish_many):
+        start = time.time()
+        func(messages)
+        elapsed = time.time() - start
+        print('{0:>14}: {1:>9.0f} messages/s'.format(func.__name__, MESSAGES / elapsed))
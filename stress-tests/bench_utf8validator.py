@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Compare the pure Python Utf8Validator against the Cython implementation from wsaccel, validating
+# ASCII-heavy and CJK-heavy corpora in fragments of 16 KB, split in the middle of code points.
+from __future__ import print_function, unicode_literals
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ws4redis.utf8validator import PyUtf8Validator
+
+try:
+    from wsaccel.utf8validator import Utf8Validator as WsaccelUtf8Validator
+except ImportError:
+    WsaccelUtf8Validator = None
+
+CORPORA = {
+    'ascii': ('{"user": "john", "message": "Hello, World", "id": 4711} ' * 20000).encode('utf-8'),
+    'cjk': ('東京都の天気は晴れです。明日は雨が降るでしょう。' * 20000).encode('utf-8'),
+}
+FRAGMENT = 16381
+
+
+def validate(validator_class, corpus):
+    validator = validator_class()
+    for offset in range(0, len(corpus), FRAGMENT):
+        result = validator.validate(corpus[offset:offset + FRAGMENT])
+    assert result[0] and result[1]
+
+
+if __name__ == '__main__':
+    implementations = [('python', PyUtf8Validator)]
+    if WsaccelUtf8Validator:
+        implementations.append(('wsaccel', WsaccelUtf8Validator))
+    else:
+        print('wsaccel is not installed')
+    for name, corpus in sorted(CORPORA.items()):
+        for impl, validator_class in implementations:
+            seconds = min(timeit.repeat(lambda: validate(validator_class, corpus), number=10, repeat=3))
+            print('{0:>6} {1:>8}: {2:8.1f} MB/s'.format(name, impl, len(corpus) * 10 / seconds / (1 << 20)))
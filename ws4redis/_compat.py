@@ -11,3 +11,10 @@ def is_authenticated(request):
     if callable(request.user.is_authenticated):
         return request.user.is_authenticated()
     return request.user.is_authenticated
+
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from time import time as monotonic
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Websocket server for ASGI containers, such as uvicorn or daphne. It serves all websockets of a
+worker process from one asyncio event loop and therefore requires Python 3 and a version of
+redis-py providing ``redis.asyncio``.
+"""
+import io
+import sys
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.core.exceptions import PermissionDenied, ImproperlyConfigured
+from django.core.handlers.asgi import ASGIRequest
+from redis import asyncio as redis_asyncio
+from ws4redis import drain as drain_module
+from ws4redis import metrics
+from ws4redis import settings as private_settings
+from ws4redis._compat import monotonic
+from ws4redis.exceptions import HandshakeError, DrainingError, SlowConsumerError
+from ws4redis.outbound import OutboundQueue
+from ws4redis.redis_store import RedisMessage, split_sequence
+from ws4redis.subscriber import RedisSubscriber
+from ws4redis.wsgi_server import WebsocketWSGIServer
+
+logger = logging.getLogger('django.request')
+
+
+def prepare_event(message):
+    """
+    Encode ``message`` into an ASGI ``websocket.send`` event. Messages are sent as text, unless
+    they are not valid UTF-8.
+    """
+    if isinstance(message, str):
+        return {'type': 'websocket.send', 'text': message}
+    try:
+        return {'type': 'websocket.send', 'text': message.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'type': 'websocket.send', 'bytes': bytes(message)}
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """
+    The messages received for a websocket of the event loop, waiting to be sent to its client.
+    Once more than ``high_water_mark`` bytes are pending, the slow consumer ``policy`` of
+    ``OutboundQueue`` is applied. Policies closing the websocket let ``get`` raise a
+    ``SlowConsumerError``, rather than the multiplexer putting the message.
+    """
+    def __init__(self, high_water_mark=1024 * 1024, policy='drop-oldest', close_timeout=1.0):
+        super(AsyncOutboundQueue, self).__init__(high_water_mark, policy, close_timeout)
+        self._ready = asyncio.Event()
+        self._error = None
+
+    def put_nowait(self, item, channel=None):
+        """
+        Append ``item``, a tuple of a message and its ASGI event, received on ``channel``.
+        """
+        if self._error is not None:
+            return
+        size = len(item[0])
+        try:
+            if self._frames and self._pending + size > self.high_water_mark:
+                if not self._overflow(size, channel):
+                    return
+        except SlowConsumerError as excpt:
+            self._error = excpt
+            self.clear()
+        else:
+            self._frames.append([channel, item, size, False])
+            self._pending += size
+        self._ready.set()
+
+    async def get(self):
+        """
+        Wait for the next item and remove it from the queue.
+
+        :raises SlowConsumerError: if the policy demands to close the websocket.
+        """
+        while not self._frames:
+            if self._error is not None:
+                raise self._error
+            self._ready.clear()
+            await self._ready.wait()
+        entry = self._frames.popleft()
+        self._pending -= entry[2]
+        return entry[1]
+
+
+class AsyncRedisMultiplexer(object):
+    """
+    Shares one ``redis.asyncio`` PubSub connection between all websockets of the event loop.
+
+    This is the asyncio counterpart of ``ws4redis.multiplexer.RedisMultiplexer``: The first
+    listener joining a channel causes a SUBSCRIBE, the last one leaving it an UNSUBSCRIBE. A task
+    reads from the PubSub connection, encodes each received message once into an ASGI event and
+    puts it into the queue of every listener of that channel.
+    """
+    def __init__(self, connection):
+        self._pubsub = connection.pubsub()
+        self._listeners = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    @staticmethod
+    def _normalize(channel):
+        if isinstance(channel, bytes):
+            return channel
+        return channel.encode('utf-8')
+
+    async def subscribe(self, queue, channels):
+        """
+        Add ``queue`` to each of the given ``channels``.
+        """
+        async with self._lock:
+            new_channels = []
+            for channel in channels:
+                channel = self._normalize(channel)
+                listeners = self._listeners.get(channel)
+                if listeners is None:
+                    listeners = self._listeners[channel] = set()
+                    new_channels.append(channel)
+                listeners.add(queue)
+            if new_channels:
+                await self._pubsub.subscribe(*new_channels)
+            if self._task is None and self._listeners:
+                self._task = asyncio.ensure_future(self._listen())
+
+    async def unsubscribe(self, queue, channels):
+        """
+        Remove ``queue`` from each of the given ``channels``.
+        """
+        async with self._lock:
+            old_channels = []
+            for channel in channels:
+                channel = self._normalize(channel)
+                listeners = self._listeners.get(channel)
+                if listeners is None:
+                    continue
+                listeners.discard(queue)
+                if not listeners:
+                    del self._listeners[channel]
+                    old_channels.append(channel)
+            if old_channels:
+                await self._pubsub.unsubscribe(*old_channels)
+
+    async def _listen(self):
+        while self._listeners:
+            try:
+                response = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as excpt:
+                logger.error('AsyncRedisMultiplexer: {}'.format(excpt))
+                await asyncio.sleep(1.0)
+                continue
+            if not response or response['type'] != 'message':
+                continue
+            listeners = self._listeners.get(self._normalize(response['channel']))
+            message = split_sequence(RedisMessage(response['data']))[1]
+            if not listeners or not message:
+                continue
+            # encode the event once and share it between all local recipients
+            item = (message, prepare_event(message))
+            for queue in listeners:
+                queue.put_nowait(item, response['channel'])
+        self._task = None
+
+
+class AsyncRedisSubscriber(RedisSubscriber):
+    """
+    Subscriber class used by ``WebsocketASGIServer``. It determines its channels exactly as
+    ``RedisSubscriber`` does, but talks to Redis through ``redis.asyncio`` and receives its
+    messages from the event loop's ``AsyncRedisMultiplexer``.
+    """
+    def __init__(self, connection, multiplexer):
+        super(AsyncRedisSubscriber, self).__init__(connection)
+        self._multiplexer = multiplexer
+        self._channels = []
+        # bounded, since messages can not be written to slow clients without blocking the loop
+        self._queue = AsyncOutboundQueue(**(private_settings.WS4REDIS_OUTBOUND_QUEUE or {}))
+
+    def subscribe_channels(self, channels):
+        # called from a worker thread while processing the request, hence only remember the keys
+        self._channels = list(channels)
+
+    async def subscribe(self):
+        await self._multiplexer.subscribe(self._queue, self._channels)
+
+    def parse_resume(self, resume, keys):
+        # messages are sent without their sequence numbers, hence subscriptions can not be resumed
+        return None
+
+    async def parse_response(self):
+        """
+        Wait for the next message on one of the subscribed channels and return it together with
+        its encoded ASGI event.
+
+        :raises SlowConsumerError: if the client does not keep up and shall be disconnected.
+        """
+        return await self._queue.get()
+
+    async def publish_message(self, message, expire=None):
+        if expire is None:
+            expire = self._expire
+        if not isinstance(message, RedisMessage):
+            raise ValueError('message object is not of type RedisMessage')
+        if not self._publishers:
+            return
+        await self._eval_publish(list(self._publishers), message, expire)
+
+    async def send_persisted_messages(self, websocket):
+        if not self._channels:
+            return
+        for message in await self._connection.mget(self._channels):
+            message = split_sequence(message)[1]
+            if message:
+                await websocket.send(message)
+
+    send_persited_messages = send_persisted_messages
+
+    def get_file_descriptor(self):
+        return None
+
+    async def release(self):
+        await self._multiplexer.unsubscribe(self._queue, self._channels)
+        self._channels = []
+
+
+class ASGIWebsocket(object):
+    """
+    Wraps the ASGI ``receive`` and ``send`` callables, offering the subset of the ``WebSocket``
+    API used by ``WebsocketASGIServer``, albeit as coroutines.
+    """
+    def __init__(self, receive, send):
+        self._receive = receive
+        self._send = send
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    async def accept(self):
+        await self._send({'type': 'websocket.accept'})
+
+    async def receive(self):
+        """
+        Wait for the next message from the client. Returns None, after the client disconnected.
+        """
+        while not self._closed:
+            event = await self._receive()
+            if event['type'] == 'websocket.receive':
+                text = event.get('text')
+                return text if text is not None else event.get('bytes')
+            if event['type'] == 'websocket.disconnect':
+                self._closed = True
+
+    async def send(self, message, binary=False):
+        if binary:
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            await self._send({'type': 'websocket.send', 'bytes': bytes(message)})
+        else:
+            await self._send(prepare_event(message))
+
+    async def send_prepared(self, event):
+        await self._send(event)
+
+    async def close(self, code=1000, reason=''):
+        if not self._closed:
+            self._closed = True
+            event = {'type': 'websocket.close', 'code': code}
+            if reason:
+                event['reason'] = reason
+            await self._send(event)
+
+
+class WebsocketASGIServer(WebsocketWSGIServer):
+    """
+    ASGI application serving the websockets below ``WEBSOCKET_URL``. All other requests
+    are passed to ``application``, usually the one returned by ``get_asgi_application()``.
+
+    Channels are selected through the query string, restricted by ``WS4REDIS_ALLOWED_CHANNELS``
+    and persisted messages are replayed, just as with ``WebsocketWSGIServer``. Keepalive pings
+    are left to the ASGI container.
+    """
+    Subscriber = AsyncRedisSubscriber
+
+    def __init__(self, application=None, redis_connection=None):
+        self.application = application
+        self.possible_channels = self.Subscriber.subscription_channels + self.Subscriber.publish_channels
+        if private_settings.WS4REDIS_CLUSTER is not None:
+            raise ImproperlyConfigured('WebsocketASGIServer does not support WS4REDIS_CLUSTER')
+        self._redis_connection = redis_connection or redis_asyncio.StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        self._multiplexer = None
+        self._websockets = set()
+        self.compile_handshake()
+        self._drain = None
+        self._drain_deadlines = {}
+        self._loop = None
+        if drain_module.drain is not None:
+            drain_module.drain.register(self)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket' and scope['path'].startswith(private_settings.WEBSOCKET_URL):
+            return await self.handle_websocket(scope, receive, send)
+        if self.application is None:
+            raise ValueError('No application configured to handle {0} requests'.format(scope['type']))
+        return await self.application(scope, receive, send)
+
+    def get_multiplexer(self):
+        if self._multiplexer is None:
+            self._multiplexer = AsyncRedisMultiplexer(self._redis_connection)
+        return self._multiplexer
+
+    def drain(self, drain):
+        """
+        Called by ``ws4redis.drain.Drain`` from any thread, hence the websockets are closed by
+        callbacks scheduled on the event loop.
+        """
+        self._drain_deadlines = drain.schedule(self._websockets)
+        self._drain = drain
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule_drain)
+
+    def _schedule_drain(self):
+        for websocket in list(self._websockets):
+            delay = self.get_drain_deadline(websocket) - monotonic()
+            self._loop.call_later(max(delay, 0), self.close_drained, websocket)
+
+    def close_drained(self, websocket):
+        self._drain_deadlines.pop(websocket, None)
+        asyncio.ensure_future(websocket.close(self._drain.code, self._drain.get_close_reason()))
+
+    def process_handshake(self, request, subscriber, stopwatch=None):
+        """
+        Process the request and determine the subscriber's channels. This method runs in a
+        worker thread, since loading sessions and users, as well as the configured callbacks, may
+        block on the database.
+        """
+        if drain_module.drain is not None:
+            drain_module.drain.listen()
+        if self._drain is not None:
+            raise DrainingError('Server is draining')
+        channels, echo_message = self.process_websocket_request(request, stopwatch)
+        subscriber.set_pubsub_channels(request, channels)
+        return channels, echo_message
+
+    async def handle_websocket(self, scope, receive, send):
+        websocket = ASGIWebsocket(receive, send)
+        event = await receive()
+        if event['type'] != 'websocket.connect':
+            return
+        self._loop = asyncio.get_event_loop()
+        # time each stage of the handshake, see ws4redis.metrics.get_histograms()
+        stopwatch = metrics.Stopwatch('handshake')
+        subscriber = self.Subscriber(self._redis_connection, self.get_multiplexer())
+        try:
+            # ASGI websocket scopes lack the request method, which Django's request requires
+            request = ASGIRequest(dict(scope, method='GET'), io.BytesIO())
+            stopwatch.lap('request')
+            channels, echo_message = await sync_to_async(self.process_handshake)(request, subscriber, stopwatch)
+        except (HandshakeError, PermissionDenied) as excpt:
+            logger.warning('{0}: {1}'.format(excpt.__class__.__name__, excpt), exc_info=sys.exc_info())
+            metrics.increment('handshake.rejected')
+            # closing a websocket before accepting it, rejects the handshake with status 403
+            await websocket.close(1008)
+            return
+        except Exception as excpt:
+            logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+            metrics.increment('handshake.rejected')
+            await websocket.close(1011)
+            return
+        await websocket.accept()
+        self._websockets.add(websocket)
+        if self._drain is not None:
+            # the server started to drain during the handshake
+            self.close_drained(websocket)
+        stopwatch.lap('upgrade')
+        logger.debug('Subscribed to channels: {0}'.format(', '.join(channels)))
+        try:
+            await subscriber.subscribe()
+            stopwatch.lap('subscribe')
+            await subscriber.send_persisted_messages(websocket)
+            stopwatch.lap('replay')
+            await self.serve(websocket, subscriber, echo_message)
+        except Exception as excpt:
+            logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+        finally:
+            self._websockets.discard(websocket)
+            await subscriber.release()
+            await websocket.close(1001)
+
+    async def serve(self, websocket, subscriber, echo_message):
+        """
+        Forward messages from the client to Redis and vice versa, until the client disconnects.
+        """
+        recvmsg = None
+
+        async def receive_messages():
+            nonlocal recvmsg
+            while True:
+                message = await websocket.receive()
+                if message is None:
+                    return
+                recvmsg = RedisMessage(message)
+                if recvmsg:
+                    await subscriber.publish_message(recvmsg)
+
+        async def send_messages():
+            while True:
+                try:
+                    message, event = await asyncio.wait_for(subscriber.parse_response(), 4.0)
+                except asyncio.TimeoutError:
+                    # nothing has been sent for 4 seconds
+                    if private_settings.WS4REDIS_HEARTBEAT:
+                        await websocket.send(private_settings.WS4REDIS_HEARTBEAT)
+                    continue
+                except SlowConsumerError as excpt:
+                    await websocket.close(excpt.code, 'Slow consumer')
+                    return
+                if echo_message or message != recvmsg:
+                    await websocket.send_prepared(event)
+
+        tasks = [asyncio.ensure_future(receive_messages()), asyncio.ensure_future(send_messages())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Publishing from a background thread, so that Django views hand their messages over to a queue
+rather than waiting for a round trip to Redis on each call of ``publish_message``.
+"""
+import os
+import atexit
+import logging
+import threading
+from collections import deque
+from ws4redis import settings, metrics
+from ws4redis._compat import monotonic
+
+logger = logging.getLogger('django.request')
+
+
+class BackgroundPublisher(object):
+    """
+    A bounded queue of messages, drained by a daemon thread of the current process. The thread
+    waits until ``batch_size`` messages are queued, or at most ``flush_interval`` seconds after the
+    first one, and then publishes them all through one pipeline. Once ``max_queue`` messages are
+    pending, further messages are dropped and counted as ``background.dropped_messages``.
+
+    The queue depth found by each flush is recorded in the histogram ``background.queue_depth``.
+    Call ``flush`` to wait until all queued messages are published, and ``close`` to stop the
+    thread. The publisher configured through ``WS4REDIS_BACKGROUND_PUBLISHER`` is closed on exit
+    of the process.
+    """
+    def __init__(self, max_queue=10000, flush_interval=0.005, batch_size=500):
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        # after a fork, the queue belongs to the parent and its thread does not exist in the child
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._sending = 0
+        self._flushing = 0
+        self._closed = False
+        self._pid = os.getpid()
+
+    def enqueue(self, channels, message, expire):
+        """
+        Queue ``message`` to be published and persisted for ``expire`` seconds on ``channels``.
+        Returns False, if the message was dropped because the queue is full or closed.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        with self._condition:
+            if self._closed or len(self._queue) >= self.max_queue:
+                metrics.increment('background.dropped_messages')
+                return False
+            self._queue.append((channels, message, expire))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ws4redis-publisher')
+                self._thread.daemon = True
+                self._thread.start()
+            if len(self._queue) == 1 or len(self._queue) == self.batch_size:
+                self._condition.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until all messages queued so far are published, for at most ``timeout`` seconds.
+        Returns False, if messages are still pending after the timeout.
+        """
+        if self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                while self._queue or self._sending:
+                    if self._thread is None:
+                        return False
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            return False
+                    self._condition.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def close(self, timeout=5.0):
+        """
+        Publish the pending messages and stop the thread. Messages enqueued afterwards are dropped.
+        """
+        if self._pid != os.getpid():
+            return
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            thread = self._thread
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        if not flushed:
+            logger.warning('BackgroundPublisher: {0} messages were not published'.format(len(self._queue)))
+
+    def _take_batch(self):
+        """
+        Wait for the next batch of messages and remove it from the queue. Returns None, once the
+        publisher is closed.
+        """
+        with self._condition:
+            while not self._queue:
+                if self._closed:
+                    self._thread = None
+                    return None
+                self._condition.wait()
+            deadline = monotonic() + self.flush_interval
+            while len(self._queue) < self.batch_size and not (self._flushing or self._closed):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            metrics.observe('background.queue_depth', len(self._queue))
+            count = min(len(self._queue), self.batch_size)
+            self._sending = count
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _run(self):
+        from ws4redis.publisher import RedisPublisher
+
+        publisher = RedisPublisher()
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            try:
+                self._publish(publisher, batch)
+            except Exception as excpt:
+                metrics.increment('background.failed_messages', len(batch))
+                logger.error('BackgroundPublisher: {}'.format(excpt))
+            with self._condition:
+                self._sending = 0
+                self._condition.notify_all()
+
+    def _publish(self, publisher, batch):
+        pipeline = publisher._connection.pipeline(transaction=False)
+        for channels, message, expire in batch:
+            for group in publisher._get_slot_groups(channels):
+                publisher._eval_publish(group, message, expire, client=pipeline)
+        pipeline.execute()
+        metrics.increment('background.published_messages', len(batch))
+
+
+background_publisher = None
+if settings.WS4REDIS_BACKGROUND_PUBLISHER is not None:
+    background_publisher = BackgroundPublisher(**settings.WS4REDIS_BACKGROUND_PUBLISHER)
+    atexit.register(background_publisher.close)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Distribution of channels and their persisted messages onto the nodes of a Redis Cluster, so that
+publishing scales with the number of nodes, rather than funneling through a single primary.
+"""
+import threading
+import six
+from django.core.exceptions import ImproperlyConfigured
+from redis import StrictRedis
+from redis.client import PubSub
+from ws4redis import settings
+
+try:
+    from redis.crc import key_slot, REDIS_CLUSTER_HASH_SLOTS
+except ImportError:
+    # redis-py < 4.1, which then can not be used with a Redis Cluster
+    key_slot = None
+
+
+class ShardedRedis(object):
+    """
+    Sends each command to the Redis node owning the hash slot of its key. Messages are published
+    through sharded pub/sub (SPUBLISH and SSUBSCRIBE), which propagates a message only within the
+    shard of its channel, whereas classic pub/sub broadcasts each message to all nodes of the
+    cluster. A channel and its persisted message share the same key, hence the same slot.
+
+    Either pass the ``startup_nodes`` of a Redis Cluster, for instance
+    ``[{'host': 'redis-1', 'port': 7000}]``, whose slot map is looked up by ``redis.cluster``, or a
+    list of standalone ``nodes``, each given by the keyword arguments of ``StrictRedis``, among which
+    the hash slots are split into ranges of equal size. Further ``options`` are passed to each
+    connection. Sharded pub/sub requires Redis 7 and a redis-py supporting SSUBSCRIBE. If ``sharded``
+    is None, it is used if both do, otherwise messages are published with PUBLISH on the node of
+    their channel.
+    """
+    def __init__(self, startup_nodes=None, nodes=None, sharded=None, **options):
+        if key_slot is None:
+            raise ImproperlyConfigured('Distributing channels onto a Redis Cluster requires redis>=4.1')
+        if bool(startup_nodes) == bool(nodes):
+            raise ValueError('Pass either the startup_nodes of a Redis Cluster or a list of nodes')
+        if sharded and not hasattr(PubSub, 'ssubscribe'):
+            raise ImproperlyConfigured('Sharded pub/sub requires a redis-py supporting SSUBSCRIBE')
+        self._startup_nodes = startup_nodes
+        self._nodes = [StrictRedis(**dict(options, **node)) for node in nodes or ()]
+        self._options = options
+        self._cluster = None
+        self._sharded = sharded
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_slot(key):
+        if not isinstance(key, six.binary_type):
+            key = key.encode('utf-8')
+        return key_slot(key)
+
+    def get_node(self, key):
+        """
+        Returns the connection to the node owning the hash slot of ``key``.
+        """
+        slot = self.get_slot(key)
+        if self._nodes:
+            return self._nodes[slot * len(self._nodes) // REDIS_CLUSTER_HASH_SLOTS]
+        cluster = self.get_cluster()
+        return cluster.get_redis_connection(cluster.nodes_manager.get_node_from_slot(slot))
+
+    def group_by_slot(self, keys):
+        """
+        Returns ``keys`` split into lists of keys located in the same hash slot.
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_slot(key), []).append(key)
+        return list(groups.values())
+
+    def get_cluster(self):
+        """
+        Returns the ``RedisCluster`` client, which is created on first use, since it connects to
+        the cluster to load the slot map.
+        """
+        with self._lock:
+            if self._cluster is None:
+                from redis.cluster import RedisCluster, ClusterNode
+
+                startup_nodes = [ClusterNode(**node) for node in self._startup_nodes]
+                self._cluster = RedisCluster(startup_nodes=startup_nodes, **self._options)
+        return self._cluster
+
+    @property
+    def sharded(self):
+        if self._sharded is None and not hasattr(PubSub, 'ssubscribe'):
+            self._sharded = False
+        elif self._sharded is None:
+            node = self._nodes[0] if self._nodes else self.get_node(b'')
+            version = node.info('server')['redis_version']
+            self._sharded = int(str(version).split('.')[0]) >= 7
+        return self._sharded
+
+    @property
+    def publish_command(self):
+        return 'SPUBLISH' if self.sharded else 'PUBLISH'
+
+    def publish(self, channel, message):
+        return self.get_node(channel).execute_command(self.publish_command, channel, message)
+
+    def get(self, name):
+        return self.get_node(name).get(name)
+
+    def setex(self, name, time, value):
+        return self.get_node(name).setex(name, time, value)
+
+    def mget(self, keys):
+        """
+        Returns the values of ``keys``, fetched through one MGET for each node.
+        """
+        keys = list(keys)
+        nodes = []
+        for key in keys:
+            node = self.get_node(key)
+            for owner, owned in nodes:
+                if owner is node:
+                    owned.append(key)
+                    break
+            else:
+                nodes.append((node, [key]))
+        values = {}
+        for node, owned in nodes:
+            values.update(zip(owned, node.mget(owned)))
+        return [values[key] for key in keys]
+
+    def delete(self, *names):
+        return sum(self.get_node(name).delete(name) for name in names)
+
+    def xrange(self, name, *args, **kwargs):
+        return self.get_node(name).xrange(name, *args, **kwargs)
+
+    def xrevrange(self, name, *args, **kwargs):
+        return self.get_node(name).xrevrange(name, *args, **kwargs)
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+
+class ShardedPipeline(object):
+    """
+    Collects the commands of a pipeline in one pipeline per node and executes them node by node.
+    Transactions only span the commands sent to the same node. The results are returned in the
+    order of the commands.
+    """
+    def __init__(self, connection, transaction):
+        self._connection = connection
+        self._transaction = transaction
+        self._pipelines = []
+        self._order = []
+
+    def get_pipeline(self, key):
+        """
+        Returns the pipeline of the node owning ``key``, for the next command.
+        """
+        node = self._connection.get_node(key)
+        for index, (owner, pipeline) in enumerate(self._pipelines):
+            if owner is node:
+                break
+        else:
+            index, pipeline = len(self._pipelines), node.pipeline(transaction=self._transaction)
+            self._pipelines.append((node, pipeline))
+        self._order.append(index)
+        return pipeline
+
+    def publish(self, channel, message):
+        self.get_pipeline(channel).execute_command(self._connection.publish_command, channel, message)
+        return self
+
+    def setex(self, name, time, value):
+        self.get_pipeline(name).setex(name, time, value)
+        return self
+
+    def xrange(self, name, *args, **kwargs):
+        self.get_pipeline(name).xrange(name, *args, **kwargs)
+        return self
+
+    def xrevrange(self, name, *args, **kwargs):
+        self.get_pipeline(name).xrevrange(name, *args, **kwargs)
+        return self
+
+    def execute(self):
+        results = [iter(pipeline.execute()) for _, pipeline in self._pipelines]
+        results = [next(results[index]) for index in self._order]
+        self._pipelines, self._order = [], []
+        return results
+
+
+class ShardedScript(object):
+    """
+    A Lua script, evaluated on the node owning the hash slot of its first key. All keys of a
+    script must be located in the same slot.
+    """
+    def __init__(self, connection, script):
+        self._connection = connection
+        self._source = script
+        self._script = None
+
+    def __call__(self, keys=(), args=(), client=None):
+        if isinstance(client, ShardedPipeline):
+            client = client.get_pipeline(keys[0])
+        else:
+            client = self._connection.get_node(keys[0])
+        if self._script is None:
+            # the script is loaded onto each node on first use
+            self._script = self._connection.get_node(keys[0]).register_script(self._source)
+        return self._script(keys=keys, args=args, client=client)
+
+
+cluster_connection = None
+if settings.WS4REDIS_CLUSTER is not None:
+    cluster_connection = ShardedRedis(**settings.WS4REDIS_CLUSTER)
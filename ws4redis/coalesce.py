@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Publishing on commit of the current database transaction, so that signal handlers firing for each
+saved row send one message per channel, and nothing at all if the transaction is rolled back.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from django.db import transaction
+from ws4redis.redis_store import RedisMessage
+
+_local = threading.local()
+
+
+def get_publish_buffer():
+    """
+    Returns the ``PublishBuffer`` of the innermost ``publish_on_commit`` block of the current
+    thread, or None.
+    """
+    return getattr(_local, 'buffer', None)
+
+
+class PublishBuffer(object):
+    """
+    Collects the messages published on each channel and collapses them according to ``policy``:
+    With ``last-wins``, only the last message of each channel is published. With ``json-array``,
+    all messages of a channel, which must be JSON documents, are published as one JSON array.
+
+    Each message is confirmed by a callback registered through ``transaction.on_commit`` for the
+    database ``using``, when it is added. Django discards the callbacks of savepoints rolled back,
+    hence messages published within them are left out when flushing.
+    """
+    policies = ('last-wins', 'json-array')
+
+    def __init__(self, policy='last-wins', using=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy for collapsing messages: {0}'.format(policy))
+        self.policy = policy
+        self.using = using
+        # each entry is a list [confirmed, channels, message, expire]
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, channels, message, expire):
+        """
+        Buffer ``message`` for each of ``channels``, to be persisted for ``expire`` seconds.
+        """
+        entry = [False, list(channels), message, expire]
+        self._entries.append(entry)
+        transaction.on_commit(partial(self._confirm, entry), using=self.using)
+
+    @staticmethod
+    def _confirm(entry):
+        entry[0] = True
+
+    def extend(self, other):
+        """
+        Add the messages buffered by ``other``, in the order they were published.
+        """
+        self._entries.extend(other._entries)
+
+    def clear(self):
+        del self._entries[:]
+
+    def collapse(self, messages):
+        if self.policy == 'last-wins':
+            return messages[-1]
+        return RedisMessage(b'[' + b','.join(messages) + b']')
+
+    def flush(self, publisher=None):
+        """
+        Publish the collapsed message of each channel, through one pipeline. Channels receiving the
+        same message share one evaluation of the publishing script per hash slot.
+        Returns a dictionary mapping each channel onto the number of its receivers.
+        """
+        from ws4redis.publisher import RedisPublisher
+
+        publisher = publisher or RedisPublisher()
+        buffered = OrderedDict()
+        for confirmed, channels, message, expire in self._entries:
+            if not confirmed:
+                continue
+            for channel in channels:
+                entry = buffered.get(channel)
+                if entry is None or self.policy == 'last-wins':
+                    buffered[channel] = ([message], expire)
+                else:
+                    entry[0].append(message)
+                    buffered[channel] = (entry[0], max(entry[1], expire))
+        self.clear()
+        messages = OrderedDict()
+        for channel, (collected, expire) in buffered.items():
+            messages.setdefault((self.collapse(collected), expire), []).append(channel)
+        receivers = {}
+        if not messages:
+            return receivers
+        calls = []
+        pipeline = publisher._connection.pipeline(transaction=False)
+        for (message, expire), channels in messages.items():
+            for group in publisher._get_slot_groups(channels):
+                publisher._eval_publish(group, message, expire, client=pipeline)
+                calls.append(group)
+        for group, counts in zip(calls, pipeline.execute()):
+            receivers.update(zip(group, counts))
+        return receivers
+
+
+@contextmanager
+def publish_on_commit(policy='last-wins', using=None):
+    """
+    Within this block, messages published through ``RedisPublisher`` by the current thread are
+    buffered, collapsed per channel according to ``policy`` and published once the transaction of
+    database ``using`` commits. If the block raises an exception or the transaction is rolled back,
+    they are discarded, as are the messages published within a savepoint rolled back. Nested
+    blocks hand their messages over to the enclosing block.
+    """
+    outer = get_publish_buffer()
+    buffer = _local.buffer = PublishBuffer(policy, using)
+    try:
+        yield buffer
+    finally:
+        _local.buffer = outer
+    if outer is not None:
+        outer.extend(buffer)
+    elif buffer:
+        transaction.on_commit(buffer.flush, using=using)
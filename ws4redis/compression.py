@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import zlib
+from ws4redis.exceptions import WebSocketError, FrameTooLargeException
+
+# trailer removed from (and added to) each compressed message, see RFC 7692, section 7.2.1
+_TRAILER = b'\x00\x00\xff\xff'
+
+
+def parse_extensions(header):
+    """
+    Parse the value of a ``Sec-WebSocket-Extensions`` header into a list of tuples
+    ``(name, [(param, value), ...])``. Parameters without a value are returned with value None.
+    """
+    extensions = []
+    for offer in header.split(','):
+        items = [item.strip() for item in offer.split(';')]
+        if not items[0]:
+            continue
+        params = []
+        for item in items[1:]:
+            if not item:
+                continue
+            param, _, value = item.partition('=')
+            value = value.strip().strip('"') if _ else None
+            params.append((param.strip().lower(), value))
+        extensions.append((items[0].lower(), params))
+    return extensions
+
+
+class PerMessageDeflate(object):
+    """
+    Implements the permessage-deflate extension (RFC 7692) for one websocket connection.
+
+    Each connection owns its compressor and decompressor, unless the context takeover has been
+    disabled for that direction. Then they are created for each message and released afterwards,
+    which trades compression ratio against memory per connection.
+    """
+    name = 'permessage-deflate'
+
+    def __init__(self, server_no_context_takeover=False, client_no_context_takeover=False,
+                 server_max_window_bits=12, client_max_window_bits=12, compress_threshold=128,
+                 max_message_size=16 * 1024 * 1024, compress_level=6, memory_level=5):
+        if not 9 <= server_max_window_bits <= 15 or not 8 <= client_max_window_bits <= 15:
+            raise ValueError('Window bits must be in range 9..15 for the server, 8..15 for the client')
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.compress_threshold = compress_threshold
+        self.max_message_size = max_message_size
+        self.compress_level = compress_level
+        self.memory_level = memory_level
+        self._compressor = None
+        self._decompressor = None
+        self._inflated = 0
+
+    @classmethod
+    def negotiate(cls, header, config):
+        """
+        Select the first acceptable permessage-deflate offer from the client's
+        ``Sec-WebSocket-Extensions`` ``header``, adjusted to the server side ``config``.
+
+        :returns: A tuple with a ``PerMessageDeflate`` instance and the value for the
+            ``Sec-WebSocket-Extensions`` response header, or ``(None, None)``, if no offer
+            has been accepted.
+        """
+        for name, params in parse_extensions(header or ''):
+            if name != cls.name:
+                continue
+            try:
+                extension = cls(**config)
+                response = extension._accept(params)
+            except ValueError:
+                # malformed or unsupported offer, try the next one
+                continue
+            return extension, response
+        return None, None
+
+    def _accept(self, params):
+        offered = {}
+        for param, value in params:
+            if param in offered:
+                raise ValueError('Duplicate parameter {0}'.format(param))
+            offered[param] = value
+        response = [self.name]
+        if 'server_no_context_takeover' in offered:
+            if offered['server_no_context_takeover'] is not None:
+                raise ValueError('server_no_context_takeover does not take a value')
+            self.server_no_context_takeover = True
+        if self.server_no_context_takeover:
+            response.append('server_no_context_takeover')
+        if 'client_no_context_takeover' in offered:
+            if offered['client_no_context_takeover'] is not None:
+                raise ValueError('client_no_context_takeover does not take a value')
+            self.client_no_context_takeover = True
+        if self.client_no_context_takeover:
+            response.append('client_no_context_takeover')
+        if 'server_max_window_bits' in offered:
+            bits = self._window_bits(offered['server_max_window_bits'])
+            if bits < 9:
+                # zlib is unable to compress with a window of 256 bytes
+                raise ValueError('server_max_window_bits=8 is not supported')
+            self.server_max_window_bits = min(bits, self.server_max_window_bits)
+        if self.server_max_window_bits < 15 or 'server_max_window_bits' in offered:
+            response.append('server_max_window_bits={0}'.format(self.server_max_window_bits))
+        if 'client_max_window_bits' in offered:
+            if offered['client_max_window_bits'] is not None:
+                bits = self._window_bits(offered['client_max_window_bits'])
+                self.client_max_window_bits = min(bits, self.client_max_window_bits)
+            response.append('client_max_window_bits={0}'.format(self.client_max_window_bits))
+        else:
+            # the client did not announce to support a smaller window
+            self.client_max_window_bits = 15
+        unknown = set(offered) - set(['server_no_context_takeover', 'client_no_context_takeover',
+                                      'server_max_window_bits', 'client_max_window_bits'])
+        if unknown:
+            raise ValueError('Unknown parameters {0}'.format(', '.join(unknown)))
+        return '; '.join(response)
+
+    @staticmethod
+    def _window_bits(value):
+        if value is None or not value.isdigit() or not 8 <= int(value) <= 15:
+            raise ValueError('Invalid window bits: {0}'.format(value))
+        return int(value)
+
+    def compress(self, payload):
+        """
+        Compress the payload of a complete outbound message.
+        """
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                          -self.server_max_window_bits, self.memory_level)
+            if not self.server_no_context_takeover:
+                self._compressor = compressor
+        payload = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if payload.endswith(_TRAILER):
+            payload = payload[:-4]
+        return payload
+
+    def decompress(self, payload, fin):
+        """
+        Decompress the payload of an inbound frame belonging to a compressed message. ``fin``
+        must be set for the final frame of that message.
+
+        :raises FrameTooLargeException: if the decompressed message exceeds ``max_message_size``.
+        """
+        if self._decompressor is None:
+            # a decoder window larger than the encoder's one is always safe
+            self._decompressor = zlib.decompressobj(-max(self.client_max_window_bits, 9))
+        if fin:
+            payload = payload + _TRAILER
+        try:
+            if self.max_message_size:
+                data = self._decompressor.decompress(payload, self.max_message_size - self._inflated + 1)
+                if self._decompressor.unconsumed_tail or len(data) + self._inflated > self.max_message_size:
+                    raise FrameTooLargeException('Decompressed message exceeds {0} bytes'.format(self.max_message_size))
+            else:
+                data = self._decompressor.decompress(payload)
+        except zlib.error as excpt:
+            raise WebSocketError('Invalid compressed payload: {0}'.format(excpt))
+        self._inflated += len(data)
+        if fin:
+            self._inflated = 0
+            if self.client_no_context_takeover:
+                self._decompressor = None
+        return data
@@ -3,6 +3,8 @@ import six
 import base64
 import select
 import logging
+import weakref
+import itertools
 from hashlib import sha1
 from wsgiref import util
 import django
@@ -15,12 +17,18 @@ try:
 except ModuleNotFoundError as e:
     import socketserver
 from django.utils.encoding import force_str
+from ws4redis import settings as private_settings
+from ws4redis.compression import PerMessageDeflate
+from ws4redis.outbound import OutboundQueue
 from ws4redis.websocket import WebSocket
 from ws4redis.wsgi_server import WebsocketWSGIServer, HandshakeError, UpgradeRequiredError
 
 util._hoppish = {}.__contains__
 logger = logging.getLogger('django.request')
 
+# sockets taken over by a reactor, which must not be closed by the request thread
+_detached_sockets = weakref.WeakSet()
+
 
 class ServerHandler(_ServerHandler):
     http_version = str("1.1")
@@ -62,6 +70,15 @@ class WebsocketRunServer(WebsocketWSGIServer):
     WS_VERSIONS = ('13', '8', '7')
     protocol_version = "HTTP/1.1"
 
+    def __init__(self, redis_connection=None):
+        super(WebsocketRunServer, self).__init__(redis_connection)
+        self._reactors = []
+        self._reactor_counter = itertools.count()
+        if private_settings.WS4REDIS_REACTOR_THREADS:
+            from ws4redis.reactor import Reactor
+
+            self._reactors = [Reactor(self) for _ in range(private_settings.WS4REDIS_REACTOR_THREADS)]
+
     def upgrade_websocket(self, environ, start_response):
         """
         Attempt to upgrade the socket environ['wsgi.input'] into a websocket enabled connection.
@@ -94,6 +111,12 @@ class WebsocketRunServer(WebsocketWSGIServer):
         ]
         if environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL') is not None:
             headers.append(('Sec-WebSocket-Protocol', environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL')))
+        compression = None
+        if private_settings.WS4REDIS_PERMESSAGE_DEFLATE is not None:
+            compression, extensions = PerMessageDeflate.negotiate(
+                environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS'), private_settings.WS4REDIS_PERMESSAGE_DEFLATE)
+            if extensions:
+                headers.append(('Sec-WebSocket-Extensions', extensions))
 
         logger.debug('WebSocket request accepted, switching protocols')
         start_response(force_str('101 Switching Protocols'), headers)
@@ -102,12 +125,36 @@ class WebsocketRunServer(WebsocketWSGIServer):
             wsgi_input = environ['wsgi.input'].stream
         else:
             wsgi_input = environ['wsgi.input']
-        return WebSocket(wsgi_input)
+        outbound = None
+        if private_settings.WS4REDIS_OUTBOUND_QUEUE is not None:
+            outbound = OutboundQueue(**private_settings.WS4REDIS_OUTBOUND_QUEUE)
+        return WebSocket(wsgi_input, compression=compression, outbound=outbound)
+
+    def detach_websocket(self, websocket, subscriber, echo_message):
+        if not self._reactors:
+            return False
+        # distribute the websockets round robin over the reactors
+        reactor = self._reactors[next(self._reactor_counter) % len(self._reactors)]
+        _detached_sockets.add(websocket.stream._sock)
+        reactor.register(websocket, subscriber, echo_message)
+        return True
+
+    def drain(self, drain):
+        super(WebsocketRunServer, self).drain(drain)
+        for reactor in self._reactors:
+            reactor.drain()
 
     def select(self, rlist, wlist, xlist, timeout=None):
         return select.select(rlist, wlist, xlist, timeout)
 
 
+def shutdown_request(self, request):
+    if request in _detached_sockets:
+        # the socket is now owned by a reactor
+        return
+    WSGIServer.shutdown_request(self, request)
+
+
 def run(addr, port, wsgi_handler, ipv6=False, threading=False, **kwargs):
     """
     Function to monkey patch the internal Django command: manage.py runserver
@@ -116,10 +163,16 @@ def run(addr, port, wsgi_handler, ipv6=False, threading=False, **kwargs):
     server_address = (addr, port)
     if not threading:
         raise Exception("Django's Websocket server must run with threading enabled")
-    httpd_cls = type('WSGIServer', (socketserver.ThreadingMixIn, WSGIServer), {'daemon_threads': True})
+    httpd_cls = type('WSGIServer', (socketserver.ThreadingMixIn, WSGIServer), {
+        'daemon_threads': True,
+        'shutdown_request': shutdown_request,
+    })
     httpd = httpd_cls(server_address, WSGIRequestHandler, ipv6=ipv6)
     httpd.set_app(wsgi_handler)
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        _websocket_app.close()
 runserver.run = run
 
 
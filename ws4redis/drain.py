@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Graceful shutdown of the websocket servers of a process, closing their websockets one by one
+rather than all at once, so that restarting a worker does not cause a storm of reconnects.
+"""
+import os
+import json
+import random
+import logging
+import signal
+import threading
+import weakref
+import six
+from ws4redis import settings
+from ws4redis._compat import monotonic
+
+logger = logging.getLogger('django.request')
+
+
+class Drain(object):
+    """
+    Once started, the registered websocket servers stop accepting websockets and close the open
+    ones with status ``code``, spread evenly over ``window`` seconds. The reason of each close
+    frame tells the client to wait a random delay of up to ``reconnect_delay`` seconds, before
+    reconnecting. ``ws4redis.js`` honors this hint instead of its own backoff.
+
+    Draining is started by calling ``start``, by receiving the signal ``signal``, if given, or for
+    all processes through the management command ``ws4redis_drain``.
+    """
+    def __init__(self, window=30.0, code=1012, reconnect_delay=5.0, signal=None):
+        self.window = window
+        self.code = code
+        self.reconnect_delay = reconnect_delay
+        self.draining = False
+        self._servers = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._listening = None
+        if signal is not None:
+            self.install_signal_handler(signal)
+
+    def install_signal_handler(self, signum):
+        if isinstance(signum, six.string_types):
+            signum = getattr(signal, signum)
+
+        def handler(signum, frame):
+            # leave the signal handler at once, the lock may be held by the interrupted code
+            threading.Thread(target=self.start, name='ws4redis-drain').start()
+
+        try:
+            signal.signal(signum, handler)
+        except ValueError:
+            logger.warning('Drain: signals can only be handled by the main thread')
+
+    def register(self, server):
+        """
+        Add a websocket server, which is drained, once draining starts.
+        """
+        self._servers.add(server)
+        if self.draining:
+            server.drain(self)
+
+    def listen(self):
+        """
+        Subscribe to the channel on which the management command requests to drain, unless this
+        process already did so.
+        """
+        from ws4redis.multiplexer import get_control_multiplexer
+
+        with self._lock:
+            if self._listening == os.getpid():
+                return
+            self._listening = os.getpid()
+        channel = get_drain_channel()
+        get_control_multiplexer(channel).subscribe(self, [channel])
+
+    def deliver(self, frame):
+        """
+        Called by the multiplexer with each request published on the drain channel.
+        """
+        self.start(**json.loads(frame.message.decode('utf-8')))
+
+    def start(self, window=None, code=None):
+        """
+        Start draining the registered websocket servers, optionally overriding the configured
+        ``window`` and status ``code``.
+        """
+        with self._lock:
+            if self.draining:
+                return
+            self.draining = True
+            if window is not None:
+                self.window = window
+            if code is not None:
+                self.code = code
+        logger.info('Drain: closing all websockets within {0} seconds'.format(self.window))
+        for server in list(self._servers):
+            server.drain(self)
+
+    def schedule(self, websockets):
+        """
+        Returns a dictionary mapping each of ``websockets`` onto the time at which it shall be
+        closed. These times are spread evenly over the window, in random order.
+        """
+        websockets = list(websockets)
+        random.shuffle(websockets)
+        step = float(self.window) / max(len(websockets), 1)
+        now = monotonic()
+        return dict((websocket, now + index * step) for index, websocket in enumerate(websockets))
+
+    def get_close_reason(self):
+        """
+        Returns the reason of a close frame, telling the client how many milliseconds to wait,
+        before reconnecting.
+        """
+        return 'reconnect-delay={0}'.format(int(random.uniform(0, self.reconnect_delay) * 1000))
+
+
+def get_drain_channel():
+    from ws4redis.redis_store import RedisStore
+
+    return '{0}control:drain'.format(RedisStore.get_prefix())
+
+
+def request_drain(window=None, code=None):
+    """
+    Ask all websocket processes to start draining.
+
+    :returns: The number of processes which received the request.
+    """
+    from ws4redis.publisher import RedisPublisher
+
+    options = dict((key, value) for key, value in (('window', window), ('code', code)) if value is not None)
+    return RedisPublisher()._connection.publish(get_drain_channel(), json.dumps(options))
+
+
+drain = None
+if settings.WS4REDIS_DRAIN is not None:
+    drain = Drain(**settings.WS4REDIS_DRAIN)
@@ -25,3 +25,18 @@ class UpgradeRequiredError(HandshakeError):
     """
     Raised if protocol must be upgraded.
     """
+
+
+class DrainingError(HandshakeError):
+    """
+    Raised if a websocket is requested, while the server is draining.
+    """
+
+
+class SlowConsumerError(WebSocketError):
+    """
+    Raised if a client does not drain its outbound queue and shall be disconnected.
+    """
+    def __init__(self, code, message='Slow consumer'):
+        super(SlowConsumerError, self).__init__(message)
+        self.code = code
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Process local cache, resolving session keys to the identity of their owner, so that the handshake
+of a returning client neither loads its session nor its user.
+"""
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from ws4redis import settings
+from ws4redis._compat import monotonic
+
+"""
+The username of the logged in user, or None for anonymous sessions, and the names of the groups
+the user belongs to.
+"""
+Identity = namedtuple('Identity', ['username', 'groups'])
+
+
+class IdentityCache(object):
+    """
+    Maps session keys onto their ``Identity``. At most ``maxsize`` entries are kept, evicting the
+    least recently used ones, and each entry expires ``ttl`` seconds after it has been added.
+
+    Entries are invalidated on logout and whenever a session key is rotated on login. Since these
+    events usually happen in another process, they are published on a Redis channel, to which
+    the cache of each websocket process listens.
+    """
+    def __init__(self, maxsize=10000, ttl=300, clock=monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listening = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_key):
+        """
+        Returns the cached ``Identity`` for ``session_key``, or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(session_key, None)
+            if entry is None or entry[0] < self.clock():
+                return None
+            # reinsert, to mark the entry as recently used
+            self._entries[session_key] = entry
+            return entry[1]
+
+    def set(self, session_key, identity):
+        with self._lock:
+            self._entries.pop(session_key, None)
+            self._entries[session_key] = (self.clock() + self.ttl, identity)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *session_keys):
+        with self._lock:
+            for session_key in session_keys:
+                self._entries.pop(session_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def listen(self):
+        """
+        Subscribe to the channel on which invalidated session keys are published, unless this
+        process already did so.
+        """
+        from ws4redis.multiplexer import get_control_multiplexer
+
+        with self._lock:
+            if self._listening == os.getpid():
+                return
+            self._listening = os.getpid()
+        channel = get_invalidation_channel()
+        get_control_multiplexer(channel).subscribe(self, [channel])
+
+    def deliver(self, frame):
+        """
+        Called by the multiplexer with each session key published on the invalidation channel.
+        """
+        self.invalidate(frame.message.decode('utf-8'))
+
+
+class CachedUser(object):
+    """
+    Stands in for the user of a cached ``Identity``. Attributes other than the username and the
+    groups are looked up on the real user, which then is loaded through ``load_user``.
+    """
+    def __init__(self, identity, load_user):
+        self.identity = identity
+        self._load_user = load_user
+        self._user = None
+
+    @property
+    def is_authenticated(self):
+        return self.identity.username is not None
+
+    @property
+    def is_anonymous(self):
+        return self.identity.username is None
+
+    @property
+    def groups(self):
+        return list(self.identity.groups)
+
+    def get_username(self):
+        return self.identity.username
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._user is None:
+            self._user = self._load_user()
+        return getattr(self._user, name)
+
+
+def get_invalidation_channel():
+    from ws4redis.redis_store import RedisStore
+
+    return '{0}identity:invalidate'.format(RedisStore.get_prefix())
+
+
+def invalidate_sessions(*session_keys):
+    """
+    Remove ``session_keys`` from the identity cache of this and of all websocket processes.
+    """
+    from ws4redis.publisher import RedisPublisher
+
+    session_keys = [key for key in session_keys if key]
+    if identity_cache is None or not session_keys:
+        return
+    identity_cache.invalidate(*session_keys)
+    connection = RedisPublisher()._connection
+    channel = get_invalidation_channel()
+    for session_key in session_keys:
+        connection.publish(channel, session_key)
+
+
+identity_cache = None
+if settings.WS4REDIS_IDENTITY_CACHE is not None:
+    identity_cache = IdentityCache(**settings.WS4REDIS_IDENTITY_CACHE)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from ws4redis.drain import request_drain
+
+
+class Command(BaseCommand):
+    help = "Drain all websocket processes, before restarting them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, default=None,
+                            help="Number of seconds over which the websockets are closed.")
+        parser.add_argument('--code', type=int, default=None,
+                            help="Status code of the close frames, such as 1001 or 1012.")
+
+    def handle(self, *args, **options):
+        receivers = request_drain(window=options['window'], code=options['code'])
+        self.stdout.write("Requested {0} websocket processes to drain.".format(receivers))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Process wide counters and histograms, which can be polled by a monitoring system, for instance to
+alert on websocket clients unable to keep up with the rate of published messages.
+"""
+import threading
+from collections import defaultdict
+from ws4redis._compat import monotonic
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_histograms = defaultdict(lambda: defaultdict(int))
+
+
+def increment(name, value=1):
+    """
+    Add ``value`` to the counter named ``name``.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def get_counters():
+    """
+    Returns a snapshot of all counters as a dictionary.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def observe(name, value):
+    """
+    Count ``value`` in the histogram named ``name``. Values are grouped into buckets, whose upper
+    bounds are powers of two.
+    """
+    bound = 1
+    while bound < value:
+        bound <<= 1
+    with _lock:
+        _histograms[name][bound] += 1
+
+
+def get_histograms():
+    """
+    Returns a snapshot of all histograms as a dictionary, mapping each name to a sorted list of
+    tuples ``(upper_bound, count)``.
+    """
+    with _lock:
+        return dict((name, sorted(buckets.items())) for name, buckets in _histograms.items())
+
+
+class Stopwatch(object):
+    """
+    Measures consecutive stages of an operation, such as the handshake of a websocket. Each lap
+    records the microseconds elapsed since the previous lap in the histogram ``<prefix>.<stage>``.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lapped_at = monotonic()
+
+    def lap(self, stage):
+        now = monotonic()
+        observe('{0}.{1}'.format(self.prefix, stage), int((now - self.lapped_at) * 1000000))
+        self.lapped_at = now
+
+
+def reset():
+    """
+    Set all counters and histograms back to zero.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
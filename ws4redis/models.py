@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-from django.contrib.auth.signals import user_logged_in
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.dispatch import receiver
+from ws4redis.identity import invalidate_sessions
 
 
 @receiver(user_logged_in)
@@ -12,3 +14,22 @@ def store_groups_in_session(sender, user, request, **kwargs):
     """
     if hasattr(user, 'groups'):
         request.session['ws4redis:memberof'] = [g.name for g in user.groups.all()]
+
+
+@receiver(user_logged_in)
+def invalidate_rotated_identity(sender, request, **kwargs):
+    """
+    When a user logs in, its session key is rotated. Invalidate the identity cached for the key of
+    the session cookie, but not for the new one: nothing can be cached under it yet, and since the
+    invalidation is delivered asynchronously, it might evict the identity of the next handshake.
+    """
+    invalidate_sessions(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+
+
+@receiver(user_logged_out)
+def invalidate_cached_identity(sender, request, **kwargs):
+    """
+    When a user logs out, invalidate the identity cached for its session.
+    """
+    session = getattr(request, 'session', None)
+    invalidate_sessions(session and session.session_key)
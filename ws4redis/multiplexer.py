@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import time
+import select
+import logging
+import threading
+from redis import StrictRedis
+from redis.exceptions import ConnectionError, TimeoutError
+from ws4redis import settings
+from ws4redis.cluster import ShardedRedis, cluster_connection
+from ws4redis.redis_store import RedisMessage, split_sequence
+from ws4redis.websocket import PreparedFrame
+
+logger = logging.getLogger('django.request')
+
+_multiplexers = {}
+_multiplexers_lock = threading.Lock()
+_control_connection = None
+
+
+def get_multiplexer(connection, channel):
+    """
+    Returns the process wide ``RedisMultiplexer`` responsible for ``channel``. The pool of
+    multiplexers is created lazily and recreated after a fork, so that each worker process owns
+    its own PubSub connections. For a ``ShardedRedis`` connection, there is a pool for each node,
+    subscribing to the channels whose hash slots the node owns.
+    """
+    sharded = False
+    if isinstance(connection, ShardedRedis):
+        sharded = connection.sharded
+        connection = connection.get_node(channel)
+    key = (os.getpid(), id(connection))
+    with _multiplexers_lock:
+        pool = _multiplexers.get(key)
+        if pool is None:
+            for stale in [k for k in _multiplexers if k[0] != key[0]]:
+                del _multiplexers[stale]
+            size = max(int(settings.WS4REDIS_MULTIPLEXER_POOL_SIZE), 1)
+            pool = _multiplexers[key] = [RedisMultiplexer(connection, sharded) for _ in range(size)]
+    if len(pool) == 1:
+        return pool[0]
+    if not isinstance(channel, bytes):
+        channel = channel.encode('utf-8')
+    return pool[zlib.crc32(channel) % len(pool)]
+
+
+def get_control_multiplexer(channel):
+    """
+    Returns the multiplexer for ``channel``, which carries control messages to all websocket
+    processes, such as the invalidation of cached identities. Control channels share a Redis
+    connection of their own, rather than one of the websockets.
+    """
+    global _control_connection
+    with _multiplexers_lock:
+        if _control_connection is None:
+            _control_connection = cluster_connection or StrictRedis(**settings.WS4REDIS_CONNECTION)
+    return get_multiplexer(_control_connection, channel)
+
+
+class RedisMultiplexer(object):
+    """
+    Shares one Redis PubSub connection between all websockets of a worker process.
+
+    A reference counted index maps each channel onto its local listeners. The first listener
+    joining a channel causes a SUBSCRIBE, the last one leaving it an UNSUBSCRIBE. A daemon thread
+    reads from the PubSub connection, encodes each received message once into a
+    ``PreparedFrame`` and fans it out to the ``deliver`` method of every listener of that channel.
+    If ``sharded`` is set, channels are subscribed through SSUBSCRIBE.
+    """
+    def __init__(self, connection, sharded=False):
+        self._pubsub = connection.pubsub()
+        self._sharded = sharded
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def _normalize(channel):
+        if isinstance(channel, bytes):
+            return channel
+        return channel.encode('utf-8')
+
+    def subscribe(self, listener, channels):
+        """
+        Add ``listener`` to each of the given ``channels``.
+        """
+        with self._lock:
+            new_channels = []
+            for channel in channels:
+                channel = self._normalize(channel)
+                listeners = self._listeners.get(channel)
+                if listeners is None:
+                    listeners = self._listeners[channel] = set()
+                    new_channels.append(channel)
+                listeners.add(listener)
+            if new_channels and self._sharded:
+                self._pubsub.ssubscribe(*new_channels)
+            elif new_channels:
+                self._pubsub.subscribe(*new_channels)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name='ws4redis-multiplexer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def unsubscribe(self, listener, channels):
+        """
+        Remove ``listener`` from each of the given ``channels``.
+        """
+        with self._lock:
+            old_channels = []
+            for channel in channels:
+                channel = self._normalize(channel)
+                listeners = self._listeners.get(channel)
+                if listeners is None:
+                    continue
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[channel]
+                    old_channels.append(channel)
+            if old_channels and self._sharded:
+                self._pubsub.sunsubscribe(*old_channels)
+            elif old_channels:
+                self._pubsub.unsubscribe(*old_channels)
+
+    def get_file_descriptor(self):
+        connection = self._pubsub.connection
+        return connection and connection._sock and connection._sock.fileno()
+
+    def _listen(self):
+        # seconds to wait before retrying, after the connection failed
+        backoff = 0
+        while True:
+            with self._lock:
+                if not self._listeners:
+                    self._thread = None
+                    return
+                fd = self.get_file_descriptor()
+            try:
+                if not fd:
+                    raise ConnectionError('PubSub connection is not established')
+                select.select([fd], [], [], 1.0)
+                self._read_responses()
+                backoff = 0
+            except Exception as excpt:
+                logger.error('RedisMultiplexer: {}'.format(excpt))
+                backoff = min(backoff * 2 or 0.1, 5.0)
+                time.sleep(backoff)
+                if isinstance(excpt, (ConnectionError, TimeoutError)):
+                    self._reconnect()
+
+    def _reconnect(self):
+        """
+        Connect the PubSub connection again, which then subscribes to all of its channels.
+        """
+        with self._lock:
+            connection = self._pubsub.connection
+            if not connection:
+                return
+            connection.disconnect()
+            try:
+                connection.connect()
+            except (ConnectionError, TimeoutError) as excpt:
+                logger.warning('RedisMultiplexer: reconnecting failed: {}'.format(excpt))
+
+    def _read_responses(self):
+        with self._lock:
+            connection = self._pubsub.connection
+            if not connection:
+                return
+            responses = []
+            while connection.can_read(timeout=0):
+                responses.append(self._pubsub.parse_response(block=True))
+            # snapshot the listeners while holding the lock, deliver without it
+            deliveries = []
+            for response in responses:
+                if response and len(response) >= 3 and response[0] in (b'message', 'message', b'smessage', 'smessage'):
+                    listeners = self._listeners.get(self._normalize(response[1]))
+                    if listeners:
+                        deliveries.append((response, list(listeners)))
+        for response, listeners in deliveries:
+            # encode the websocket frame once and share it between all local recipients
+            seq, message = split_sequence(RedisMessage(response))
+            if not message:
+                continue
+            frame = PreparedFrame(message, channel=response[1], seq=seq)
+            for listener in listeners:
+                listener.deliver(frame)
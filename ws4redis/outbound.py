@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import logging
+import select
+from collections import deque
+from ws4redis import metrics
+from ws4redis._compat import monotonic
+from ws4redis.exceptions import SlowConsumerError
+
+logger = logging.getLogger('django.request')
+
+
+class OutboundQueue(object):
+    """
+    Frames waiting to be written to a websocket, whose client does not drain its socket as fast
+    as messages are published.
+
+    Frames are written without blocking, whatever the socket does not accept, remains queued until
+    it becomes writable again. Once the queued frames would exceed ``high_water_mark`` bytes, the
+    connection is considered a slow consumer and ``policy`` decides what happens:
+
+    ``drop-oldest``
+        Discard the oldest queued frames until the new one fits.
+    ``drop-newest``
+        Discard the new frame.
+    ``keep-latest``
+        Discard all but the newest queued frame of each channel.
+    ``close-1008``, ``close-1013``
+        Close the websocket with status 1008 (policy violation) or 1013 (try again later).
+
+    Control frames and a frame which already has been written partially, are never discarded.
+    On close, the remainder of a partially written frame and the close frame are written in
+    blocking mode, waiting at most ``close_timeout`` seconds for the client.
+    """
+    policies = ('drop-oldest', 'drop-newest', 'keep-latest', 'close-1008', 'close-1013')
+
+    def __init__(self, high_water_mark=1024 * 1024, policy='drop-oldest', close_timeout=1.0):
+        if policy not in self.policies:
+            raise ValueError('Unknown slow consumer policy: {0}'.format(policy))
+        self.high_water_mark = high_water_mark
+        self.policy = policy
+        self.close_timeout = close_timeout
+        self.slow = False
+        # each entry is a list [channel, buffers, size, control]
+        self._frames = deque()
+        self._pending = 0
+        self._partial = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def pending(self):
+        """
+        Number of bytes waiting to be written.
+        """
+        return self._pending
+
+    def push(self, buffers, channel=None, control=False):
+        """
+        Append a frame consisting of ``buffers`` to the queue, applying the slow consumer policy
+        if the high water mark is exceeded.
+
+        :raises SlowConsumerError: if the policy demands to close the websocket.
+        """
+        size = sum(len(buf) for buf in buffers)
+        if self._frames and not control and self._pending + size > self.high_water_mark:
+            if not self._overflow(size, channel):
+                return
+        self._frames.append([channel, buffers, size, control])
+        self._pending += size
+
+    def _overflow(self, size, channel):
+        metrics.increment('outbound.slow_consumer_events')
+        if not self.slow:
+            self.slow = True
+            metrics.increment('outbound.slow_consumers')
+            logger.warning('Slow consumer: more than {0} bytes pending, applying policy {1}'.format(
+                self.high_water_mark, self.policy))
+        if self.policy.startswith('close-'):
+            metrics.increment('outbound.slow_consumer_closes')
+            raise SlowConsumerError(int(self.policy[6:]))
+        if self.policy == 'drop-newest':
+            self._discard([[channel, None, size, False]])
+            return False
+        droppable = self._droppable()
+        if self.policy == 'keep-latest':
+            latest = {channel: None}
+            for entry in reversed(droppable):
+                if entry[0] not in latest:
+                    latest[entry[0]] = entry
+            self._remove([entry for entry in droppable if latest.get(entry[0]) is not entry])
+        else:
+            excess = self._pending + size - self.high_water_mark
+            dropped = []
+            for entry in droppable:
+                if excess <= 0:
+                    break
+                dropped.append(entry)
+                excess -= entry[2]
+            self._remove(dropped)
+        return True
+
+    def _droppable(self):
+        frames = list(self._frames)
+        if self._partial:
+            frames = frames[1:]
+        return [entry for entry in frames if not entry[3]]
+
+    def _remove(self, entries):
+        if not entries:
+            return
+        ids = set(id(entry) for entry in entries)
+        self._frames = deque(entry for entry in self._frames if id(entry) not in ids)
+        self._pending -= sum(entry[2] for entry in entries)
+        self._discard(entries)
+
+    def _discard(self, entries):
+        metrics.increment('outbound.dropped_frames', len(entries))
+        metrics.increment('outbound.dropped_bytes', sum(entry[2] for entry in entries))
+
+    def clear(self):
+        """
+        Forget all queued frames, for instance because the websocket is about to be closed. A frame
+        which already has been written partially is kept, since any frame written next, such as
+        the close frame, must not be interleaved with its remaining bytes.
+        """
+        partial = self._frames[0] if self._partial else None
+        self._frames.clear()
+        self._pending = 0
+        if partial is not None:
+            self._frames.append(partial)
+            self._pending = partial[2]
+
+    def peek(self):
+        """
+        Returns the buffers of the first queued frame.
+        """
+        return self._frames[0][1]
+
+    def consume(self, count):
+        """
+        Remove ``count`` written bytes from the head of the queue.
+        """
+        while count:
+            entry = self._frames[0]
+            if count >= entry[2]:
+                count -= entry[2]
+                self._pending -= entry[2]
+                self._frames.popleft()
+                self._partial = False
+                continue
+            buffers = entry[1]
+            while count >= len(buffers[0]):
+                count -= len(buffers[0])
+                buffers = buffers[1:]
+            entry[1] = [memoryview(buffers[0])[count:]] + buffers[1:]
+            entry[2] -= count
+            self._pending -= count
+            self._partial = True
+            count = 0
+
+    def flush(self, stream):
+        """
+        Write as many queued frames to ``stream`` as the socket accepts without blocking.
+
+        :returns: True, if the queue has been drained completely.
+        """
+        while self._frames:
+            buffers = []
+            for entry in self._frames:
+                buffers.extend(entry[1])
+                if len(buffers) >= stream.max_iovecs:
+                    break
+            sent = stream.writev_nowait(buffers)
+            if not sent:
+                break
+            self.consume(sent)
+            if self._partial:
+                # the socket's send buffer is full
+                break
+        return not self._frames
+
+    def drain(self, stream, timeout):
+        """
+        Write the queued frames to ``stream``, waiting up to ``timeout`` seconds for the socket
+        to become writable.
+
+        :returns: True, if the queue has been drained completely.
+        """
+        deadline = monotonic() + timeout
+        while not self.flush(stream):
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not select.select([], [stream.fileno], [], remaining)[1]:
+                return False
+        return True
@@ -1,7 +1,9 @@
 #-*- coding: utf-8 -*-
 from redis import ConnectionPool, StrictRedis
-from ws4redis import settings
-from ws4redis.redis_store import RedisStore
+from ws4redis import settings, background
+from ws4redis.coalesce import get_publish_buffer
+from ws4redis.cluster import cluster_connection
+from ws4redis.redis_store import RedisStore, RedisMessage, split_sequence, get_channel_keys
 from ws4redis._compat import is_authenticated
 from redis.connection import (
     UnixDomainSocketConnection,
@@ -26,16 +28,133 @@ else:
     )
 
 
+def _audience_key(audience):
+    """
+    Returns an immutable snapshot of the ``audience`` dictionary, usable as dictionary key.
+    """
+    def freeze(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+        if isinstance(value, set):
+            return frozenset(value)
+        return value
+
+    return tuple(sorted((key, freeze(value)) for key, value in audience.items()))
+
+
 class RedisPublisher(RedisStore):
     def __init__(self, **kwargs):
         """
         Initialize the channels for publishing messages through the message queue.
         """
-        connection = StrictRedis(connection_pool=redis_connection_pool)
+        connection = cluster_connection or StrictRedis(connection_pool=redis_connection_pool)
         super(RedisPublisher, self).__init__(connection)
         for key in self._get_message_channels(**kwargs):
             self._publishers.add(key)
 
+    def publish_message(self, message, expire=None):
+        """
+        Publish a ``message`` on the channels of this publisher. Within a ``publish_on_commit``
+        block, the message is buffered instead, and an empty dictionary is returned.
+        """
+        if not self._buffer_message(message, expire):
+            return super(RedisPublisher, self).publish_message(message, expire)
+        return {}
+
+    def pipeline_publish_message(self, message, expire=None, transaction=True):
+        if not self._buffer_message(message, expire):
+            return super(RedisPublisher, self).pipeline_publish_message(message, expire, transaction)
+        return {}
+
+    def _buffer_message(self, message, expire):
+        """
+        Add ``message`` to the buffer of the current ``publish_on_commit`` block, if any.
+        """
+        buffer = get_publish_buffer()
+        if buffer is None:
+            return False
+        if not isinstance(message, RedisMessage):
+            raise ValueError('message object is not of type RedisMessage')
+        buffer.add(self._publishers, message, self._expire if expire is None else expire)
+        return True
+
+    def enqueue_message(self, message, expire=None, publisher=None):
+        """
+        Like publish_message, but hands the ``message`` over to the background ``publisher``,
+        which defaults to the one configured through ``WS4REDIS_BACKGROUND_PUBLISHER``, and
+        returns at once, without waiting for Redis. Returns False, if the queue was full and the
+        message has been dropped. Without a background publisher, the message is published
+        synchronously, or buffered within a ``publish_on_commit`` block.
+        """
+        if expire is None:
+            expire = self._expire
+        if not isinstance(message, RedisMessage):
+            raise ValueError('message object is not of type RedisMessage')
+        publisher = publisher or background.background_publisher
+        if publisher is None or get_publish_buffer() is not None:
+            self.publish_message(message, expire)
+            return True
+        return publisher.enqueue(list(self._publishers), message, expire)
+
+    def publish_many(self, messages, expire=None, chunk_size=1000):
+        """
+        Publish many messages, each to its own audience, in a few round trips to the Redis
+        datastore, by pipelining the scripts for about ``chunk_size`` channels at a time.
+        ``messages`` is an iterable of ``(message, audience)`` tuples, where ``audience`` is a
+        dictionary with the keyword arguments accepted by the constructor, for instance
+        ``{'facility': 'foobar', 'users': ['john', 'mary']}``. Identical messages addressed to the
+        same channel, are published only once.
+        Returns a dictionary mapping each channel onto the number of subscribers, which received
+        the last message published on it. Within a ``publish_on_commit`` block, the messages are
+        buffered instead, and an empty dictionary is returned.
+        """
+        if expire is None:
+            expire = self._expire
+        buffer = get_publish_buffer()
+        if buffer is not None:
+            for message, audience in messages:
+                if not isinstance(message, RedisMessage):
+                    message = RedisMessage(message)
+                if message:
+                    buffer.add(self._get_message_channels(**audience), message, expire)
+            return {}
+        receivers = {}
+        published = set()
+        audiences = {}
+        # the channels of each script queued in the pipeline
+        calls = []
+        pending = 0
+        pipeline = self._connection.pipeline(transaction=False)
+        for message, audience in messages:
+            if not isinstance(message, RedisMessage):
+                message = RedisMessage(message)
+            if not message:
+                continue
+            # audiences are often shared between messages, hence build their channels only once;
+            # they are keyed by content, since callers may mutate one dictionary between messages
+            key = _audience_key(audience)
+            audience_channels = audiences.get(key)
+            if audience_channels is None:
+                audience_channels = audiences[key] = self._get_message_channels(**audience)
+            channels = []
+            for channel in audience_channels:
+                if (channel, message) not in published:
+                    published.add((channel, message))
+                    channels.append(channel)
+            # the message is sent once for all of its channels of the same hash slot
+            for group in self._get_slot_groups(channels):
+                self._eval_publish(group, message, expire, client=pipeline)
+                calls.append(group)
+                pending += len(group)
+            if pending >= chunk_size:
+                for group, counts in zip(calls, pipeline.execute()):
+                    receivers.update(zip(group, counts))
+                calls, pending = [], 0
+        if calls:
+            for group, counts in zip(calls, pipeline.execute()):
+                receivers.update(zip(group, counts))
+        return receivers
+
     def fetch_message(self, request, facility, audience='any'):
         """
         Fetch the first message available for the given ``facility`` and ``audience``, if it has
@@ -46,25 +165,23 @@ class RedisPublisher(RedisStore):
         ``group``, ``user``, ``session`` or ``any``. The default is ``any``, which means to check
         for all possible audiences.
         """
-        prefix = self.get_prefix()
+        keys = get_channel_keys(self.get_prefix(), facility)
         channels = []
         if audience in ('session', 'any',):
             if request and request.session:
-                channels.append('{prefix}session:{0}:{facility}'.format(request.session.session_key, prefix=prefix, facility=facility))
+                channels.extend(keys.sessions([request.session.session_key]))
         if audience in ('user', 'any',):
             if is_authenticated(request):
-                channels.append('{prefix}user:{0}:{facility}'.format(request.user.get_username(), prefix=prefix, facility=facility))
+                channels.extend(keys.users([request.user.get_username()]))
         if audience in ('group', 'any',):
             try:
                 if is_authenticated(request):
-                    groups = request.session['ws4redis:memberof']
-                    channels.extend('{prefix}group:{0}:{facility}'.format(g, prefix=prefix, facility=facility)
-                                for g in groups)
+                    channels.extend(keys.groups(request.session['ws4redis:memberof']))
             except (KeyError, AttributeError):
                 pass
         if audience in ('broadcast', 'any',):
-            channels.append('{prefix}broadcast:{facility}'.format(prefix=prefix, facility=facility))
-        for channel in channels:
-            message = self._connection.get(channel)
+            channels.append(keys.broadcast)
+        for value in self._connection.mget(channels) if channels else ():
+            message = split_sequence(value)[1]
             if message:
                 return message
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+import selectors
+import threading
+from collections import deque
+from ws4redis import settings as private_settings
+from ws4redis._compat import monotonic
+from ws4redis.exceptions import FrameTooLargeException
+from ws4redis.outbound import OutboundQueue
+from ws4redis.redis_store import RedisMessage
+from ws4redis.timerwheel import TimerWheel
+
+logger = logging.getLogger('django.request')
+
+# kinds of file descriptors registered for each connection
+_WEBSOCKET, _REDIS = 1, 2
+
+
+class Connection(object):
+    """
+    The state of one websocket served by a ``Reactor``.
+    """
+    __slots__ = ('websocket', 'subscriber', 'echo_message', 'recvmsg', 'sock', 'websocket_fd',
+                 'redis_fd', 'events', 'sent_at', 'active_at', 'timers')
+
+    def __init__(self, websocket, subscriber, echo_message):
+        self.websocket = websocket
+        self.subscriber = subscriber
+        self.echo_message = echo_message
+        self.recvmsg = None
+        self.sock = websocket.stream._sock
+        self.websocket_fd = websocket.get_file_descriptor()
+        self.redis_fd = subscriber.get_file_descriptor()
+        self.events = 0
+        self.sent_at = self.active_at = monotonic()
+        self.timers = []
+
+
+class Reactor(object):
+    """
+    Serves the websockets handed over by the request threads of the development server from a
+    single thread, using the most efficient selector of the platform, such as epoll or kqueue.
+
+    Reads never block: Whatever the socket offers is appended to the stream's buffer, and a
+    message is read only after it has been buffered completely. Writes are queued in the
+    websocket's outbound queue, and the socket is watched for writability only while that queue
+    is not empty. Heartbeats, keepalive pings and idle timeouts are kept in a timing wheel, so
+    that an idle connection costs no more than its buffers and a few small objects, and the
+    reactor only wakes up on I/O or on an expired deadline.
+    """
+    def __init__(self, server):
+        self.server = server
+        self._selector = selectors.DefaultSelector()
+        self._handovers = deque()
+        # set, when the server starts draining
+        self._drain_pending = False
+        self._timers = TimerWheel()
+        # connections whose last batch read from Redis has been cut short
+        self._backlogged = set()
+        self._wakeup_fds = os.pipe()
+        for fd in self._wakeup_fds:
+            os.set_blocking(fd, False)
+        self._selector.register(self._wakeup_fds[0], selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self.run, name='ws4redis-reactor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, websocket, subscriber, echo_message):
+        """
+        Hand ``websocket`` over to the reactor. This method is called from the request threads.
+        """
+        if websocket.outbound is None:
+            # writes must not block the reactor
+            websocket.outbound = OutboundQueue(**(private_settings.WS4REDIS_OUTBOUND_QUEUE or {}))
+        self._handovers.append(Connection(websocket, subscriber, echo_message))
+        self._wakeup()
+
+    def drain(self):
+        """
+        Close the websockets at the times scheduled by the server, which drains. This method is
+        called from any thread.
+        """
+        self._drain_pending = True
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_fds[1], b'x')
+        except BlockingIOError:
+            # the reactor has not yet consumed the previous wakeups
+            pass
+
+    def run(self):
+        while True:
+            timeout = 0 if self._backlogged else self._timers.timeout()
+            for key, events in self._selector.select(timeout):
+                if key.data is None:
+                    self._accept_handovers()
+                    continue
+                connection, kind = key.data
+                try:
+                    if kind == _REDIS:
+                        self._read_redis(connection)
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            connection.websocket.flush()
+                        if events & selectors.EVENT_READ:
+                            self._read_websocket(connection)
+                    self._update(connection)
+                except FrameTooLargeException as excpt:
+                    logger.info('Reactor: {0}'.format(excpt))
+                    self.close(connection, 1009)
+                except Exception as excpt:
+                    logger.error('Reactor: {0}'.format(excpt), exc_info=True)
+                    self.close(connection)
+            for connection in list(self._backlogged):
+                if connection not in self._backlogged:
+                    # closed meanwhile
+                    continue
+                # responses received from Redis are buffered, hence the socket may not be readable
+                try:
+                    self._read_redis(connection, block=False)
+                    self._update(connection)
+                except Exception as excpt:
+                    logger.error('Reactor: {0}'.format(excpt), exc_info=True)
+                    self.close(connection)
+            self._timers.advance()
+
+    def _accept_handovers(self):
+        try:
+            while os.read(self._wakeup_fds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        if self._drain_pending:
+            self._drain_pending = False
+            for key in list(self._selector.get_map().values()):
+                if key.data is not None and key.data[1] == _WEBSOCKET:
+                    self._schedule_close(key.data[0])
+        while self._handovers:
+            connection = self._handovers.popleft()
+            connection.sock.setblocking(False)
+            if connection.redis_fd:
+                self._selector.register(connection.redis_fd, selectors.EVENT_READ, (connection, _REDIS))
+            if private_settings.WS4REDIS_HEARTBEAT:
+                self._schedule(connection, 4.0, self._heartbeat)
+            if private_settings.WS4REDIS_KEEPALIVE is not None:
+                self._schedule(connection, 0, self._keepalive)
+            if private_settings.WS4REDIS_IDLE_TIMEOUT:
+                self._schedule(connection, private_settings.WS4REDIS_IDLE_TIMEOUT, self._idle_timeout)
+            self._schedule_close(connection)
+            try:
+                # frames may have been buffered while upgrading the connection
+                self._read_messages(connection)
+                self._update(connection)
+            except Exception as excpt:
+                logger.error('Reactor: {0}'.format(excpt), exc_info=True)
+                self.close(connection)
+
+    def _read_websocket(self, connection):
+        received = connection.websocket.stream.fill()
+        if received == 0:
+            # the client closed the connection
+            connection.websocket.close(1001, 'Websocket Closed')
+        elif received:
+            self._read_messages(connection)
+
+    def _read_messages(self, connection):
+        websocket = connection.websocket
+        while not websocket.closed and websocket.message_buffered:
+            message = websocket.receive()
+            if message is not None:
+                connection.recvmsg = RedisMessage(message)
+                connection.active_at = monotonic()
+                if connection.recvmsg:
+                    connection.subscriber.publish_message(connection.recvmsg)
+
+    def _read_redis(self, connection, block=True):
+        frames, backlogged = self.server.receive_frames(
+            connection.subscriber, connection.echo_message, connection.recvmsg, block)
+        if backlogged:
+            self._backlogged.add(connection)
+        else:
+            self._backlogged.discard(connection)
+        if frames:
+            connection.websocket.send_prepared_batch(frames)
+            connection.sent_at = connection.active_at = monotonic()
+
+    def _update(self, connection):
+        """
+        Adjust the events watched on the websocket, or release the connection, after the
+        websocket has been closed.
+        """
+        websocket = connection.websocket
+        if websocket.closed:
+            self.close(connection)
+            return
+        events = selectors.EVENT_READ
+        if websocket.pending:
+            events |= selectors.EVENT_WRITE
+        if events != connection.events:
+            if connection.events:
+                self._selector.modify(connection.websocket_fd, events, (connection, _WEBSOCKET))
+            else:
+                self._selector.register(connection.websocket_fd, events, (connection, _WEBSOCKET))
+            connection.events = events
+
+    def _schedule(self, connection, delay, callback):
+        """
+        Call ``callback(connection)`` after ``delay`` seconds, unless the connection is closed.
+        """
+        connection.timers = [timer for timer in connection.timers if timer.active]
+        connection.timers.append(self._timers.schedule(delay, self._expire, connection, callback))
+
+    def _expire(self, connection, callback):
+        if connection.websocket.closed:
+            return
+        try:
+            callback(connection)
+            self._update(connection)
+        except Exception as excpt:
+            logger.error('Reactor: {0}'.format(excpt), exc_info=True)
+            self.close(connection)
+
+    def _heartbeat(self, connection):
+        # the heartbeat is due, after nothing has been sent for 4 seconds
+        delay = connection.sent_at + 4.0 - monotonic()
+        if delay <= 0:
+            connection.websocket.send(private_settings.WS4REDIS_HEARTBEAT)
+            connection.sent_at = monotonic()
+            delay = 4.0
+        self._schedule(connection, delay, self._heartbeat)
+
+    def _keepalive(self, connection):
+        delay = connection.websocket.keepalive(**private_settings.WS4REDIS_KEEPALIVE)
+        if not connection.websocket.closed:
+            self._schedule(connection, delay, self._keepalive)
+
+    def _idle_timeout(self, connection):
+        delay = connection.active_at + private_settings.WS4REDIS_IDLE_TIMEOUT - monotonic()
+        if delay <= 0:
+            logger.info('Reactor: closing websocket after {0} seconds without any message'.format(
+                private_settings.WS4REDIS_IDLE_TIMEOUT))
+            connection.websocket.close(1001, 'Idle timeout')
+        else:
+            self._schedule(connection, delay, self._idle_timeout)
+
+    def _schedule_close(self, connection):
+        """
+        Close the connection at the time scheduled by the server, if it drains.
+        """
+        deadline = self.server.get_drain_deadline(connection.websocket)
+        if deadline is not None:
+            self._schedule(connection, max(deadline - monotonic(), 0), self._close_drained)
+
+    def _close_drained(self, connection):
+        self.server.close_drained(connection.websocket)
+
+    def close(self, connection, code=1001):
+        """
+        Close the websocket, release its subscriber and the underlying socket.
+        """
+        for fd in (connection.websocket_fd, connection.redis_fd):
+            try:
+                self._selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+        connection.events = 0
+        self._backlogged.discard(connection)
+        for timer in connection.timers:
+            timer.cancel()
+        connection.timers = []
+        websocket = connection.websocket
+        if not websocket.closed:
+            websocket.close(code, 'Websocket Closed')
+        connection.subscriber.release()
+        self.server.websockets.discard(websocket)
+        connection.sock.close()
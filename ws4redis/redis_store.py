@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import six
 import warnings
+from collections import OrderedDict
 from ws4redis import settings
 from ws4redis._compat import is_authenticated
+from ws4redis.cluster import ShardedRedis
+from ws4redis.identity import CachedUser
 
 
 """
@@ -11,6 +14,55 @@ or as a group.
 """
 SELF = type('SELF_TYPE', (object,), {})()
 
+"""
+Lua script publishing a message on many channels, so that the message is sent to Redis only once.
+KEYS are the channels, ARGV the message, the expiry of the persisted message and the command to
+publish with. Returns the number of receivers for each channel.
+"""
+PUBLISH_MESSAGE = """
+local counts = {}
+for i, channel in ipairs(KEYS) do
+    if tonumber(ARGV[2]) > 0 then
+        redis.call('SETEX', channel, ARGV[2], ARGV[1])
+    end
+    counts[i] = redis.call(ARGV[3], channel, ARGV[1])
+end
+return counts
+"""
+
+"""
+Lua script publishing a message on many channels, each with its next sequence number, so that
+numbering, appending to the stream and publishing are atomic. KEYS are triples of a channel, its
+stream and its counter, ARGV the message, the approximate length and the expiry of the streams,
+the expiry of the persisted message and the command to publish with. The counter does not expire
+with the stream, so that a client resuming after both expired, does not hold a higher number than
+the messages published next. Returns the number of receivers for each channel.
+"""
+PUBLISH_SEQUENCED = """
+local counts = {}
+for i = 1, #KEYS, 3 do
+    local seq = redis.call('INCR', KEYS[i + 2])
+    if seq == 1 then
+        -- continue the numbering of a stream created before its counter
+        local last = redis.call('XREVRANGE', KEYS[i + 1], '+', '-', 'COUNT', 1)[1]
+        if last then
+            seq = tonumber(string.match(last[1], '-(%d+)$')) + 1
+            redis.call('SET', KEYS[i + 2], seq)
+        end
+    end
+    redis.call('XADD', KEYS[i + 1], 'MAXLEN', '~', ARGV[2], '0-' .. seq, 'message', ARGV[1])
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('EXPIRE', KEYS[i + 1], ARGV[3])
+    end
+    local payload = seq .. '|' .. ARGV[1]
+    if tonumber(ARGV[4]) > 0 then
+        redis.call('SETEX', KEYS[i], ARGV[4], payload)
+    end
+    counts[#counts + 1] = redis.call(ARGV[5], KEYS[i], payload)
+end
+return counts
+"""
+
 
 def _wrap_users(users, request):
     """
@@ -26,6 +78,16 @@ def _wrap_users(users, request):
     return result
 
 
+def _get_memberof(request):
+    """
+    Returns the groups of the current logged in user, taken from the identity cache, if the
+    handshake resolved the user through it, otherwise from the session store.
+    """
+    if isinstance(request.user, CachedUser):
+        return request.user.groups
+    return request.session.get('ws4redis:memberof', [])
+
+
 def _wrap_groups(groups, request):
     """
     Returns a list of groups for the given list of groups and/or the current logged in user, if
@@ -38,7 +100,7 @@ def _wrap_groups(groups, request):
     result = set()
     for g in groups:
         if g is SELF and is_authenticated(request):
-            result.update(request.session.get('ws4redis:memberof', []))
+            result.update(_get_memberof(request))
         else:
             result.add(g)
     return result
@@ -74,18 +136,94 @@ class RedisMessage(six.binary_type):
                 if settings.WS4REDIS_HEARTBEAT is None or value != settings.WS4REDIS_HEARTBEAT.encode():
                     return super(RedisMessage, cls).__new__(cls, value)
             elif isinstance(value, list):
-                if len(value) >= 2 and value[0] == b'message':
+                if len(value) >= 2 and value[0] in (b'message', b'smessage'):
                     return super(RedisMessage, cls).__new__(cls, value[2])
         else:
             if isinstance(value, (six.string_types, bytearray)):
                 if value != settings.WS4REDIS_HEARTBEAT:
                     return six.binary_type.__new__(cls, value)
             elif isinstance(value, list):
-                if len(value) >= 2 and value[0] == 'message':
+                if len(value) >= 2 and value[0] in ('message', 'smessage'):
                     return six.binary_type.__new__(cls, value[2])
         return None
 
 
+def split_sequence(message):
+    """
+    Returns the sequence number, which ``RedisStore.publish_message`` prepends to messages if
+    ``WS4REDIS_STREAM`` is set, and the message without it. The sequence number is None for
+    messages published without one.
+    """
+    if settings.WS4REDIS_STREAM is not None and message:
+        pos = message.find(b'|', 0, 21)
+        if pos > 0 and message[:pos].isdigit():
+            return int(message[:pos]), RedisMessage(message[pos + 1:])
+    return None, message
+
+
+def get_stream_sequence(entry_id):
+    """
+    Returns the sequence number of a stream entry, which is the second part of its ID.
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('ascii')
+    return int(entry_id.split('-')[1])
+
+
+class ChannelKeys(object):
+    """
+    Builds the channel keys of one facility. The templates are prepared once, and each key is
+    built only once and then shared, as long as no more than ``maxsize`` keys are kept per kind
+    of audience. Keys are kept here, rather than interned by Python, since session keys come and go.
+    """
+    maxsize = 10000
+
+    def __init__(self, prefix, facility):
+        self.broadcast = '{0}broadcast:{1}'.format(prefix, facility)
+        # the parts of each key preceding and following the name of the group, user or session
+        self._templates = dict((kind, ('{0}{1}:'.format(prefix, kind), ':{0}'.format(facility)))
+                               for kind in ('group', 'user', 'session'))
+        self._keys = dict((kind, {}) for kind in self._templates)
+
+    def _build(self, kind, names):
+        keys = self._keys[kind]
+        result = []
+        for name in names:
+            key = keys.get(name)
+            if key is None:
+                if len(keys) >= self.maxsize:
+                    keys.clear()
+                key = keys[name] = '{0}{1}{2}'.format(self._templates[kind][0], name, self._templates[kind][1])
+            result.append(key)
+        return result
+
+    def groups(self, names):
+        return self._build('group', names)
+
+    def users(self, names):
+        return self._build('user', names)
+
+    def sessions(self, session_keys):
+        return self._build('session', session_keys)
+
+
+_channel_keys = {}
+
+
+def get_channel_keys(prefix, facility):
+    """
+    Returns the ``ChannelKeys`` of ``facility``, whose keys start with ``prefix``.
+    """
+    key = (prefix, facility)
+    keys = _channel_keys.get(key)
+    if keys is None:
+        if len(_channel_keys) >= ChannelKeys.maxsize:
+            # facilities are taken from the request path, hence bound their number
+            _channel_keys.clear()
+        keys = _channel_keys[key] = ChannelKeys(prefix, facility)
+    return keys
+
+
 class RedisStore(object):
     """
     Abstract base class to control publishing and subscription for messages to and from the Redis
@@ -96,6 +234,39 @@ class RedisStore(object):
     def __init__(self, connection):
         self._connection = connection
         self._publishers = set()
+        self._scripts = {}
+
+    def _get_slot_groups(self, channels):
+        """
+        Returns ``channels`` split into lists of channels located in the same hash slot, since
+        a script may only access keys of one slot in a Redis Cluster.
+        """
+        if isinstance(self._connection, ShardedRedis):
+            return self._connection.group_by_slot(channels)
+        channels = list(channels)
+        return [channels] if channels else []
+
+    def _eval_publish(self, channels, message, expire, client=None):
+        """
+        Publish ``message`` on each of ``channels`` and persist it for ``expire`` seconds, through
+        a Lua script, so that the message is sent to Redis only once. The channels must be located
+        in the same hash slot. Returns the number of receivers for each channel, or, if ``client``
+        is a pipeline, the pipeline.
+        """
+        publish_command = getattr(self._connection, 'publish_command', 'PUBLISH')
+        if settings.WS4REDIS_STREAM is None:
+            source, keys, args = PUBLISH_MESSAGE, channels, [message, expire, publish_command]
+        else:
+            options = settings.WS4REDIS_STREAM
+            source, keys = PUBLISH_SEQUENCED, []
+            for channel in channels:
+                keys.extend([channel, self.get_stream_key(channel), self.get_sequence_key(channel)])
+            args = [message, options.get('maxlen', 1000), options.get('expire', 86400), expire, publish_command]
+        script = self._scripts.get(source)
+        if script is None:
+            # the script is sent by EVALSHA and loaded again, if Redis does not know it
+            script = self._scripts[source] = self._connection.register_script(source)
+        return script(keys=keys, args=args, client=client)
 
     def publish_message(self, message, expire=None):
         """
@@ -103,22 +274,23 @@ class RedisStore(object):
         ``expire`` sets the time in seconds, on how long the message shall additionally of being
         published, also be persisted in the Redis datastore. If unset, it defaults to the
         configuration settings ``WS4REDIS_EXPIRE``.
+        Returns a dictionary mapping each channel onto the number of its receivers.
         """
         if expire is None:
             expire = self._expire
         if not isinstance(message, RedisMessage):
             raise ValueError('message object is not of type RedisMessage')
-        for channel in self._publishers:
-            self._connection.publish(channel, message)
-            if expire > 0:
-                self._connection.setex(channel, expire, message)
+        receivers = {}
+        for channels in self._get_slot_groups(self._publishers):
+            receivers.update(zip(channels, self._eval_publish(channels, message, expire)))
+        return receivers
 
     def pipeline_publish_message(
         self, message, expire=None, transaction=True
     ):
         """
-        Like publish_message, but pipelines all publish and setex
-        Redis commands to save round trips to the Redis datastore.
+        Like publish_message, but pipelines the scripts of all hash slots, to save round trips
+        to a Redis Cluster.
         """
         if expire is None:
             expire = self._expire
@@ -126,72 +298,87 @@ class RedisStore(object):
             raise ValueError('message object is not of type RedisMessage')
 
         pipeline = self._connection.pipeline(transaction=transaction)
-
-        for channel in self._publishers:
-            pipeline.publish(channel, message)
-            if expire > 0:
-                pipeline.setex(channel, expire, message)
-
-        pipeline.execute()
+        groups = self._get_slot_groups(self._publishers)
+        for channels in groups:
+            self._eval_publish(channels, message, expire, client=pipeline)
+        receivers = {}
+        for channels, counts in zip(groups, pipeline.execute()):
+            receivers.update(zip(channels, counts))
+        return receivers
 
     @staticmethod
     def get_prefix():
         return settings.WS4REDIS_PREFIX and '{0}:'.format(settings.WS4REDIS_PREFIX) or ''
 
+    @classmethod
+    def get_stream_key(cls, channel):
+        """
+        Returns the key of the stream keeping the recent messages published on ``channel``. The
+        channel is its hash tag, so that a Redis Cluster keeps both in the same slot.
+        """
+        return '{0}stream:{{{1}}}'.format(cls.get_prefix(), channel)
+
+    @classmethod
+    def get_sequence_key(cls, channel):
+        """
+        Returns the key of the counter numbering the messages published on ``channel``. Like the
+        stream, it uses the channel as hash tag.
+        """
+        return '{0}sequence:{{{1}}}'.format(cls.get_prefix(), channel)
+
     def _get_message_channels(self, request=None, facility='{facility}', broadcast=False,
                               groups=(), users=(), sessions=()):
-        prefix = self.get_prefix()
+        keys = get_channel_keys(self.get_prefix(), facility)
         channels = []
         if broadcast is True:
             # broadcast message to each subscriber listening on the named facility
-            channels.append('{prefix}broadcast:{facility}'.format(prefix=prefix, facility=facility))
+            channels.append(keys.broadcast)
 
         # handle group messaging
         if isinstance(groups, (list, tuple)):
-            # message is delivered to all listed groups
-            channels.extend('{prefix}group:{0}:{facility}'.format(g, prefix=prefix, facility=facility)
-                            for g in _wrap_groups(groups, request))
+            # message is delivered to all listed groups, each once
+            channels.extend(keys.groups(OrderedDict.fromkeys(groups) if SELF not in groups else
+                                        _wrap_groups(groups, request)))
         elif groups is True and is_authenticated(request):
             # message is delivered to all groups the currently logged in user belongs to
             warnings.warn('Wrap groups=True into a list or tuple using SELF', DeprecationWarning)
-            channels.extend('{prefix}group:{0}:{facility}'.format(g, prefix=prefix, facility=facility)
-                            for g in request.session.get('ws4redis:memberof', []))
-        elif isinstance(groups, basestring):
+            channels.extend(keys.groups(_get_memberof(request)))
+        elif isinstance(groups, six.string_types):
             # message is delivered to the named group
             warnings.warn('Wrap a single group into a list or tuple', DeprecationWarning)
-            channels.append('{prefix}group:{0}:{facility}'.format(groups, prefix=prefix, facility=facility))
+            channels.extend(keys.groups([groups]))
         elif not isinstance(groups, bool):
             raise ValueError('Argument `groups` must be a list or tuple')
 
         # handle user messaging
         if isinstance(users, (list, tuple)):
-            # message is delivered to all listed users
-            channels.extend('{prefix}user:{0}:{facility}'.format(u, prefix=prefix, facility=facility)
-                            for u in _wrap_users(users, request))
+            # message is delivered to all listed users, each once
+            channels.extend(keys.users(OrderedDict.fromkeys(users) if SELF not in users else
+                                       _wrap_users(users, request)))
         elif users is True and is_authenticated(request):
             # message is delivered to browser instances of the currently logged in user
             warnings.warn('Wrap users=True into a list or tuple using SELF', DeprecationWarning)
-            channels.append('{prefix}user:{0}:{facility}'.format(request.user.get_username(), prefix=prefix, facility=facility))
-        elif isinstance(users, basestring):
+            channels.extend(keys.users([request.user.get_username()]))
+        elif isinstance(users, six.string_types):
             # message is delivered to the named user
             warnings.warn('Wrap a single user into a list or tuple', DeprecationWarning)
-            channels.append('{prefix}user:{0}:{facility}'.format(users, prefix=prefix, facility=facility))
+            channels.extend(keys.users([users]))
         elif not isinstance(users, bool):
             raise ValueError('Argument `users` must be a list or tuple')
 
         # handle session messaging
         if isinstance(sessions, (list, tuple)):
-            # message is delivered to all browsers instances listed in sessions
-            channels.extend('{prefix}session:{0}:{facility}'.format(s, prefix=prefix, facility=facility)
-                            for s in _wrap_sessions(sessions, request))
+            # message is delivered to all browsers instances listed in sessions, each once
+            channels.extend(keys.sessions(OrderedDict.fromkeys(sessions) if SELF not in sessions else
+                                          _wrap_sessions(sessions, request)))
         elif sessions is True and request and request.session:
             # message is delivered to browser instances owning the current session
             warnings.warn('Wrap a single session key into a list or tuple using SELF', DeprecationWarning)
-            channels.append('{prefix}session:{0}:{facility}'.format(request.session.session_key, prefix=prefix, facility=facility))
-        elif isinstance(sessions, basestring):
+            channels.extend(keys.sessions([request.session.session_key]))
+        elif isinstance(sessions, six.string_types):
             # message is delivered to the named user
             warnings.warn('Wrap a single session key into a list or tuple', DeprecationWarning)
-            channels.append('{prefix}session:{0}:{facility}'.format(sessions, prefix=prefix, facility=facility))
+            channels.extend(keys.sessions([sessions]))
         elif not isinstance(sessions, bool):
             raise ValueError('Argument `sessions` must be a list or tuple')
         return channels
@@ -29,11 +29,62 @@ WS4REDIS_SUBSCRIBER = getattr(settings, 'WS4REDIS_SUBSCRIBER', 'ws4redis.subscri
 This set the magic string to recognize heartbeat messages. If set, this message string is ignored
 by the server and also shall be ignored on the client.
 
-If WS4REDIS_HEARTBEAT is not None, the server sends at least every 4 seconds a heartbeat message.
-It is then up to the client to decide, what to do with these messages.
+If WS4REDIS_HEARTBEAT is not None, the server sends a heartbeat message, whenever nothing else
+has been sent to the client for 4 seconds. It is then up to the client to decide, what to do with
+these messages.
 """
 WS4REDIS_HEARTBEAT = getattr(settings, 'WS4REDIS_HEARTBEAT', None)
 
+"""
+Keyword arguments for ``WebSocket.keepalive``. If set, the server sends a protocol level PING
+frame after ``interval`` seconds without having received anything from the client, measures the
+round trip time from the matching PONG frame and closes the websocket after ``max_missed``
+unanswered pings. Set to None to disable server side pings.
+"""
+WS4REDIS_KEEPALIVE = getattr(settings, 'WS4REDIS_KEEPALIVE', None)
+
+"""
+Close a websocket with status 1001, after no message has been exchanged with its client for this
+number of seconds. Heartbeats and protocol level pings do not count as messages. Set to None to
+keep idle websockets open.
+"""
+WS4REDIS_IDLE_TIMEOUT = getattr(settings, 'WS4REDIS_IDLE_TIMEOUT', None)
+
+"""
+Maximum number of messages read from Redis in one go, whenever a websocket wakes up, and then sent
+to the client in one coalesced write. The sizes of these batches are recorded in the histogram
+``subscriber.batch_size`` of ``ws4redis.metrics``.
+"""
+WS4REDIS_BATCH_SIZE = getattr(settings, 'WS4REDIS_BATCH_SIZE', 64)
+
+"""
+Keyword arguments for ``ws4redis.identity.IdentityCache``, which keeps the username and groups of
+up to ``maxsize`` session keys for ``ttl`` seconds, so that the handshake of a returning client
+neither loads its session nor its user. Cached identities are invalidated on login and logout.
+Set to None to resolve the identity on each handshake.
+"""
+WS4REDIS_IDENTITY_CACHE = getattr(settings, 'WS4REDIS_IDENTITY_CACHE', None)
+
+"""
+Keyword arguments for ``ws4redis.drain.Drain``, which drains the websocket servers of a process on
+request: They stop accepting websockets and close the open ones with status ``code`` (default
+1012), spread over ``window`` seconds, telling each client to wait up to ``reconnect_delay``
+seconds before reconnecting. Draining is started by the management command ``ws4redis_drain``,
+or by the signal named ``signal``, for instance ``'SIGUSR1'``. Defaults to None, which turns off
+draining; set it to a dictionary, even an empty one, to turn it on.
+"""
+WS4REDIS_DRAIN = getattr(settings, 'WS4REDIS_DRAIN', None)
+
+"""
+If set, each published message is numbered with a sequence per channel and appended to a Redis
+Stream, trimmed to about ``maxlen`` entries (default 1000) and expiring ``expire`` seconds (default
+86400) after the last message. The counter of each channel does not expire, so that sequence
+numbers keep increasing, even after the stream expired. Clients reconnecting with
+``?resume=<channel>:<seq>,...`` receive the messages they missed. Set to None to publish messages
+without sequence numbers.
+"""
+WS4REDIS_STREAM = getattr(settings, 'WS4REDIS_STREAM', None)
+
 
 """
 If set, this callback function is called right after the initialization of the Websocket.
@@ -52,3 +103,55 @@ If set, this callback function is called instead of the default process_request
 This function can be used to enforce custom authentication flow. i.e. JWT
 """
 WS4REDIS_PROCESS_REQUEST = getattr(settings, 'WS4REDIS_PROCESS_REQUEST', None)
+
+"""
+Number of Redis PubSub connections each worker process shares between all of its websockets,
+when using ``ws4redis.subscriber.MultiplexedRedisSubscriber`` as ``WS4REDIS_SUBSCRIBER``.
+Channels are distributed onto these connections by hashing their names.
+"""
+WS4REDIS_MULTIPLEXER_POOL_SIZE = getattr(settings, 'WS4REDIS_MULTIPLEXER_POOL_SIZE', 1)
+
+"""
+Keyword arguments for ``ws4redis.compression.PerMessageDeflate``, configuring the permessage-deflate
+extension (RFC 7692), which is offered by most browsers. Messages larger than ``compress_threshold``
+bytes are sent compressed, inbound messages inflating to more than ``max_message_size`` bytes
+close the websocket with status 1009. Defaults to None, which turns off compression; set it to
+a dictionary, even an empty one, to offer it.
+"""
+WS4REDIS_PERMESSAGE_DEFLATE = getattr(settings, 'WS4REDIS_PERMESSAGE_DEFLATE', None)
+
+"""
+Keyword arguments for ``ws4redis.outbound.OutboundQueue``, which lets the server write messages
+without blocking on clients, which do not drain their socket. Once more than ``high_water_mark``
+bytes are queued for a websocket, ``policy`` decides whether to drop the oldest or the newest
+messages, to keep only the latest message per channel or to close the websocket with status 1008
+or 1013. On close, the close frame is written within ``close_timeout`` seconds, discarding the
+backlog. Set to None to write messages in blocking mode. ``WebsocketASGIServer`` always bounds the
+messages queued for each websocket, using the defaults of ``OutboundQueue`` if this is None.
+"""
+WS4REDIS_OUTBOUND_QUEUE = getattr(settings, 'WS4REDIS_OUTBOUND_QUEUE', None)
+
+"""
+Number of reactor threads serving the websockets of the development server. If set, each
+websocket is handed over to a reactor after the handshake, which serves all of its websockets
+from one thread through ``selectors.DefaultSelector``, rather than keeping a thread per
+websocket. Reactors require Python 3. Set to 0 to serve each websocket from its request thread.
+"""
+WS4REDIS_REACTOR_THREADS = getattr(settings, 'WS4REDIS_REACTOR_THREADS', 0)
+
+"""
+Keyword arguments for ``ws4redis.cluster.ShardedRedis``, which distributes the channels onto the
+nodes of a Redis Cluster, given by its ``startup_nodes``, and publishes through sharded pub/sub.
+Requires ``ws4redis.subscriber.MultiplexedRedisSubscriber`` as ``WS4REDIS_SUBSCRIBER``. Set to None
+to use the single Redis server configured by ``WS4REDIS_CONNECTION``.
+"""
+WS4REDIS_CLUSTER = getattr(settings, 'WS4REDIS_CLUSTER', None)
+
+"""
+Keyword arguments for ``ws4redis.background.BackgroundPublisher``, which lets
+``RedisPublisher.enqueue_message`` return at once, while a thread of each process publishes the
+queued messages through one pipeline every ``flush_interval`` seconds or every ``batch_size``
+messages. Once ``max_queue`` messages are pending, further messages are dropped. Set to None to
+publish each enqueued message synchronously.
+"""
+WS4REDIS_BACKGROUND_PUBLISHER = getattr(settings, 'WS4REDIS_BACKGROUND_PUBLISHER', None)
@@ -5,12 +5,15 @@
  * options.disconnected -> Callback called after the websocket is disconnected.
  * options.receive_message -> Callback called when a message is received from the websocket.
  * options.heartbeat_msg -> String to identify the heartbeat message.
+ * options.resume -> Resume the subscriptions after reconnecting, receiving the missed messages.
  * $ -> JQuery instance.
  */
 function WS4Redis(options, $) {
 	'use strict';
 	var opts, ws, deferred, timer, attempts = 1, must_reconnect = true;
-	var heartbeat_interval = null, missed_heartbeats = 0;
+	var heartbeat_interval = null, missed_heartbeats = 0, reconnect_delay = null;
+	// the sequence number of the last message received on each channel, if resuming
+	var sequences = {};
 
 	if (this === undefined)
 		return new WS4Redis(options, $);
@@ -18,8 +21,17 @@ function WS4Redis(options, $) {
 		throw new Error('No Websocket URI in options');
 	if ($ === undefined)
 		$ = jQuery;
-	opts = $.extend({ heartbeat_msg: null }, options);
-	connect(opts.uri);
+	opts = $.extend({ heartbeat_msg: null, resume: false }, options);
+	connect(get_uri());
+
+	function get_uri() {
+		if (!opts.resume)
+			return opts.uri;
+		var tokens = $.map(sequences, function(seq, channel) {
+			return channel + ':' + seq;
+		});
+		return opts.uri + (opts.uri.indexOf('?') < 0 ? '?' : '&') + 'resume=' + encodeURIComponent(tokens.join(','));
+	}
 
 	function connect(uri) {
 		try {
@@ -50,10 +62,12 @@ function WS4Redis(options, $) {
 		if (must_reconnect && !timer) {
 			// try to reconnect
 			console.log('Reconnecting...');
-			var interval = generate_inteval(attempts);
+			// a draining server tells when to reconnect, so that its clients do not return all at once
+			var interval = reconnect_delay !== null ? reconnect_delay : generate_inteval(attempts);
+			reconnect_delay = null;
 			timer = setTimeout(function() {
 				attempts++;
-				connect(ws.url);
+				connect(get_uri());
 			}, interval);
 		}
 	}
@@ -90,6 +104,10 @@ function WS4Redis(options, $) {
 
 	function on_close(evt) {
 		console.log("Connection closed!");
+		var hint = /reconnect-delay=(\d+)/.exec(evt.reason || '');
+		if (hint) {
+			reconnect_delay = parseInt(hint[1], 10);
+		}
 		if ($.type(opts.disconnected) === 'function') {
 			opts.disconnected(evt);
 		}
@@ -102,11 +120,25 @@ function WS4Redis(options, $) {
 	}
 
 	function on_message(evt) {
+		// the server sends heartbeats only while idle, hence any message resets the counter
+		missed_heartbeats = 0;
 		if (opts.heartbeat_msg && evt.data === opts.heartbeat_msg) {
-			// reset the counter for missed heartbeats
-			missed_heartbeats = 0;
-		} else if ($.type(opts.receive_message) === 'function') {
-			return opts.receive_message(evt.data);
+			return;
+		}
+		var data = evt.data;
+		if (opts.resume && typeof data === 'string') {
+			// messages are prefixed by <channel>:<seq>|, unless the server does not number them
+			var pos = data.indexOf('|'), token = data.substring(0, pos);
+			if (pos >= 0 && /^[^|]*:\d*$/.test(token)) {
+				var sep = token.lastIndexOf(':');
+				if (token.substring(sep + 1)) {
+					sequences[token.substring(0, sep)] = token.substring(sep + 1);
+				}
+				data = data.substring(pos + 1);
+			}
+		}
+		if ($.type(opts.receive_message) === 'function') {
+			return opts.receive_message(data);
 		}
 	}
 
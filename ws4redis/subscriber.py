@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
+from collections import deque
 from django.conf import settings
-from ws4redis.redis_store import RedisStore, SELF
+from ws4redis import settings as private_settings
+from ws4redis.redis_store import RedisStore, RedisMessage, SELF, split_sequence, get_stream_sequence
+from ws4redis.multiplexer import get_multiplexer
+from ws4redis.websocket import PreparedFrame
 
 
 class RedisSubscriber(RedisStore):
@@ -12,6 +18,8 @@ class RedisSubscriber(RedisStore):
 
     def __init__(self, connection):
         self._subscription = None
+        # the last sequence number sent for each channel, if the client resumes its subscription
+        self._sequences = None
         super(RedisSubscriber, self).__init__(connection)
 
     def parse_response(self):
@@ -20,6 +28,20 @@ class RedisSubscriber(RedisStore):
         """
         return self._subscription.parse_response()
 
+    def parse_responses(self, limit, block=True):
+        """
+        Parse the next response and all further responses, which already have been received, up
+        to ``limit`` responses in total. Unless ``block`` is set, an empty list is returned if no
+        response has been received yet, rather than waiting for the next one.
+        """
+        connection = self._subscription.connection
+        if not block and not (connection and connection.can_read(timeout=0)):
+            return []
+        responses = [self._subscription.parse_response()]
+        while len(responses) < limit and connection and connection.can_read():
+            responses.append(self._subscription.parse_response())
+        return responses
+
     def set_pubsub_channels(self, request, channels):
         """
         Initialize the channels used for publishing and subscribing messages through the message queue.
@@ -44,19 +66,140 @@ class RedisSubscriber(RedisStore):
             'sessions': 'subscribe-session' in channels and [SELF] or [],
             'broadcast': 'subscribe-broadcast' in channels,
         }
+        keys = self._get_message_channels(request=request, facility=facility, **audience)
+        if private_settings.WS4REDIS_STREAM is not None and 'resume' in request.GET:
+            self._sequences = self.parse_resume(request.GET['resume'], keys)
+        self.subscribe_channels(keys)
+
+    def parse_resume(self, resume, keys):
+        """
+        Returns a dictionary mapping each of the subscribed channel ``keys`` onto the sequence number
+        of the last message the client received on it, as given by the ``resume`` parameter
+        ``<channel>:<seq>,...``, where the channel is named without the prefix.
+        """
+        prefix = self.get_prefix()
+        sequences = dict((key, None) for key in keys)
+        for token in resume.split(','):
+            channel, _, seq = token.rpartition(':')
+            if prefix + channel in sequences and seq.isdigit():
+                sequences[prefix + channel] = int(seq)
+        return sequences
+
+    @property
+    def resumable(self):
+        """
+        True, if the client resumes its subscription and thus expects sequenced messages.
+        """
+        return self._sequences is not None
+
+    def get_missed_messages(self, sequences):
+        """
+        Returns a list of ``(channel, seq, message)`` tuples with the messages published on each
+        channel of ``sequences`` after the sequence number given for it. If these messages were
+        trimmed from the stream meanwhile, or if no sequence number is given, the persisted message
+        is returned instead, if any. The streams are read in one pipeline, the persisted messages
+        through one MGET.
+        """
+        resumed = [(channel, seq) for channel, seq in sequences.items() if seq is not None]
+        results = []
+        if resumed:
+            pipeline = self._connection.pipeline(transaction=False)
+            for channel, seq in resumed:
+                stream = self.get_stream_key(channel)
+                pipeline.xrange(stream, '0-{0}'.format(seq + 1), '+')
+                pipeline.xrevrange(stream, count=1)
+            results = pipeline.execute()
+        missed = []
+        snapshots = [channel for channel, seq in sequences.items() if seq is None]
+        for (channel, seq), entries, latest in zip(resumed, results[::2], results[1::2]):
+            if entries and get_stream_sequence(entries[0][0]) == seq + 1:
+                missed.extend((channel, get_stream_sequence(entry_id), RedisMessage(fields[b'message']))
+                              for entry_id, fields in entries)
+            elif entries or not latest or get_stream_sequence(latest[0][0]) != seq:
+                # the gap has been trimmed, or the stream has been recreated
+                snapshots.append(channel)
+        if snapshots:
+            for channel, value in zip(snapshots, self._connection.mget(snapshots)):
+                seq, message = split_sequence(value)
+                if message:
+                    missed.append((channel, seq, message))
+        return missed
+
+    def sequence_message(self, channel, seq, message):
+        """
+        Returns ``message`` prefixed by its channel, named without the prefix, and its sequence
+        number, so that the client can resume its subscription after reconnecting.
+        """
+        if isinstance(channel, bytes):
+            channel = channel.decode('utf-8')
+        token = '{0}:{1}|'.format(channel[len(self.get_prefix()):], '' if seq is None else seq)
+        return RedisMessage(token.encode('utf-8') + message)
+
+    def sequence_frames(self, frames):
+        """
+        Returns the frames to be sent to a client resuming its subscription. Frames, which have been
+        replayed already, are skipped, the others are replaced by their sequenced counterpart.
+        """
+        result = []
+        for frame in frames:
+            channel = frame.channel.decode('utf-8') if isinstance(frame.channel, bytes) else frame.channel
+            if frame.seq is not None:
+                last = self._sequences.get(channel)
+                if last is not None and frame.seq <= last:
+                    continue
+                self._sequences[channel] = frame.seq
+            if frame.sequenced is None:
+                # shared between all websockets resuming a subscription on this channel
+                message = self.sequence_message(channel, frame.seq, frame.message)
+                frame.sequenced = PreparedFrame(message, channel=frame.channel)
+            result.append(frame.sequenced)
+        return result
+
+    def subscribe_channels(self, channels):
+        """
+        Subscribe to the given list of channel keys on the Redis datastore.
+        """
         self._subscription = self._connection.pubsub()
-        for key in self._get_message_channels(request=request, facility=facility, **audience):
-            self._subscription.subscribe(key)
+        if channels:
+            # a single SUBSCRIBE command for all channels
+            self._subscription.subscribe(*channels)
+
+    def get_persisted_messages(self, channels):
+        """
+        Returns a list of ``PreparedFrame`` objects, one for each message persisted on one of the
+        given ``channels``, fetched through one MGET.
+        """
+        channels = list(channels)
+        if not channels:
+            return []
+        frames = []
+        for channel, value in zip(channels, self._connection.mget(channels)):
+            message = split_sequence(value)[1]
+            if message:
+                frames.append(PreparedFrame(message, channel=channel))
+        return frames
 
     def send_persisted_messages(self, websocket):
         """
         This method is called immediately after a websocket is openend by the client, so that
         persisted messages can be sent back to the client upon connection.
         """
-        for channel in self._subscription.channels:
-            message = self._connection.get(channel)
-            if message:
-                websocket.send(message)
+        if self.resumable:
+            self.send_missed_messages(websocket)
+            return
+        websocket.send_prepared_batch(self.get_persisted_messages(self._subscription.channels))
+
+    def send_missed_messages(self, websocket):
+        """
+        Send the messages, which the client missed since it received the sequence numbers given on
+        resuming its subscription.
+        """
+        frames = []
+        for channel, seq, message in self.get_missed_messages(self._sequences):
+            frames.append(PreparedFrame(self.sequence_message(channel, seq, message), channel=channel))
+            if seq is not None:
+                self._sequences[channel] = seq
+        websocket.send_prepared_batch(frames)
 
     # for backwards compatibility: remove on major version upgrade (v1)
     send_persited_messages = send_persisted_messages
@@ -77,3 +220,84 @@ class RedisSubscriber(RedisStore):
             self._subscription.unsubscribe()
             self._subscription.reset()
 
+
+class MultiplexedRedisSubscriber(RedisSubscriber):
+    """
+    Subscriber class, which shares a small pool of Redis PubSub connections between all websockets
+    of a worker process, rather than opening one connection for each websocket. Messages received
+    by the shared connection are queued locally and signalled through a pipe, so that the websocket
+    loop can select on it, as it would on a dedicated Redis connection.
+    """
+    def __init__(self, connection):
+        super(MultiplexedRedisSubscriber, self).__init__(connection)
+        self._channels = []
+        self._messages = deque()
+        self._lock = threading.Lock()
+        self._signalled = False
+        self._wakeup_fds = os.pipe()
+
+    def subscribe_channels(self, channels):
+        self._channels = list(channels)
+        for multiplexer, keys in self._group_by_multiplexer(self._channels):
+            multiplexer.subscribe(self, keys)
+
+    def _group_by_multiplexer(self, channels):
+        groups = {}
+        for channel in channels:
+            groups.setdefault(get_multiplexer(self._connection, channel), []).append(channel)
+        return groups.items()
+
+    def deliver(self, frame):
+        """
+        Called by the multiplexer thread with a ``PreparedFrame`` for each message received
+        on one of our channels.
+        """
+        with self._lock:
+            if self._wakeup_fds is None:
+                # released meanwhile, its pipe may already have been closed
+                return
+            self._messages.append(frame)
+            if not self._signalled:
+                self._signalled = True
+                os.write(self._wakeup_fds[1], b'x')
+
+    def parse_response(self):
+        with self._lock:
+            frame = self._messages.popleft() if self._messages else None
+            if not self._messages and self._signalled:
+                self._signalled = False
+                os.read(self._wakeup_fds[0], 1)
+        return frame
+
+    def parse_responses(self, limit, block=True):
+        with self._lock:
+            frames = []
+            while self._messages and len(frames) < limit:
+                frames.append(self._messages.popleft())
+            if not self._messages and self._signalled:
+                self._signalled = False
+                os.read(self._wakeup_fds[0], 1)
+        return frames
+
+    def send_persisted_messages(self, websocket):
+        if self.resumable:
+            self.send_missed_messages(websocket)
+            return
+        websocket.send_prepared_batch(self.get_persisted_messages(self._channels))
+
+    send_persited_messages = send_persisted_messages
+
+    def get_file_descriptor(self):
+        return self._wakeup_fds and self._wakeup_fds[0]
+
+    def release(self):
+        for multiplexer, keys in self._group_by_multiplexer(self._channels):
+            multiplexer.unsubscribe(self, keys)
+        self._channels = []
+        with self._lock:
+            if self._wakeup_fds:
+                for fd in self._wakeup_fds:
+                    os.close(fd)
+                self._wakeup_fds = None
+            self._messages.clear()
+            self._signalled = False
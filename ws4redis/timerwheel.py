@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Hierarchical timing wheel, as described by Varghese and Lauck, keeping the deadlines of many
+connections, such as heartbeats, keepalive pings and idle timeouts.
+
+Scheduling and cancelling a timer takes constant time, regardless of how many timers are pending,
+and its owner only has to wake up, when a deadline actually expires.
+"""
+from ws4redis._compat import monotonic
+
+
+class Timer(object):
+    """
+    Handle returned by ``TimerWheel.schedule``.
+    """
+    __slots__ = ('tick', 'callback', 'args', '_bucket')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self._bucket = None
+
+    @property
+    def active(self):
+        return self._bucket is not None
+
+    def cancel(self):
+        """
+        Remove the timer from its wheel, unless it already expired.
+        """
+        if self._bucket is not None:
+            self._bucket.discard(self)
+            self._bucket = None
+
+
+class TimerWheel(object):
+    """
+    Timers are rounded up to ticks of ``resolution`` seconds and kept in ``levels`` wheels of
+    ``slots`` buckets each. The first wheel holds the timers expiring within the next ``slots``
+    ticks, each further wheel covers a range ``slots`` times as large. Whenever a wheel completes a
+    revolution, the timers of the next bucket of the wheel above are redistributed to the wheels
+    below. With the defaults, timers expiring within the next 19 days are placed exactly, later
+    ones are placed into the last bucket and rescheduled, when it is reached.
+
+    A timer never expires early. A wheel is not thread safe and shall be driven by the thread
+    owning the connections, whose timers it keeps.
+    """
+    def __init__(self, resolution=0.1, slots=256, levels=3, clock=monotonic):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self._tick = int(clock() / resolution)
+        # the earliest tick at which a bucket holding timers is reached, if not dirty
+        self._next_tick = None
+        self._dirty = False
+
+    def __len__(self):
+        """
+        Number of pending timers.
+        """
+        return sum(len(bucket) for wheel in self._wheels for bucket in wheel)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call ``callback(*args)`` after ``delay`` seconds.
+
+        :returns: A ``Timer``, which can be cancelled.
+        """
+        tick = -int(-(self.clock() + delay) // self.resolution)
+        timer = Timer(max(tick, self._tick + 1), callback, args)
+        reached = self._place(timer)
+        if not self._dirty and (self._next_tick is None or reached < self._next_tick):
+            self._next_tick = reached
+        return timer
+
+    def _place(self, timer):
+        """
+        Add ``timer`` to the bucket covering its tick and return the tick at which this bucket
+        is reached.
+        """
+        delta = timer.tick - self._tick
+        tick = timer.tick
+        unit = 1
+        for level in range(self.levels):
+            if delta < unit * self.slots:
+                break
+            if level == self.levels - 1:
+                # beyond the range of the wheels, placed again once the last bucket is reached
+                tick = self._tick + unit * self.slots - 1
+                break
+            unit *= self.slots
+        bucket = self._wheels[level][tick // unit % self.slots]
+        bucket.add(timer)
+        timer._bucket = bucket
+        return tick // unit * unit
+
+    def _find_next_tick(self):
+        next_tick = None
+        unit = 1
+        for wheel in self._wheels:
+            position = self._tick // unit
+            for offset in range(1, self.slots + 1):
+                if wheel[(position + offset) % self.slots]:
+                    tick = (position + offset) * unit
+                    if next_tick is None or tick < next_tick:
+                        next_tick = tick
+                    break
+            unit *= self.slots
+        return next_tick
+
+    def _get_next_tick(self):
+        if self._dirty:
+            self._next_tick = self._find_next_tick()
+            self._dirty = False
+        return self._next_tick
+
+    def timeout(self):
+        """
+        Returns the number of seconds until the wheel has to be advanced, or None if no timers
+        are pending.
+        """
+        next_tick = self._get_next_tick()
+        if next_tick is None:
+            return None
+        # slightly later, so that the tick is reached despite rounding errors
+        return max(next_tick * self.resolution - self.clock(), 0) + self.resolution / 1000
+
+    def advance(self):
+        """
+        Call the callbacks of all expired timers.
+
+        :returns: The number of expired timers.
+        """
+        now = int(self.clock() / self.resolution)
+        expired = []
+        while self._tick < now:
+            next_tick = self._get_next_tick()
+            if next_tick is None or next_tick > now:
+                self._tick = now
+                break
+            # all buckets up to the next tick are empty
+            self._tick = next_tick
+            self._cascade()
+            bucket = self._wheels[0][self._tick % self.slots]
+            timers = list(bucket)
+            bucket.clear()
+            for timer in timers:
+                if timer.tick > self._tick:
+                    # beyond the range of a single wheel
+                    self._place(timer)
+                else:
+                    expired.append(timer)
+            self._dirty = True
+        for timer in expired:
+            timer._bucket = None
+            timer.callback(*timer.args)
+        return len(expired)
+
+    def _cascade(self):
+        """
+        Redistribute the timers of the buckets of the upper wheels, which are reached.
+        """
+        unit = 1
+        for level in range(1, self.levels):
+            unit *= self.slots
+            if self._tick % unit:
+                break
+            bucket = self._wheels[level][self._tick // unit % self.slots]
+            timers = list(bucket)
+            bucket.clear()
+            for timer in timers:
+                self._place(timer)
@@ -4,7 +4,7 @@
 ##
 ##  Note:
 ##
-##  This code is a Python implementation of the algorithm
+##  On Python 2, this code uses a Python implementation of the algorithm
 ##
 ##            "Flexible and Economical UTF-8 Decoder"
 ##
@@ -13,6 +13,8 @@
 ##       bjoern@hoehrmann.de
 ##       http://bjoern.hoehrmann.de/utf-8/decoder/dfa/
 ##
+##  On Python 3, complete chunks are validated by the built-in UTF-8 codec.
+##
 ##  Licensed under the Apache License, Version 2.0 (the "License");
 ##  you may not use this file except in compliance with the License.
 ##  You may obtain a copy of the License at
@@ -27,111 +29,127 @@
 ##
 ###############################################################################
 
+import codecs
 import six
 
 if six.PY3:
     xrange = range
 
-## use Cython implementation of UTF8 validator if available
-##
-try:
-    from wsaccel.utf8validator import Utf8Validator
-except:
-    ## fallback to pure Python implementation
 
-    class Utf8Validator:
+class Utf8Validator(object):
+    """
+    Incremental UTF-8 validator with constant memory consumption (minimal
+    state). On Python 2 it is replaced by the Cython implementation from
+    wsaccel, if available.
+
+    Each chunk is validated as a whole by Python's UTF-8 codec. Only an incomplete
+    sequence at the end of a chunk, that is up to three octets, is carried over to
+    the next chunk. Python 2's codec accepts encoded surrogates, therefore there
+    the DFA by Bjoern Hoehrmann is used instead.
+    """
+
+    ## DFA transitions
+    UTF8VALIDATOR_DFA = [
+        0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 00..1f
+        0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 20..3f
+        0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 40..5f
+        0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 60..7f
+        1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,  # 80..9f
+        7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,  # a0..bf
+        8,8,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,  # c0..df
+        0xa,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x4,0x3,0x3,  # e0..ef
+        0xb,0x6,0x6,0x6,0x5,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,  # f0..ff
+        0x0,0x1,0x2,0x3,0x5,0x8,0x7,0x1,0x1,0x1,0x4,0x6,0x1,0x1,0x1,0x1,  # s0..s0
+        1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,0,1,1,1,1,1,0,1,0,1,1,1,1,1,1,  # s1..s2
+        1,2,1,1,1,1,1,2,1,2,1,1,1,1,1,1,1,1,1,1,1,1,1,2,1,1,1,1,1,1,1,1,  # s3..s4
+        1,2,1,1,1,1,1,1,1,2,1,1,1,1,1,1,1,1,1,1,1,1,1,3,1,3,1,1,1,1,1,1,  # s5..s6
+        1,3,1,1,1,1,1,3,1,3,1,1,1,1,1,1,1,3,1,1,1,1,1,1,1,1,1,1,1,1,1,1,  # s7..s8
+    ]
+
+    UTF8_ACCEPT = 0
+    UTF8_REJECT = 1
+
+    def __init__(self):
+        self.state = None
+        self.i = None
+        self.pending = None
+        self.reset()
+
+    def reset(self):
         """
-        Incremental UTF-8 validator with constant memory consumption (minimal
-        state).
+        Reset validator to start new incremental UTF-8 decode/validation.
+        """
+        self.state = self.UTF8_ACCEPT
+        self.i = 0
+        self.pending = b''
 
-        Implements the algorithm "Flexible and Economical UTF-8 Decoder" by
-        Bjoern Hoehrmann (http://bjoern.hoehrmann.de/utf-8/decoder/dfa/).
+    def validate(self, ba):
         """
+        Incrementally validate a chunk of bytes provided as string.
+
+        Will return a quad (valid?, endsOnCodePoint?, currentIndex, totalIndex).
 
-        ## DFA transitions
-        UTF8VALIDATOR_DFA = [
-            0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 00..1f
-            0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 20..3f
-            0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 40..5f
-            0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,  # 60..7f
-            1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,  # 80..9f
-            7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,  # a0..bf
-            8,8,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,  # c0..df
-            0xa,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x3,0x4,0x3,0x3,  # e0..ef
-            0xb,0x6,0x6,0x6,0x5,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,0x8,  # f0..ff
-            0x0,0x1,0x2,0x3,0x5,0x8,0x7,0x1,0x1,0x1,0x4,0x6,0x1,0x1,0x1,0x1,  # s0..s0
-            1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,0,1,1,1,1,1,0,1,0,1,1,1,1,1,1,  # s1..s2
-            1,2,1,1,1,1,1,2,1,2,1,1,1,1,1,1,1,1,1,1,1,1,1,2,1,1,1,1,1,1,1,1,  # s3..s4
-            1,2,1,1,1,1,1,1,1,2,1,1,1,1,1,1,1,1,1,1,1,1,1,3,1,3,1,1,1,1,1,1,  # s5..s6
-            1,3,1,1,1,1,1,3,1,3,1,1,1,1,1,1,1,3,1,1,1,1,1,1,1,1,1,1,1,1,1,1,  # s7..s8
-        ]
-
-        UTF8_ACCEPT = 0
-        UTF8_REJECT = 1
-
-        def __init__(self):
-            self.state = None
-            self.codepoint = None
-            self.i = None
-            self.reset()
-
-        def decode(self, b):
-            """
-            Eat one UTF-8 octet, and validate on the fly.
-
-            Returns UTF8_ACCEPT when enough octets have been consumed, in which case
-            self.codepoint contains the decoded Unicode code point.
-
-            Returns UTF8_REJECT when invalid UTF-8 was encountered.
-
-            Returns some other positive integer when more octets need to be eaten.
-            """
-            type = Utf8Validator.UTF8VALIDATOR_DFA[b]
-
-            if self.state != Utf8Validator.UTF8_ACCEPT:
-                self.codepoint = (b & 0x3f) | (self.codepoint << 6)
-            else:
-                self.codepoint = (0xff >> type) & b
-
-            self.state = Utf8Validator.UTF8VALIDATOR_DFA[256 + self.state * 16 + type]
-
-            return self.state
-
-        def reset(self):
-            """
-            Reset validator to start new incremental UTF-8 decode/validation.
-            """
-            self.state = Utf8Validator.UTF8_ACCEPT
-            self.codepoint = 0
-            self.i = 0
-
-        def validate(self, ba):
-            """
-            Incrementally validate a chunk of bytes provided as string.
-
-            Will return a quad (valid?, endsOnCodePoint?, currentIndex, totalIndex).
-
-            As soon as an octet is encountered which renders the octet sequence
-            invalid, a quad with valid? == False is returned. currentIndex returns
-            the index within the currently consumed chunk, and totalIndex the
-            index within the total consumed sequence that was the point of bail out.
-            When valid? == True, currentIndex will be len(ba) and totalIndex the
-            total amount of consumed bytes.
-            """
-
-            if not isinstance(ba, six.text_type):
-                ba = ba.decode()
-            l = len(ba)
-
-            for i in xrange(l):
-                ## optimized version of decode(), since we are not interested in actual code points
-
-                self.state = Utf8Validator.UTF8VALIDATOR_DFA[256 + (self.state << 4) + Utf8Validator.UTF8VALIDATOR_DFA[ord(ba[i])]]
-
-                if self.state == Utf8Validator.UTF8_REJECT:
-                    self.i += i
-                    return False, False, i, self.i
-
-            self.i += l
-
-            return True, self.state == Utf8Validator.UTF8_ACCEPT, l, self.i
+        As soon as an octet is encountered which renders the octet sequence
+        invalid, a quad with valid? == False is returned. currentIndex returns
+        the index within the currently consumed chunk, and totalIndex the
+        index within the total consumed sequence that was the point of bail out.
+        When valid? == True, currentIndex will be len(ba) and totalIndex the
+        total amount of consumed bytes.
+        """
+        if self.state == self.UTF8_REJECT:
+            return False, False, 0, self.i
+        if six.PY2:
+            return self._validate_dfa(bytearray(ba))
+
+        data = self.pending + ba if self.pending else ba
+        try:
+            consumed = codecs.utf_8_decode(data, 'strict', False)[1]
+            # the codec does not check an incomplete sequence at the end of the chunk
+            index = self._check_incomplete(bytearray(data[consumed:]))
+            if index is not None:
+                index += consumed
+        except UnicodeDecodeError as e:
+            index = e.start if e.reason == 'invalid start byte' else e.end
+        if index is not None:
+            index -= len(self.pending)
+            self.state = self.UTF8_REJECT
+            self.i += index
+            return False, False, index, self.i
+        # carry the incomplete, but so far valid sequence over to the next chunk
+        self.pending = bytes(data[consumed:])
+        l = len(ba)
+        self.i += l
+        return True, not self.pending, l, self.i
+
+    def _check_incomplete(self, tail):
+        """
+        Returns the index of the first invalid octet in the trailing incomplete sequence ``tail``
+        or None, if it is a valid prefix of a code point.
+        """
+        state = self.UTF8_ACCEPT
+        for i in xrange(len(tail)):
+            state = self.UTF8VALIDATOR_DFA[256 + (state << 4) + self.UTF8VALIDATOR_DFA[tail[i]]]
+            if state == self.UTF8_REJECT:
+                return i
+
+    def _validate_dfa(self, ba):
+        l = len(ba)
+        for i in xrange(l):
+            self.state = self.UTF8VALIDATOR_DFA[256 + (self.state << 4) + self.UTF8VALIDATOR_DFA[ba[i]]]
+            if self.state == self.UTF8_REJECT:
+                self.i += i
+                return False, False, i, self.i
+        self.i += l
+        return True, self.state == self.UTF8_ACCEPT, l, self.i
+
+
+PyUtf8Validator = Utf8Validator
+
+## on Python 2 use the Cython implementation of UTF8 validator if available,
+## on Python 3 the codec based validator above outperforms it
+##
+if six.PY2:
+    try:
+        from wsaccel.utf8validator import Utf8Validator
+    except ImportError:
+        pass
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 import uwsgi
+import logging
 import gevent.select
-from ws4redis.exceptions import WebSocketError
+from ws4redis import settings as private_settings
+from ws4redis.exceptions import WebSocketError, SlowConsumerError
+from ws4redis.outbound import OutboundQueue
+from ws4redis.websocket import WebSocket
 from ws4redis.wsgi_server import WebsocketWSGIServer
 
+logger = logging.getLogger('django.request')
+
 
 class uWSGIWebsocket(object):
-    def __init__(self):
+    def __init__(self, outbound=None):
         self._closed = False
+        self.outbound = outbound
 
     def get_file_descriptor(self):
         """Return the file descriptor for the given websocket"""
@@ -21,6 +28,25 @@ class uWSGIWebsocket(object):
     def closed(self):
         return self._closed
 
+    @property
+    def buffered(self):
+        # uWSGI reads and buffers frames by itself
+        return False
+
+    @property
+    def rtt(self):
+        return None
+
+    def keepalive(self, interval, max_missed=2):
+        # uWSGI answers pings by itself and sends its own, see option websockets-ping-freq
+        return interval
+
+    @property
+    def pending(self):
+        if self.outbound is None:
+            return 0
+        return self.outbound.pending
+
     def receive(self):
         if self._closed:
             raise WebSocketError("Connection is already closed")
@@ -35,22 +61,63 @@ class uWSGIWebsocket(object):
             uwsgi.websocket_recv_nb()
         except IOError:
             self.close()
+        else:
+            self._send_queued()
+
+    def send(self, message, binary=None, channel=None):
+        if self.outbound is None:
+            self._send(message)
+            return
+        try:
+            self.outbound.push([WebSocket._encode_bytes(message)], channel)
+        except SlowConsumerError as excpt:
+            logger.info('websocket: closing slow consumer with {0}'.format(excpt.code))
+            self.outbound.clear()
+            self.close(excpt.code, 'Slow consumer')
+            return
+        self._send_queued()
 
-    def send(self, message, binary=None):
+    def _send(self, message):
         try:
             uwsgi.websocket_send(message)
         except IOError as e:
             self.close()
             raise WebSocketError(e)
 
+    def _send_queued(self):
+        # uWSGI writes each frame in blocking mode, hence frames are handed over only while the
+        # socket is writable
+        if self.outbound is None or self._closed:
+            return
+        fd = self.get_file_descriptor()
+        while len(self.outbound) and gevent.select.select([], [fd], [], 0)[1]:
+            payload = b''.join(self.outbound.peek())
+            self.outbound.consume(len(payload))
+            self._send(payload)
+
+    def send_prepared(self, frame):
+        # uWSGI encodes the frame by itself
+        self.send(frame.payload, channel=frame.channel)
+
+    def send_prepared_batch(self, frames):
+        # uWSGI offers no vectored send, so the frames are written one by one
+        for frame in frames:
+            self.send(frame.payload, channel=frame.channel)
+
     def close(self, code=1000, message=''):
         self._closed = True
 
 
 class uWSGIWebsocketServer(WebsocketWSGIServer):
+    # uWSGI answers pings and detects missing pongs only while websocket_recv_nb is called
+    poll_interval = 4.0
+
     def upgrade_websocket(self, environ, start_response):
         uwsgi.websocket_handshake(environ['HTTP_SEC_WEBSOCKET_KEY'], environ.get('HTTP_ORIGIN', ''))
-        return uWSGIWebsocket()
+        outbound = None
+        if private_settings.WS4REDIS_OUTBOUND_QUEUE is not None:
+            outbound = OutboundQueue(**private_settings.WS4REDIS_OUTBOUND_QUEUE)
+        return uWSGIWebsocket(outbound=outbound)
 
     def select(self, rlist, wlist, xlist, timeout=None):
         return gevent.select.select(rlist, wlist, xlist, timeout)
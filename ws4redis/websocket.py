@@ -1,21 +1,38 @@
 # -*- coding: utf-8 -*-
 # This code was generously pilfered from https://bitbucket.org/Jeffrey/gevent-websocket
 # written by Jeffrey Gelens (http://noppo.pro/) and licensed under the Apache License, Version 2.0
+import codecs
 import logging
 import six
+import errno
+import socket
 import struct
 from socket import error as socket_error
+from ws4redis import metrics
+from ws4redis._compat import monotonic
 from ws4redis.utf8validator import Utf8Validator
-from ws4redis.exceptions import WebSocketError, FrameTooLargeException
+from ws4redis.exceptions import WebSocketError, FrameTooLargeException, SlowConsumerError
+
+# use Cython implementation of the payload masking if available
+try:
+    from wsaccel.xormask import createXorMasker
+except ImportError:
+    createXorMasker = None
 
 logger = logging.getLogger('django.request')
 
 if six.PY3:
     xrange = range
 
+utf8_decoder = codecs.getincrementaldecoder('utf-8')
+
+# not available on all platforms, where a write may then block until the client drained some data
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
 
 class WebSocket(object):
-    __slots__ = ('_closed', 'stream', 'utf8validator', 'utf8validate_last')
+    __slots__ = ('_closed', 'stream', 'compression', 'outbound', 'rtt', '_received_at', '_ping_sent_at',
+                 '_ping_payload', '_missed_pongs')
 
     OPCODE_CONTINUATION = 0x00
     OPCODE_TEXT = 0x01
@@ -24,11 +41,17 @@ class WebSocket(object):
     OPCODE_PING = 0x09
     OPCODE_PONG = 0x0a
 
-    def __init__(self, wsgi_input):
+    def __init__(self, wsgi_input, compression=None, outbound=None):
         self._closed = False
         self.stream = Stream(wsgi_input)
-        self.utf8validator = Utf8Validator()
-        self.utf8validate_last = None
+        self.compression = compression
+        self.outbound = outbound
+        # round trip time in seconds, measured by the latest answered PING
+        self.rtt = None
+        self._received_at = monotonic()
+        self._ping_sent_at = None
+        self._ping_payload = None
+        self._missed_pongs = 0
 
     def __del__(self):
         try:
@@ -50,7 +73,8 @@ class WebSocket(object):
             self.close(1007)
             raise
 
-    def _encode_bytes(self, text):
+    @staticmethod
+    def _encode_bytes(text):
         """
         :returns: The utf-8 byte string equivalent of `text`.
         """
@@ -85,6 +109,48 @@ class WebSocket(object):
     def closed(self):
         return self._closed
 
+    @property
+    def buffered(self):
+        """
+        True, if data has been received from the socket, but not yet been read. Then the next
+        frame can be read without waiting for the file descriptor to become readable.
+        """
+        return self.stream is not None and self.stream.buffered > 0
+
+    @property
+    def message_buffered(self):
+        """
+        True, if the stream holds all frames required by ``receive``, so that it returns without
+        waiting for the socket. This is the case for a complete message, a close frame, or
+        control frames which are not followed by any further data.
+        """
+        if self.stream is None:
+            return False
+        offset = 0
+        in_message = False
+        while True:
+            frame = self.stream.peek_frame(offset)
+            if frame is None:
+                return False
+            fin, opcode, size = frame
+            offset += size
+            if opcode in (self.OPCODE_PING, self.OPCODE_PONG):
+                if not in_message and offset == self.stream.buffered:
+                    return True
+            elif fin:
+                return True
+            else:
+                in_message = True
+
+    @property
+    def pending(self):
+        """
+        Number of bytes waiting in the outbound queue, until the socket becomes writable.
+        """
+        if self.outbound is None or self.stream is None:
+            return 0
+        return self.outbound.pending
+
     def handle_close(self, header, payload):
         """
         Called when a close frame has been decoded from the stream.
@@ -116,7 +182,47 @@ class WebSocket(object):
         self.send_frame(payload, self.OPCODE_PONG)
 
     def handle_pong(self, header, payload):
-        pass
+        if self._ping_payload is not None and payload == self._ping_payload:
+            self.rtt = self._received_at - self._ping_sent_at
+            self._ping_payload = None
+            self._missed_pongs = 0
+
+    def ping(self):
+        """
+        Send a PING frame to the client. Its payload identifies the matching PONG frame, which is
+        used to measure the round trip time.
+        """
+        self._ping_sent_at = monotonic()
+        self._ping_payload = struct.pack('!d', self._ping_sent_at)
+        self.send_frame(self._ping_payload, self.OPCODE_PING)
+
+    def keepalive(self, interval, max_missed=2):
+        """
+        Ping the client after ``interval`` seconds without having received anything from it. If
+        nothing is received within another ``interval`` seconds, the ping counts as missed and is
+        repeated. After ``max_missed`` consecutive missed pings, the websocket is closed.
+
+        :returns: The number of seconds until this method shall be called again.
+        """
+        now = monotonic()
+        if self._ping_sent_at is not None and self._received_at < self._ping_sent_at:
+            # waiting for any sign of life
+            due = self._ping_sent_at + interval
+            if now < due:
+                return due - now
+            self._missed_pongs += 1
+            if self._missed_pongs >= max_missed:
+                logger.info('websocket: closing after {0} missed pongs'.format(self._missed_pongs))
+                metrics.increment('keepalive.timeouts')
+                self.close(1001, 'Ping timeout')
+                return interval
+        else:
+            due = self._received_at + interval
+            if now < due:
+                return due - now
+            self._missed_pongs = 0
+        self.ping()
+        return interval
 
     def read_frame(self):
         """
@@ -128,41 +234,44 @@ class WebSocket(object):
         :return: The header and payload as a tuple.
         """
         header = Header.decode_header(self.stream)
+        self._received_at = monotonic()
         if header.flags:
-            raise WebSocketError
+            # RSV1 marks the first frame of a compressed message, if permessage-deflate was negotiated
+            if header.flags != Header.RSV0_MASK or not self.compression or \
+                    header.opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                raise WebSocketError('Unexpected reserved bits in {0!r}'.format(header))
         if not header.length:
-            return header, ''
+            return header, b''
+        if header.length > self.stream.max_buffer_size:
+            raise FrameTooLargeException('Frame exceeds {0} bytes'.format(self.stream.max_buffer_size))
         try:
             payload = self.stream.read(header.length)
         except socket_error:
-            payload = ''
-        except Exception:
+            payload = b''
+        except Exception as e:
             logger.debug("{}: {}".format(type(e), six.text_type(e)))
-            payload = ''
+            payload = b''
         if len(payload) != header.length:
             raise WebSocketError('Unexpected EOF reading frame payload')
         if header.mask:
             payload = header.unmask_payload(payload)
         return header, payload
 
-    def validate_utf8(self, payload):
-        # Make sure the frames are decodable independently
-        self.utf8validate_last = self.utf8validator.validate(payload)
-
-        if not self.utf8validate_last[0]:
-            raise UnicodeError("Encountered invalid UTF-8 while processing "
-                               "text message at payload octet index "
-                               "{0:d}".format(self.utf8validate_last[3]))
-
     def read_message(self):
         """
         Return the next text or binary message from the socket.
 
         This is an internal method as calling this will not cleanup correctly
         if an exception is called. Use `receive` instead.
+
+        The payloads of fragmented messages are collected and joined once, after the final
+        fragment has been read. Text is validated and decoded incrementally while reading, so
+        that each octet is checked for valid UTF-8 exactly once.
         """
         opcode = None
-        message = None
+        fragments = None
+        decoder = None
+        compressed = False
         while True:
             header, payload = self.read_frame()
             f_opcode = header.opcode
@@ -170,51 +279,60 @@ class WebSocket(object):
                 # a new frame
                 if opcode:
                     raise WebSocketError("The opcode in non-fin frame is expected to be zero, got {0!r}".format(f_opcode))
-                # Start reading a new message, reset the validator
-                self.utf8validator.reset()
-                self.utf8validate_last = (True, True, 0, 0)
                 opcode = f_opcode
+                compressed = bool(header.flags)
+                if compressed:
+                    payload = self.compression.decompress(payload, header.fin)
+                if header.fin:
+                    # the common case of an unfragmented message
+                    if opcode == self.OPCODE_TEXT:
+                        return payload.decode('utf-8')
+                    return six.binary_type(payload)
+                fragments = []
+                if opcode == self.OPCODE_TEXT:
+                    decoder = utf8_decoder()
             elif f_opcode == self.OPCODE_CONTINUATION:
                 if not opcode:
                     raise WebSocketError("Unexpected frame with opcode=0")
-            elif f_opcode == self.OPCODE_PING:
-                self.handle_ping(header, payload)
-                continue
-            elif f_opcode == self.OPCODE_PONG:
-                self.handle_pong(header, payload)
+                if compressed:
+                    payload = self.compression.decompress(payload, header.fin)
+            elif f_opcode in (self.OPCODE_PING, self.OPCODE_PONG):
+                if f_opcode == self.OPCODE_PING:
+                    self.handle_ping(header, payload)
+                else:
+                    self.handle_pong(header, payload)
+                if opcode is None and not self.stream.buffered:
+                    # do not wait for the next message after a lone control frame
+                    return
                 continue
             elif f_opcode == self.OPCODE_CLOSE:
                 self.handle_close(header, payload)
                 return
             else:
                 raise WebSocketError("Unexpected opcode={0!r}".format(f_opcode))
-            if opcode == self.OPCODE_TEXT:
-                self.validate_utf8(payload)
-                if six.PY3:
-                    payload = payload.decode()
-            if message is None:
-                message = six.text_type() if opcode == self.OPCODE_TEXT else six.binary_type()
-            message += payload
+            if decoder:
+                # raises UnicodeDecodeError as soon as an invalid octet is encountered
+                fragments.append(decoder.decode(payload, header.fin))
+            else:
+                fragments.append(payload)
             if header.fin:
                 break
-        if opcode == self.OPCODE_TEXT:
-            if six.PY2:
-                self.validate_utf8(message)
-            else:
-                self.validate_utf8(message.encode())
-            return message
-        else:
-            return bytearray(message)
+        if decoder:
+            return u''.join(fragments)
+        return b''.join(fragments)
 
     def receive(self):
         """
-        Read and return a message from the stream. If `None` is returned, then
-        the socket is considered closed/errored.
+        Read and return a message from the stream. If `None` is returned, then either only
+        control frames have been received, or the socket is considered closed/errored.
         """
         if self._closed:
             raise WebSocketError("Connection is already closed")
         try:
             return self.read_message()
+        except FrameTooLargeException as e:
+            logger.info('websocket.receive: FrameTooLargeException {}'.format(e))
+            self.close(1009)
         except UnicodeError as e:
             logger.info('websocket.receive: UnicodeError {}'.format(e))
             self.close(1007)
@@ -227,9 +345,37 @@ class WebSocket(object):
 
     def flush(self):
         """
-        Flush a websocket. In this implementation intentionally it does nothing.
+        Flush a websocket, writing as much of the outbound queue, as the socket accepts without
+        blocking. Without an outbound queue, it intentionally does nothing.
         """
-        pass
+        if self.outbound is not None and self.stream is not None:
+            try:
+                self.outbound.flush(self.stream)
+            except socket_error:
+                raise WebSocketError("Socket is dead")
+
+    def _write(self, frames, control=False):
+        """
+        Write ``frames``, a list of tuples ``(buffers, channel)``, each of them forming a frame.
+        With an outbound queue, the frames are queued and written without blocking, otherwise
+        they are written using a single vectored write. Control frames bypass the slow consumer
+        policy.
+        """
+        try:
+            if self.outbound is None:
+                self.stream.writev([buf for buffers, channel in frames for buf in buffers])
+                return
+            try:
+                for buffers, channel in frames:
+                    self.outbound.push(buffers, channel, control)
+            except SlowConsumerError as excpt:
+                logger.info('websocket: closing slow consumer with {0}'.format(excpt.code))
+                self.outbound.clear()
+                self.close(excpt.code, 'Slow consumer')
+                return
+            self.outbound.flush(self.stream)
+        except socket_error:
+            raise WebSocketError("Socket is dead")
 
     def send_frame(self, message, opcode):
         """
@@ -241,11 +387,42 @@ class WebSocket(object):
             message = self._encode_bytes(message)
         elif opcode == self.OPCODE_BINARY:
             message = six.binary_type(message)
-        header = Header.encode_header(True, opcode, '', len(message), 0)
-        try:
-            self.stream.write(header + message)
-        except socket_error:
-            raise WebSocketError("Socket is dead")
+        flags = 0
+        if self.compression and opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY) and \
+                len(message) >= self.compression.compress_threshold:
+            message = self.compression.compress(message)
+            flags = Header.RSV0_MASK
+        header = Header.encode_header(True, opcode, '', len(message), flags)
+        # gather header and payload in the kernel rather than concatenating them
+        self._write([([header, message], None)], control=opcode >= self.OPCODE_CLOSE)
+
+    def _encode_prepared(self, frame):
+        data = frame.get_data(self.compression)
+        if data is None:
+            # the compressor keeps its context, hence the payload must be compressed individually
+            payload = self.compression.compress(frame.payload)
+            return [Header.encode_header(True, frame.opcode, '', len(payload), Header.RSV0_MASK), payload]
+        return [data]
+
+    def send_prepared(self, frame):
+        """
+        Send a ``PreparedFrame`` over the websocket, without encoding its message again.
+        """
+        if self._closed:
+            raise WebSocketError("Connection is already closed")
+        self._write([(self._encode_prepared(frame), frame.channel)])
+
+    def send_prepared_batch(self, frames):
+        """
+        Send a sequence of ``PreparedFrame`` objects over the websocket, coalesced into as few
+        system calls as possible. Frames which must be compressed individually for this
+        websocket, are encoded in order, so that the message order is preserved.
+        """
+        if self._closed:
+            raise WebSocketError("Connection is already closed")
+        frames = [(self._encode_prepared(frame), frame.channel) for frame in frames]
+        if frames:
+            self._write(frames)
 
     def send(self, message, binary=False):
         """
@@ -267,10 +444,16 @@ class WebSocket(object):
         """
         try:
             message = self._encode_bytes(message)
+            if self.outbound is not None and self.stream is not None:
+                # a backlogged client shall receive the close frame, rather than the backlog
+                self.outbound.clear()
             self.send_frame(
                 struct.pack('!H%ds' % len(message), code, message),
                 opcode=self.OPCODE_CLOSE)
-        except WebSocketError:
+            if self.outbound is not None and self.stream is not None:
+                if not self.outbound.drain(self.stream, self.outbound.close_timeout):
+                    logger.debug("Timed out writing the closing frame")
+        except (WebSocketError, socket_error):
             # Failed to write the closing frame but it's ok because we're
             # closing the socket anyway.
             logger.debug("Failed to write closing frame -> closing socket")
@@ -280,22 +463,237 @@ class WebSocket(object):
             self.stream = None
 
 
+class PreparedFrame(object):
+    """
+    A message encoded once into a complete websocket frame, so that it can be sent to many
+    websockets without encoding it again for each of them.
+    """
+    __slots__ = ('message', 'opcode', 'payload', 'data', 'channel', 'seq', 'sequenced', '_compressed')
+
+    def __init__(self, message, binary=False, channel=None, seq=None):
+        self.message = message
+        self.channel = channel
+        # the sequence number of the message and the frame sent to clients resuming a subscription
+        self.seq = seq
+        self.sequenced = None
+        if binary:
+            self.opcode = WebSocket.OPCODE_BINARY
+            self.payload = six.binary_type(message)
+        else:
+            self.opcode = WebSocket.OPCODE_TEXT
+            self.payload = WebSocket._encode_bytes(message)
+        self.data = Header.encode_header(True, self.opcode, '', len(self.payload), 0) + self.payload
+        self._compressed = {}
+
+    def get_data(self, compression=None):
+        """
+        Returns the encoded frame for a websocket using ``compression``, or None, if the frame
+        can not be shared, because that websocket compresses with context takeover.
+        """
+        if compression is None or len(self.payload) < compression.compress_threshold:
+            return self.data
+        if not compression.server_no_context_takeover:
+            return None
+        key = (compression.server_max_window_bits, compression.compress_level, compression.memory_level)
+        data = self._compressed.get(key)
+        if data is None:
+            payload = compression.compress(self.payload)
+            data = Header.encode_header(True, self.opcode, '', len(payload), Header.RSV0_MASK) + payload
+            self._compressed[key] = data
+        return data
+
+
 class Stream(object):
     """
     Wraps the handler's socket/rfile attributes and makes it in to a file like
     object that can be read from/written to by the lower level websocket api.
+
+    Reads are served from a read-ahead buffer, which is filled using ``recv_into``, so that a
+    single system call can yield several pipelined frames. Payloads larger than the buffer are
+    received directly into a buffer of their own size.
+
+    Writes consisting of several buffers, such as a frame header followed by its payload, are
+    handed to the kernel using ``sendmsg``, which gathers them without copying into a joined
+    string first.
     """
 
-    __slots__ = ('read', 'write', 'fileno')
+    __slots__ = ('_sock', '_buffer', '_view', '_start', '_end', 'write', 'fileno')
+
+    buffer_size = 4096
+
+    # writes smaller than this are joined, since copying them is cheaper than gathering
+    gather_threshold = 4096
+
+    # maximum number of buffers passed to a single sendmsg call, see IOV_MAX
+    max_iovecs = 1024
+
+    # limits the buffer, while frames are received without blocking, and the payload of any frame
+    max_buffer_size = 16 * 1024 * 1024
 
     def __init__(self, wsgi_input):
         if six.PY2:
-            self.read = wsgi_input._sock.recv
-            self.write = wsgi_input._sock.sendall
+            self._sock = wsgi_input._sock
         else:
-            self.read = wsgi_input.raw._sock.recv
-            self.write = wsgi_input.raw._sock.sendall
+            self._sock = wsgi_input.raw._sock
+        self.write = self._sock.sendall
         self.fileno = wsgi_input.fileno()
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0
+
+    @property
+    def buffered(self):
+        """
+        Number of bytes received from the socket, which have not been consumed yet.
+        """
+        return self._end - self._start
+
+    def fill(self):
+        """
+        Receive whatever the socket offers without blocking and append it to the buffer. A full
+        buffer is enlarged, so that it is able to hold a frame, which then can be read completely
+        from the buffer.
+
+        :returns: The number of bytes received, zero if the peer closed the connection, or None
+            if nothing could be received without blocking.
+        """
+        start, end = self._start, self._end
+        if start == end:
+            start = end = 0
+            if len(self._buffer) > self.buffer_size:
+                # release an enlarged buffer, once it has been consumed
+                self._resize(self.buffer_size)
+        elif end == len(self._buffer):
+            if start:
+                self._view[:end - start] = self._view[start:end]
+                start, end = 0, end - start
+            elif end < self.max_buffer_size:
+                self._resize(min(2 * end, self.max_buffer_size))
+            else:
+                raise FrameTooLargeException('Frame exceeds {0} bytes'.format(self.max_buffer_size))
+        self._start, self._end = start, end
+        try:
+            received = self._sock.recv_into(self._view[end:], 0, _MSG_DONTWAIT)
+        except socket_error as excpt:
+            if excpt.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+        self._end = end + received
+        return received
+
+    def _resize(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        view[:self._end - self._start] = self._view[self._start:self._end]
+        self._buffer, self._view = buffer, view
+
+    def peek_frame(self, offset=0):
+        """
+        Returns a tuple ``(fin, opcode, size)`` for the frame starting ``offset`` bytes after the
+        read position, if the frame has been received completely, otherwise None.
+        """
+        buffer, position, available = self._buffer, self._start + offset, self._end - self._start - offset
+        if available < 2:
+            return None
+        first_byte, second_byte = buffer[position], buffer[position + 1]
+        length = second_byte & Header.LENGTH_MASK
+        size = 2
+        if length == 126:
+            if available < 4:
+                return None
+            length = struct.unpack_from('!H', buffer, position + 2)[0]
+            size = 4
+        elif length == 127:
+            if available < 10:
+                return None
+            length = struct.unpack_from('!Q', buffer, position + 2)[0]
+            size = 10
+        if second_byte & Header.MASK_MASK:
+            size += 4
+        size += length
+        if available < size:
+            return None
+        return bool(first_byte & Header.FIN_MASK), first_byte & Header.OPCODE_MASK, size
+
+    def read(self, size):
+        """
+        Read exactly ``size`` bytes from the socket, retrying on short reads. Less bytes are
+        returned only, if the peer closed the connection.
+        """
+        start, end = self._start, self._end
+        if end - start >= size:
+            self._start = start + size
+            return self._view[start:start + size].tobytes()
+        if size > len(self._buffer):
+            return self._read_large(size)
+        if start:
+            # compact the buffer to make room for the remaining bytes
+            self._view[:end - start] = self._view[start:end]
+            end -= start
+            self._start = start = 0
+        while end < size:
+            received = self._sock.recv_into(self._view[end:])
+            if not received:
+                break
+            end += received
+        size = min(size, end)
+        self._start, self._end = size, end
+        return self._view[:size].tobytes()
+
+    def writev(self, buffers):
+        """
+        Write all ``buffers`` to the socket, as if they were concatenated, retrying on short
+        writes. Small writes, and writes on platforms lacking ``sendmsg``, are joined and sent
+        using a single ``sendall``.
+        """
+        sendmsg = getattr(self._sock, 'sendmsg', None)
+        if sendmsg is None or sum(len(buf) for buf in buffers) < self.gather_threshold:
+            return self._sock.sendall(b''.join(buffers))
+        while buffers:
+            chunk = buffers[:self.max_iovecs]
+            sent = sendmsg(chunk)
+            remaining = sum(len(buf) for buf in chunk) - sent
+            if not remaining:
+                buffers = buffers[len(chunk):]
+                continue
+            # short write: skip the buffers sent completely and slice the partially sent one
+            index = 0
+            while sent >= len(chunk[index]):
+                sent -= len(chunk[index])
+                index += 1
+            buffers = [memoryview(buffers[index])[sent:]] + buffers[index + 1:]
+
+    def writev_nowait(self, buffers):
+        """
+        Write as much of ``buffers`` to the socket, as it accepts without blocking.
+
+        :returns: The number of bytes written, zero if the socket's send buffer is full.
+        """
+        try:
+            sendmsg = getattr(self._sock, 'sendmsg', None)
+            if sendmsg is None:
+                return self._sock.send(b''.join(buffers), _MSG_DONTWAIT)
+            return sendmsg(buffers[:self.max_iovecs], [], _MSG_DONTWAIT)
+        except socket_error as excpt:
+            if excpt.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def _read_large(self, size):
+        # the size is announced by the peer, hence check it before allocating a buffer of that size
+        if size > self.max_buffer_size:
+            raise FrameTooLargeException('Frame exceeds {0} bytes'.format(self.max_buffer_size))
+        payload = bytearray(size)
+        view = memoryview(payload)
+        received = self._end - self._start
+        view[:received] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while received < size:
+            count = self._sock.recv_into(view[received:])
+            if not count:
+                return payload[:received]
+            received += count
+        return payload
 
 
 class Header(object):
@@ -320,13 +718,20 @@ class Header(object):
         self.length = length
 
     def mask_payload(self, payload):
-        payload = bytearray(payload)
-        mask = bytearray(self.mask)
-        for i in xrange(self.length):
-            payload[i] ^= mask[i % 4]
-        if six.PY3:
-            return bytes(payload)
-        return str(payload)
+        length = len(payload)
+        if createXorMasker is not None:
+            return createXorMasker(self.mask, length).process(payload)
+        if six.PY2:
+            payload = bytearray(payload)
+            mask = bytearray(self.mask)
+            for i in xrange(length):
+                payload[i] ^= mask[i % 4]
+            return str(payload)
+        # XOR the whole payload at once against the repeated masking key, treating both as one
+        # big integer. Even for payloads of a few bytes, this is faster than a Python loop.
+        mask = (self.mask * (length // 4 + 1))[:length]
+        payload = int.from_bytes(payload, 'little') ^ int.from_bytes(mask, 'little')
+        return payload.to_bytes(length, 'little')
 
     # it's the same operation
     unmask_payload = mask_payload
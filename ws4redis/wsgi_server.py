@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
 
 import logging
@@ -11,13 +12,20 @@ if django.VERSION[:2] >= (1, 7):
 from django.conf import settings
 from django.contrib.auth import get_user
 from django.core.handlers.wsgi import WSGIRequest
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ImproperlyConfigured
 from django import http
 from django.utils.encoding import force_str
 from django.utils.functional import SimpleLazyObject
+from ws4redis import drain as drain_module
+from ws4redis import metrics
 from ws4redis import settings as private_settings
-from ws4redis.redis_store import RedisMessage
-from ws4redis.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError
+from ws4redis._compat import is_authenticated, monotonic
+from ws4redis.cluster import ShardedRedis, cluster_connection
+from ws4redis.identity import CachedUser, Identity, identity_cache
+from ws4redis.redis_store import RedisMessage, split_sequence
+from ws4redis.subscriber import MultiplexedRedisSubscriber
+from ws4redis.websocket import PreparedFrame
+from ws4redis.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError, DrainingError
 
 logger = logging.getLogger('django.request')
 
@@ -37,6 +45,9 @@ except ImportError:
     from django.utils.module_loading import import_by_path as import_string
 
 class WebsocketWSGIServer(object):
+    # maximum number of seconds to wait for I/O, for servers whose websockets must be polled
+    poll_interval = None
+
     def __init__(self, redis_connection=None):
         """
         redis_connection can be overriden by a mock object.
@@ -45,9 +56,52 @@ class WebsocketWSGIServer(object):
         module = import_module('.'.join(comps[:-1]))
         Subscriber = getattr(module, comps[-1])
         self.possible_channels = Subscriber.subscription_channels + Subscriber.publish_channels
-        self._redis_connection = redis_connection and redis_connection or StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        self._redis_connection = redis_connection or cluster_connection or StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        if isinstance(self._redis_connection, ShardedRedis) and not issubclass(Subscriber, MultiplexedRedisSubscriber):
+            # messages of channels located on different nodes, must be received through multiplexers
+            raise ImproperlyConfigured('WS4REDIS_CLUSTER requires MultiplexedRedisSubscriber as WS4REDIS_SUBSCRIBER')
         self.Subscriber = Subscriber
         self._websockets = set()  # a list of currently active websockets
+        self.compile_handshake()
+        self._drain = None
+        self._drain_deadlines = {}
+        # becomes readable, once the server drains, waking up the loops of all websockets
+        self._drain_fds = None
+        if drain_module.drain is not None:
+            self._drain_fds = os.pipe()
+            drain_module.drain.register(self)
+
+    def close(self):
+        """
+        Close the pipe waking up the websockets, once the server drains. Call this method after
+        the server has been shut down.
+        """
+        if self._drain_fds is not None:
+            for fd in self._drain_fds:
+                os.close(fd)
+            self._drain_fds = None
+
+    def compile_handshake(self):
+        """
+        Resolve the session store and the callbacks configured through ``WS4REDIS_PROCESS_REQUEST``
+        and ``WS4REDIS_ALLOWED_CHANNELS`` once, rather than on each handshake. Call this method
+        again, after changing one of these settings at runtime.
+        """
+        self._SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+        self._process_request = self.resolve_callback(private_settings.WS4REDIS_PROCESS_REQUEST)
+        if self._process_request is None:
+            self._process_request = self.process_request
+        self._allowed_channels = self.resolve_callback(private_settings.WS4REDIS_ALLOWED_CHANNELS)
+
+    @staticmethod
+    def resolve_callback(callback):
+        """
+        Returns the function referred to by ``callback``, which may be a dotted path, or None.
+        """
+        if isinstance(callback, six.string_types):
+            return import_string(callback)
+        if callable(callback):
+            return callback
 
     def assure_protocol_requirements(self, environ):
         if environ.get('REQUEST_METHOD') != 'GET':
@@ -64,9 +118,28 @@ class WebsocketWSGIServer(object):
         request.user = None
         session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
         if session_key is not None:
-            engine = import_module(settings.SESSION_ENGINE)
-            request.session = engine.SessionStore(session_key)
-            request.user = SimpleLazyObject(lambda: get_user(request))
+            request.session = self._SessionStore(session_key)
+            if identity_cache is None:
+                request.user = SimpleLazyObject(lambda: get_user(request))
+            else:
+                request.user = self.resolve_identity(request, session_key)
+
+    def resolve_identity(self, request, session_key):
+        """
+        Returns a ``CachedUser`` for the session of ``request``. Only if its identity is not cached
+        yet, the session and the user are loaded.
+        """
+        identity_cache.listen()
+        identity = identity_cache.get(session_key)
+        if identity is None:
+            request.user = get_user(request)
+            if is_authenticated(request):
+                memberof = request.session.get('ws4redis:memberof', [])
+                identity = Identity(request.user.get_username(), tuple(memberof))
+            else:
+                identity = Identity(None, ())
+            identity_cache.set(session_key, identity)
+        return CachedUser(identity, lambda: get_user(request))
 
     def process_subscriptions(self, request):
         agreed_channels = []
@@ -79,68 +152,203 @@ class WebsocketWSGIServer(object):
                 echo_message = True
         return agreed_channels, echo_message
 
+    def process_websocket_request(self, request, stopwatch=None):
+        """
+        Attach the session and the user to ``request`` and return the list of channels agreed
+        upon, restricted by ``WS4REDIS_ALLOWED_CHANNELS``, and whether to echo messages.
+        """
+        stopwatch = stopwatch or metrics.Stopwatch('handshake')
+        self._process_request(request)
+        stopwatch.lap('auth')
+        channels, echo_message = self.process_subscriptions(request)
+        if self._allowed_channels is not None:
+            channels = list(self._allowed_channels(request, channels))
+        stopwatch.lap('channels')
+        return channels, echo_message
+
+    def prepare_frame(self, response):
+        """
+        Returns a ``PreparedFrame`` for a response received from the subscriber. Subscribers sharing
+        their Redis connection, already deliver frames, which are shared among all recipients.
+        """
+        if isinstance(response, PreparedFrame):
+            return response
+        seq, message = split_sequence(RedisMessage(response))
+        if message:
+            return PreparedFrame(message, channel=response[1], seq=seq)
+
+    def receive_frames(self, subscriber, echo_message, recvmsg, block=True):
+        """
+        Read a batch of responses from ``subscriber`` and return the frames to be sent to the
+        client, together with a flag telling whether further responses may be pending. Unless
+        ``block`` is set, nothing is read if no response has been received yet.
+        """
+        responses = subscriber.parse_responses(private_settings.WS4REDIS_BATCH_SIZE, block)
+        if responses:
+            metrics.observe('subscriber.batch_size', len(responses))
+        frames = []
+        for response in responses:
+            frame = self.prepare_frame(response)
+            if frame and (echo_message or frame.message != recvmsg):
+                frames.append(frame)
+        if frames and subscriber.resumable:
+            frames = subscriber.sequence_frames(frames)
+        return frames, len(responses) >= private_settings.WS4REDIS_BATCH_SIZE
+
+    def detach_websocket(self, websocket, subscriber, echo_message):
+        """
+        Hook to hand an upgraded ``websocket`` over to another thread serving it, instead of
+        running the loop in the current one. Returns True, if the websocket has been taken over.
+        """
+        return False
+
     @property
     def websockets(self):
         return self._websockets
 
+    def drain(self, drain):
+        """
+        Called by ``ws4redis.drain.Drain`` from any thread. Reject further websockets and close
+        the open ones at the times scheduled by ``drain``.
+        """
+        self._drain_deadlines = drain.schedule(self._websockets)
+        self._drain = drain
+        if self._drain_fds is not None:
+            os.write(self._drain_fds[1], b'x')
+
+    def get_drain_deadline(self, websocket):
+        """
+        Returns the time at which ``websocket`` shall be closed, while the server drains,
+        otherwise None.
+        """
+        if self._drain is None:
+            return None
+        return self._drain_deadlines.get(websocket, monotonic())
+
+    def close_drained(self, websocket):
+        """
+        Close ``websocket``, telling its client when to reconnect.
+        """
+        logger.debug('Closing websocket, since the server drains')
+        self._drain_deadlines.pop(websocket, None)
+        websocket.close(self._drain.code, self._drain.get_close_reason())
+
     def __call__(self, environ, start_response):
         """
         Hijack the main loop from the original thread and listen on events on the Redis
         and the Websocket filedescriptors.
         """
         websocket = None
-        subscriber = self.Subscriber(self._redis_connection)
+        subscriber = None
+        detached = False
+        # time each stage of the handshake, see ws4redis.metrics.get_histograms()
+        stopwatch = metrics.Stopwatch('handshake')
+        if drain_module.drain is not None:
+            drain_module.drain.listen()
         try:
             self.assure_protocol_requirements(environ)
+            if self._drain is not None:
+                raise DrainingError('Server is draining')
+            stopwatch.lap('protocol')
             request = WSGIRequest(environ)
-            if isinstance(private_settings.WS4REDIS_PROCESS_REQUEST, six.string_types):
-                import_string(private_settings.WS4REDIS_PROCESS_REQUEST)(request)
-            elif callable(private_settings.WS4REDIS_PROCESS_REQUEST):
-                private_settings.WS4REDIS_PROCESS_REQUEST(request)
-            else:
-                self.process_request(request)
-            channels, echo_message = self.process_subscriptions(request)
-            if callable(private_settings.WS4REDIS_ALLOWED_CHANNELS):
-                channels = list(private_settings.WS4REDIS_ALLOWED_CHANNELS(request, channels))
-            elif private_settings.WS4REDIS_ALLOWED_CHANNELS is not None:
-                try:
-                    mod, callback = private_settings.WS4REDIS_ALLOWED_CHANNELS.rsplit('.', 1)
-                    callback = getattr(import_module(mod), callback, None)
-                    if callable(callback):
-                        channels = list(callback(request, channels))
-                except AttributeError:
-                    pass
+            stopwatch.lap('request')
+            channels, echo_message = self.process_websocket_request(request, stopwatch)
             websocket = self.upgrade_websocket(environ, start_response)
             self._websockets.add(websocket)
+            stopwatch.lap('upgrade')
             logger.debug('Subscribed to channels: {0}'.format(', '.join(channels)))
+            subscriber = self.Subscriber(self._redis_connection)
             subscriber.set_pubsub_channels(request, channels)
             websocket_fd = websocket.get_file_descriptor()
             listening_fds = [websocket_fd]
+            drain_fd = None
+            if self._drain_fds is not None:
+                drain_fd = self._drain_fds[0]
+                listening_fds.append(drain_fd)
             redis_fd = subscriber.get_file_descriptor()
             if redis_fd:
                 listening_fds.append(redis_fd)
+            stopwatch.lap('subscribe')
             subscriber.send_persisted_messages(websocket)
+            stopwatch.lap('replay')
+            if self.detach_websocket(websocket, subscriber, echo_message):
+                # from now on, the websocket is served by another thread
+                detached = True
+                return http.HttpResponse()
             recvmsg = None
+            keepalive = private_settings.WS4REDIS_KEEPALIVE
+            keepalive_timeout = 4.0
+            idle_timeout = private_settings.WS4REDIS_IDLE_TIMEOUT
+            # the heartbeat is due, after nothing has been sent for 4 seconds
+            heartbeat_at = monotonic() + 4.0
+            active_at = monotonic()
+            # set, if a batch read from Redis has been cut short and further responses are buffered
+            backlogged = False
+            # the time to close the websocket at, once the server drains
+            close_at = None
             while websocket and not websocket.closed:
-                ready = self.select(listening_fds, [], [], 4.0)[0]
-                if not ready:
-                    # flush empty socket
+                # wake up only on I/O or when one of the deadlines expires
+                now = monotonic()
+                timeouts = []
+                if private_settings.WS4REDIS_HEARTBEAT:
+                    timeouts.append(heartbeat_at - now)
+                if keepalive is not None:
+                    timeouts.append(keepalive_timeout)
+                if idle_timeout:
+                    timeouts.append(active_at + idle_timeout - now)
+                if self.poll_interval:
+                    timeouts.append(self.poll_interval)
+                if close_at is not None:
+                    timeouts.append(close_at - now)
+                timeout = max(min(timeouts), 0) if timeouts else None
+                if backlogged:
+                    timeout = 0
+                # wait for the socket to become writable only while frames are queued
+                ready, writable = self.select(listening_fds, [websocket_fd] if websocket.pending else [], [], timeout)[:2]
+                if backlogged and redis_fd not in ready:
+                    # responses received from Redis are buffered, hence the socket may not be readable
+                    ready = list(ready) + [redis_fd]
+                if writable or not ready:
+                    # flush empty socket and write queued frames
                     websocket.flush()
                 for fd in ready:
                     if fd == websocket_fd:
-                        recvmsg = RedisMessage(websocket.receive())
-                        if recvmsg:
-                            subscriber.publish_message(recvmsg)
+                        # consume all frames which already have been received in one go
+                        while True:
+                            message = websocket.receive()
+                            if message is not None:
+                                recvmsg = RedisMessage(message)
+                                active_at = monotonic()
+                                if recvmsg:
+                                    subscriber.publish_message(recvmsg)
+                            if websocket.closed or not websocket.buffered:
+                                break
                     elif fd == redis_fd:
-                        sendmsg = RedisMessage(subscriber.parse_response())
-                        if sendmsg and (echo_message or sendmsg != recvmsg):
-                            websocket.send(sendmsg)
+                        # while backlogged, the socket may not be readable and no response pending
+                        frames, backlogged = self.receive_frames(subscriber, echo_message, recvmsg, not backlogged)
+                        if frames:
+                            websocket.send_prepared_batch(frames)
+                            active_at = monotonic()
+                            heartbeat_at = active_at + 4.0
+                    elif fd == drain_fd:
+                        # the pipe remains readable, hence stop watching it
+                        listening_fds.remove(drain_fd)
+                        close_at = self.get_drain_deadline(websocket)
                     else:
                         logger.error('Invalid file descriptor: {0}'.format(fd))
                 # Check again that the websocket is closed before sending the heartbeat,
                 # because the websocket can closed previously in the loop.
-                if private_settings.WS4REDIS_HEARTBEAT and not websocket.closed:
-                    websocket.send(private_settings.WS4REDIS_HEARTBEAT)
+                if monotonic() >= heartbeat_at:
+                    heartbeat_at = monotonic() + 4.0
+                    if private_settings.WS4REDIS_HEARTBEAT and not websocket.closed:
+                        websocket.send(private_settings.WS4REDIS_HEARTBEAT)
+                if keepalive is not None and not websocket.closed:
+                    keepalive_timeout = websocket.keepalive(**keepalive)
+                if idle_timeout and monotonic() >= active_at + idle_timeout and not websocket.closed:
+                    logger.info('Closing websocket after {0} seconds without any message'.format(idle_timeout))
+                    websocket.close(1001, 'Idle timeout')
+                if close_at is not None and monotonic() >= close_at and not websocket.closed:
+                    self.close_drained(websocket)
                 # Remove websocket from _websockets if closed
                 if websocket.closed:
                     self._websockets.remove(websocket)
@@ -149,6 +357,10 @@ class WebsocketWSGIServer(object):
             response = http.HttpResponse(content='Websocket Closed')
             # bypass status code validation in HttpResponse constructor -- necessary for Django v1.11
             response.status_code = 1001
+        except DrainingError as excpt:
+            logger.info('Rejecting websocket, since the server drains')
+            response = http.HttpResponse(status=503, content=excpt)
+            response['Retry-After'] = str(int(self._drain.reconnect_delay) + 1)
         except UpgradeRequiredError as excpt:
             logger.info('Websocket upgrade required')
             response = http.HttpResponseBadRequest(status=426, content=excpt)
@@ -164,10 +376,14 @@ class WebsocketWSGIServer(object):
         else:
             response = http.HttpResponse()
         finally:
-            subscriber.release()
-            if websocket:
+            if detached:
+                pass
+            elif websocket:
+                if subscriber is not None:
+                    subscriber.release()
                 websocket.close(code=1001, message='Websocket Closed')
             else:
+                metrics.increment('handshake.rejected')
                 logger.warning('Starting late response on websocket')
                 status_text = http_client.responses.get(response.status_code, 'UNKNOWN STATUS CODE')
                 status = '{0} {1}'.format(response.status_code, status_text)